@@ -32,7 +32,9 @@ import kornia.metrics as metrics
 from torchvision import datasets
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 import random
+import time
 
 # Import GP and BoTorch functions
 import gpytorch as gpt
@@ -61,58 +63,31 @@ from botorch.optim import gen_batch_initial_conditions
 from gpytorch.models import ExactGP
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 # from smt.sampling_methods import LHS
+
+from latentbo_acquisition import ACQ_OPTIMIZERS, kriging_believer, refine_acquisition
+from latentbo_candidates import (TrajectoryDeduplicator, candidate_set, density_candidates, feasible_mask,
+                                 latent_box_grid, quadtree_feasible)
+from latentbo_feasibility import FeasibilityClassifier
+from latentbo_parallel import EvaluationExecutor, load_machine_profile, profile_layout, select_layout
+from latentbo_parametric import ParametricTrajectorySpace
+from latentbo_pca import LinearTrajectoryModel
+from latentbo_positive import PositiveTrajectoryModel
+from latentbo_profiling import (MemoryTracker, evaluation_profiler, install_memory_tracker, memory_begin, memory_end,
+                                memory_stage)
+from latentbo_pretrain import pretrain_trajectory_vae
+from latentbo_replay import record_table
+from latentbo_telemetry import NULL_BO_TELEMETRY, EvaluationCosts, bo_telemetry, phase_timer
+from latentbo_trajectories import trajectory_library
+from latentbo_trust_region import TrustRegion
 from torch.optim import SGD
 from torch.optim import Adam
 from scipy.stats import norm
-from scipy.interpolate import interp1d
 
 # import atomai as aoi
 
 from smt.sampling_methods import LHS
 
 
-# @title Helper functions
-
-def func_periodic(x, params):
-    y = params["A"] * np.exp(params["alpha"] * x) * np.cos(params["omega"] * x) + params["B"] * x
-    return y
-
-
-def generate_1Dspectra_Segment(degree, nsamples) -> torch.Tensor:
-    dataset = []
-    points = []
-    slopes = []
-
-    for i in range(nsamples):
-
-        x = np.linspace(-1, 1, 120)
-        segment_x = np.array([-1] + list(sorted(np.random.uniform(-1, 1, degree))) + [1])
-        segment_y = np.random.uniform(0, 1, degree + 2)
-        points.append(torch.from_numpy(segment_x))
-
-        slope = np.zeros(degree + 1)
-        for j in range(len(slope)):
-            slope[j] = (segment_y[j + 1] - segment_y[j]) / (segment_x[j + 1] - segment_x[j])
-        slope = torch.from_numpy(slope)
-
-        f2 = interp1d(segment_x, segment_y, kind='linear')
-        f2 = f2(x)
-        f2 = torch.from_numpy(f2).type(torch.float)
-        # noise = torch.randint(0, 50, (1,)) / 1e3
-        noise = 0  # no noise
-
-        data_t = f2 + noise * torch.randn(size=(len(x),))
-        dataset.append(data_t)
-        slopes.append(slope)
-
-    dataset = torch.cat(dataset).reshape(nsamples, 120)
-    points = torch.cat(points).reshape(nsamples, degree + 2)
-    slopes = torch.cat(slopes).reshape(nsamples, degree + 1)
-
-    # dataset = (dataset - dataset.min()) / (dataset.max() - dataset.min())
-    return dataset, points, slopes
-
-
 """#Functions defined for problem and objectives
 #Task
 - Build objective function with maximizing mean loss or the Structural dissimilarity (DSSIM) among the manifolds representing each discrete class
@@ -166,46 +141,46 @@ def ssim_loss(
     return loss
 
 
-# @title SSIM Loss objective function- Combined objective to minimize the ssim among the manifolds representing discrete classes, thus maximize the loss; and to maximize the ssim within the manifolds representing each discrete classes, thus minimize the loss
-def loss_obj(X, data, batch_size, B, H, W, discrete_dim):
-    # xx=float(X)
-    pen = 10 ** 0
-    data_dim = (H, W)
+# @title Manifolds of the discrete classes and SSIM losses among/within them (building blocks of loss_obj)
+def collect_manifolds(jvae, B, H, W, discrete_dim):
     M = torch.empty(B * B, H, W, discrete_dim)
-    loss1 = 0
-    loss2 = 0
-    train_loader_X = pv.utils.init_dataloader(data, batch_size=batch_size)
-    jvae_X = pv.models.jiVAE(data_dim, latent_dim=2, discrete_dim=discrete_dim, invariances=['r'], seed=42)
-
-    trainer_X = pv.trainers.SVItrainer(jvae_X, lr=1e-3, enumerate_parallel=True)
-
-    kl_scale = torch.from_numpy(X)
-    # print(kl_scale.shape)
-    for i in range(120):
-        sc = kl_scale[i] if i < len(kl_scale) else kl_scale[-1]
-        trainer_X.step(train_loader_X, scale_factor=[sc, sc])
-        # loss[i] = trainer_X.loss_history["training_loss"][-1]
-
     for i in range(discrete_dim):
-        M[:, :, :, i] = jvae_X.manifold2d(d=B, disc_idx=i, plot=False)
+        M[:, :, :, i] = jvae.manifold2d(d=B, disc_idx=i, plot=False)
 
     M = torch.reshape(M, (M.shape[0], 1, M.shape[1], M.shape[2], M.shape[3]))
-    k1 = 0
-    # Objective 1 is to minimize the ssim among the manifolds representing discrete classes, thus maximize the loss
-    for i in range(discrete_dim):
-        for j in range(discrete_dim):
-            if (j > i):
-                M1 = M[:, :, :, :, i]
-                M2 = M[:, :, :, :, j]
-                # print(M1.shape, M2.shape)
-                # Compute SSIM/loss among each manifolds
-                loss1 = loss1 + ssim_loss(M1, M2, 5)
-                k1 = k1 + 1
-    # obj1 = (loss1/k1)*pen
-    obj1 = (loss1) * pen
+    return M
 
-    # Objective 2 is to maximize the ssim within the manifolds representing each discrete classes, thus minimize the loss
 
+def inter_manifold_loss(M, discrete_dim, ssim_chunk=None):
+    # Sum of the SSIM losses over all pairs of class manifolds.
+    # With ssim_chunk, up to ssim_chunk pairs are stacked into a single ssim call (same value, fewer calls,
+    # memory bounded by the chunk size)
+    loss1 = 0
+    if ssim_chunk is None:
+        for i in range(discrete_dim):
+            for j in range(discrete_dim):
+                if (j > i):
+                    M1 = M[:, :, :, :, i]
+                    M2 = M[:, :, :, :, j]
+                    # print(M1.shape, M2.shape)
+                    # Compute SSIM/loss among each manifolds
+                    loss1 = loss1 + ssim_loss(M1, M2, 5)
+    else:
+        pairs = [(i, j) for i in range(discrete_dim) for j in range(discrete_dim) if (j > i)]
+        for c in range(0, len(pairs), ssim_chunk):
+            chunk = pairs[c:c + ssim_chunk]
+            M1 = torch.cat([M[:, :, :, :, i] for (i, j) in chunk])
+            M2 = torch.cat([M[:, :, :, :, j] for (i, j) in chunk])
+            loss_map = ssim_loss(M1, M2, 5, reduction='none')
+            # Mean over each pair, summed over the pairs of the chunk
+            loss1 = loss1 + torch.sum(torch.mean(torch.reshape(loss_map, (len(chunk), -1)), 1))
+    return loss1
+
+
+# Returns the loss and the number of ssim_loss calls
+def intra_manifold_loss(M, B, discrete_dim):
+    loss2 = 0
+    n_calls = 0
     np.random.seed(0)
     n_image = 1000
     idxy = np.random.randint(0, B * B, (n_image, 2))
@@ -226,12 +201,53 @@ def loss_obj(X, data, batch_size, B, H, W, discrete_dim):
                 k2 = k2 + 1
 
         loss2 = loss2 + (l2 / k2)
+        n_calls = n_calls + k2
+    return loss2, n_calls
+
+
+# @title SSIM Loss objective function- Combined objective to minimize the ssim among the manifolds representing discrete classes, thus maximize the loss; and to maximize the ssim within the manifolds representing each discrete classes, thus minimize the loss
+def loss_obj(X, data, batch_size, B, H, W, discrete_dim, num_epochs=120, ssim_chunk=None, phase_log=None):
+    # phase_log: JSON-lines file receiving the per-phase timings of this evaluation (None disables the timers)
+    timer = phase_timer(phase_log)
+    # xx=float(X)
+    pen = 10 ** 0
+    data_dim = (H, W)
+    with timer.phase("dataloader"):
+        train_loader_X = pv.utils.init_dataloader(data, batch_size=batch_size)
+    with timer.phase("model_init"):
+        jvae_X = pv.models.jiVAE(data_dim, latent_dim=2, discrete_dim=discrete_dim, invariances=['r'], seed=42)
+
+        trainer_X = pv.trainers.SVItrainer(jvae_X, lr=1e-3, enumerate_parallel=True)
+
+    kl_scale = torch.from_numpy(X)
+    # print(kl_scale.shape)
+    for i in range(num_epochs):
+        sc = kl_scale[i] if i < len(kl_scale) else kl_scale[-1]
+        with timer.phase("epoch"):
+            trainer_X.step(train_loader_X, scale_factor=[sc, sc])
+        # loss[i] = trainer_X.loss_history["training_loss"][-1]
+
+    with timer.phase("manifold2d"):
+        M = collect_manifolds(jvae_X, B, H, W, discrete_dim)
+
+    # Objective 1 is to minimize the ssim among the manifolds representing discrete classes, thus maximize the loss
+    with timer.phase("ssim_inter"):
+        loss1 = inter_manifold_loss(M, discrete_dim, ssim_chunk)
+    # obj1 = (loss1/k1)*pen
+    obj1 = (loss1) * pen
+
+    # Objective 2 is to maximize the ssim within the manifolds representing each discrete classes, thus minimize the loss
+    with timer.phase("ssim_intra"):
+        loss2, ssim_calls_intra = intra_manifold_loss(M, B, discrete_dim)
 
     # obj2 = (loss2/discrete_dim)*pen
     obj2 = (loss2) * pen
 
     obj = obj1 - obj2  # obj2 converted into maximization problem
 
+    timer.emit(objective=float(obj), num_epochs=num_epochs, batch_size=batch_size, n_images=len(data),
+               shape=[H, W], discrete_dim=discrete_dim, ssim_chunk=ssim_chunk, threads=torch.get_num_threads(),
+               ssim_calls_inter=discrete_dim * (discrete_dim - 1) // 2, ssim_calls_intra=ssim_calls_intra)
     return obj
 
 
@@ -275,31 +291,28 @@ def loss_obj2(X, data, batch_size, B, H, W, discrete_dim):
 
 
 # @title Eliminate infeasible latent space from data
-def getfeasible(X, fix_model):
-    X_f = np.zeros((X.shape[1] ** X.shape[0], X.shape[0]))
-    z = torch.empty((1, 2))
-    k = 0
-    for t1 in range(0, X.shape[1]):
-        for t2 in range(0, X.shape[1]):
-            z[0, 0] = X[0, t1]
-            z[0, 1] = X[1, t2]
-            decoded_traj = fix_model.decode(z).numpy()
-            if (np.min(decoded_traj) > 0):
-                # decoded_traj_feas[t1, t2] = 1 #1 denotes feasible
-                X_f[k, 0] = X[0, t1]
-                X_f[k, 1] = X[1, t2]
-                k = k + 1
-            else:
-                # decoded_traj_feas[t1, t2] = 0 #0 denotes infeasible
-                X_f[k, 0] = np.inf
-                X_f[k, 1] = np.inf
-                k = k + 1
-
-    X_feas = np.transpose(np.vstack((X_f[~np.isinf(X_f[:, 0]), 0], X_f[~np.isinf(X_f[:, 1]), 1])))
-    X_feas = torch.from_numpy(X_feas)
-    # print(X_f.shape)
-    # print(X_feas.shape)
-    return X_feas
+def getfeasible(X, fix_model, budget=None, feasibility="scan", candidates=None):
+    # budget: maximum number of candidates; grids larger than the budget (e.g. latent_dim > 2) are replaced by a
+    #         Sobol sample of the same box (latentbo_candidates), None keeps the full grid
+    # feasibility: "scan" (decode every candidate), "quadtree" (2D grids: decode coarse cells and refine only
+    #              along the feasibility boundary) or a fitted FeasibilityClassifier (decode only the uncertain ones)
+    # candidates: explicit candidate points (n, d) used instead of the grid of X, e.g. density_candidates
+    # Search spaces that are feasible by construction (latentbo_parametric) enumerate their candidates directly
+    if candidates is not None:
+        X_c = torch.as_tensor(candidates, dtype=torch.float64)
+        if hasattr(fix_model, "candidates"):
+            return X_c
+    elif hasattr(fix_model, "candidates"):
+        return fix_model.candidates(X, budget)
+    else:
+        X_c = candidate_set(X, budget)
+    if isinstance(feasibility, FeasibilityClassifier):
+        mask, _ = feasibility.screen(fix_model, X_c)
+        return X_c[mask]
+    if feasibility == "quadtree" and candidates is None and X.shape[0] == 2 and len(X_c) == X.shape[1] ** 2:
+        mask, _ = quadtree_feasible(fix_model, X)
+        return X_c[mask.reshape(-1)]
+    return X_c[feasible_mask(fix_model, X_c)]
 
 
 """#Functions defined for BO architecture
@@ -368,11 +381,41 @@ def optimize_hyperparam_trainGP(train_X, train_Y):
 
         optimizer1.step()
 
+    # Marginal log likelihood at the last optimizer step (reported by the BO telemetry)
+    gp_surro.final_mll = -loss1.item()
     gp_surro.eval()
     gp_surro.likelihood.eval()
     return gp_surro
 
 
+# Evaluation cost model: GP of the standardized log wall time of the evaluations (same model and fit as above)
+def optimize_cost_model(train_X, costs):
+    # Evaluations without a representative cost (NaN, e.g. the profiled one) are left out
+    costs = torch.as_tensor(costs, dtype=torch.float64)
+    train_X = train_X[torch.isfinite(costs)]
+    log_cost = torch.log(costs[torch.isfinite(costs)].clamp_min(1e-6))
+    cost_mean, cost_std = log_cost.mean(), log_cost.std().clamp_min(1e-6)
+    gp_cost = optimize_hyperparam_trainGP(train_X, ((log_cost - cost_mean) / cost_std).float().reshape(-1, 1))
+    gp_cost.cost_mean, gp_cost.cost_std = cost_mean, cost_std
+    return gp_cost
+
+
+# Predicted evaluation cost (seconds) at test_X: exp of the posterior mean of the log-cost GP, in batches
+def predict_cost(gp_cost, test_X, chunk=4096):
+    with torch.no_grad():
+        mean = torch.cat([gp_cost.posterior(test_X[start:start + chunk]).mean.reshape(-1)
+                          for start in range(0, len(test_X), chunk)])
+    return torch.exp(mean.double() * gp_cost.cost_std + gp_cost.cost_mean)
+
+
+# Differentiable predicted cost (seconds) of normalized points, the divisor of the refined cost-aware acquisition
+def cost_function(gp_cost):
+    def cost(X_norm):
+        mean = gp_cost.posterior(X_norm.to(gp_cost.train_inputs[0].dtype)).mean.reshape(-1)
+        return torch.exp(mean.double() * gp_cost.cost_std + gp_cost.cost_mean)
+    return cost
+
+
 # GP posterior predictions#
 def cal_posterior(gp_surro, test_X):
     y_pred_means = torch.empty(len(test_X), 1)
@@ -385,8 +428,7 @@ def cal_posterior(gp_surro, test_X):
                 gpt.settings.max_cg_iterations(100), \
                 gpt.settings.max_preconditioner_size(80), \
                 gpt.settings.num_trace_samples(128):
-            t_X[:, 0] = test_X[t, 0]
-            t_X[:, 1] = test_X[t, 1]
+            t_X[:, :] = test_X[t, :]
             # t_X = test_X.double()
             y_pred_surro = gp_surro.posterior(t_X)
             y_pred_means[t, 0] = y_pred_surro.mean
@@ -424,31 +466,93 @@ def acqmanEI(y_pred_means, y_pred_vars, train_Y):
 """
 
 
+# Evaluate the objective for a batch of latent points, sequentially or concurrently on an EvaluationExecutor
+def evaluate_latent_batch(Z, fix_params, data, fix_model, m, executor=None, obj_kwargs=None,
+                          telemetry=NULL_BO_TELEMETRY, profiler=None, objective=None):
+    # objective: function with the signature of loss_obj evaluated sequentially (None: loss_obj)
+    objective = loss_obj if objective is None else objective
+    batch_size, B, H, W, discrete_dim = fix_params[0], fix_params[1], fix_params[2], fix_params[3], fix_params[4]
+    decoded_traj = fix_model.decode(Z.float()).numpy()
+    decoded_traj = np.reshape(decoded_traj, (decoded_traj.shape[0], -1))
+    Y = torch.empty((len(Z), 1))
+    if executor is None:
+        for k in range(len(Z)):
+            print("Function eval #" + str(m + 1))
+            t0 = time.perf_counter()
+            profiled = profiler is not None and profiler.wants(m + 1)
+            with memory_stage("loss_obj"):
+                if profiled:
+                    Y[k, 0] = profiler.run(m + 1, objective, decoded_traj[k], data, batch_size, B, H, W, discrete_dim,
+                                           **(obj_kwargs or {}))
+                else:
+                    Y[k, 0] = objective(decoded_traj[k], data, batch_size, B, H, W, discrete_dim,
+                                        **(obj_kwargs or {}))
+            telemetry.add_evaluation(time.perf_counter() - t0, profiled=profiled)
+            m = m + 1
+    else:
+        # The executor workers already hold data, fix_params and obj_kwargs, only the trajectories are shipped
+        # (the memory stage then covers the worker processes through their RSS, when psutil is installed).
+        # A profiled evaluation runs in this process instead, so that the trace is captured here.
+        with memory_stage("loss_obj_batch"):
+            profiled = [profiler is not None and profiler.wants(m + k + 1) for k in range(len(Z))]
+            futures = [None if profiled[k] else executor.submit(decoded_traj[k]) for k in range(len(Z))]
+            for k in range(len(Z)):
+                print("Function eval #" + str(m + 1))
+                if profiled[k]:
+                    t0 = time.perf_counter()
+                    Y[k, 0] = profiler.run(m + 1, objective, decoded_traj[k], data, batch_size, B, H, W, discrete_dim,
+                                           **(obj_kwargs or {}))
+                    telemetry.add_evaluation(time.perf_counter() - t0, profiled=True)
+                else:
+                    Y[k, 0] = futures[k].result()
+                    telemetry.add_evaluation(futures[k].timing["run_s"], futures[k].timing["queue_wait_s"])
+                m = m + 1
+    return Y, m
+
+
 # Normalize all data. It is very important to fit GP model with normalized data to avoid issues such as
 # - decrease of GP performance due to largely spaced real-valued data X.
-def normalize_get_initialdata_KL(X, fix_params, data, fix_model, num_rows, num, m):
+def normalize_get_initialdata_KL(X, fix_params, data, fix_model, num_rows, num, m, executor=None, obj_kwargs=None,
+                                 telemetry=NULL_BO_TELEMETRY, profiler=None, objective=None, candidate_budget=None,
+                                 feasibility="scan", candidates=None, dedup=None):
     # Eliminate infeasible region in the latent space
-    X_feas = getfeasible(X, fix_model)
+    X_feas = getfeasible(X, fix_model, candidate_budget, feasibility, candidates)
+    if dedup is not None:
+        # Drop the candidates whose decoded trajectory is within tol of a kept one (TrajectoryDeduplicator)
+        keep, _ = dedup.unique(X_feas)
+        X_feas = X_feas[keep]
 
-    X_feas_norm = torch.empty((X_feas.shape[0], X_feas.shape[1]))
     # train_X = torch.empty((len(X), num))
     # train_X_norm = torch.empty((len(X), num))
     train_Y = torch.empty((num, 1))
 
+    while True:
+        # Select starting samples randomly as training data
+        np.random.seed(0)
+        xlimits = np.array([[0, len(X_feas)]])
+        sampling = LHS(xlimits=xlimits)
+
+        idx = sampling(num)
+        idx = np.reshape(idx, (idx.shape[0] * idx.shape[1]))
+        idx = np.round(idx)
+        # idx = np.random.randint(0, len(X_feas), num)
+        if not isinstance(feasibility, FeasibilityClassifier):
+            break
+        # Candidates screened by the classifier: verify the initial design with the decoder, drop the infeasible
+        # candidates and draw again
+        ok = feasible_mask(fix_model, X_feas[idx])
+        if ok.all():
+            break
+        keep = torch.ones(len(X_feas), dtype=torch.bool)
+        keep[torch.from_numpy(idx[~ok.numpy()].astype(np.int64))] = False
+        X_feas = X_feas[keep]
+
+    X_feas_norm = torch.empty((X_feas.shape[0], X_feas.shape[1]))
     # Normalize X
     for i in range(0, X_feas.shape[1]):
         X_feas_norm[:, i] = (X_feas[:, i] - torch.min(X_feas[:, i])) / (
                     torch.max(X_feas[:, i]) - torch.min(X_feas[:, i]))
 
-    # Select starting samples randomly as training data
-    np.random.seed(0)
-    xlimits = np.array([[0, len(X_feas)]])
-    sampling = LHS(xlimits=xlimits)
-
-    idx = sampling(num)
-    idx = np.reshape(idx, (idx.shape[0] * idx.shape[1]))
-    idx = np.round(idx)
-    # idx = np.random.randint(0, len(X_feas), num)
     train_X = X_feas[idx]
     train_X_norm = X_feas_norm[idx]
 
@@ -457,18 +561,18 @@ def normalize_get_initialdata_KL(X, fix_params, data, fix_model, num_rows, num,
     np.save("train_X_norm.npy", train_X_norm)
 
     # Evaluate initial training data
-    z = torch.empty((1, 2))
-    for i in range(0, num):
-        z[0, 0] = train_X[i, 0]
-        z[0, 1] = train_X[i, 1]
-        decoded_traj = fix_model.decode(z).numpy()
-        decoded_traj1 = np.reshape(decoded_traj, (decoded_traj.shape[0] * decoded_traj.shape[1]))
-        print("Function eval #" + str(m + 1))
-        batch_size, B, H, W, discrete_dim  = fix_params[0], fix_params[1], fix_params[2], fix_params[3], fix_params[4]
-
-        train_Y[i, 0] = loss_obj(decoded_traj1, data, batch_size, B, H, W, discrete_dim)
-        m = m + 1
-        # Saving/Updating data at each iterations
+    if executor is None:
+        for i in range(0, num):
+            train_Y[i:i + 1], m = evaluate_latent_batch(train_X[i:i + 1], fix_params, data, fix_model, m,
+                                                        obj_kwargs=obj_kwargs, telemetry=telemetry,
+                                                        profiler=profiler, objective=objective)
+            # Saving/Updating data at each iterations
+            np.save("train_Y.npy", train_Y)
+            np.save("m.npy", m)
+    else:
+        # Initial samples are independent, evaluate them all concurrently
+        train_Y, m = evaluate_latent_batch(train_X, fix_params, data, fix_model, m, executor, obj_kwargs, telemetry,
+                                           profiler, objective)
         np.save("train_Y.npy", train_Y)
         np.save("m.npy", m)
 
@@ -476,45 +580,42 @@ def normalize_get_initialdata_KL(X, fix_params, data, fix_model, num_rows, num,
 
 
 ################################Augment data - Existing training data with new evaluated data################################
-def augment_newdata_KL(acq_X, acq_X_norm, train_X, train_X_norm, train_Y, fix_params, data, fix_model, m):
+def augment_newdata_KL(acq_X, acq_X_norm, train_X, train_X_norm, train_Y, fix_params, data, fix_model, m,
+                       executor=None, obj_kwargs=None, telemetry=NULL_BO_TELEMETRY, profiler=None, objective=None):
     nextX = acq_X
     nextX_norm = acq_X_norm
     # train_X_norm = torch.cat((train_X_norm, nextX_norm), 0)
     # train_X_norm = train_X_norm.double()
     train_X_norm = torch.vstack((train_X_norm, nextX_norm))
     train_X = torch.vstack((train_X, nextX))
-    next_feval = torch.empty(1, 1)
-    z = torch.empty((1, 2))
-    z[0, 0] = train_X[-1, 0]
-    z[0, 1] = train_X[-1, 1]
-    decoded_traj = fix_model.decode(z).numpy()
-    decoded_traj1 = np.reshape(decoded_traj, (decoded_traj.shape[0] * decoded_traj.shape[1]))
-    print("Function eval #" + str(m + 1))
-    batch_size, B, H, W, discrete_dim = fix_params[0], fix_params[1], fix_params[2], fix_params[3], fix_params[4]
-
-    next_feval[0, 0] = loss_obj(decoded_traj1, data, batch_size, B, H, W, discrete_dim)
+    # All rows of acq_X are evaluated (more than one when a batch of q points is acquired per iteration)
+    next_feval, m = evaluate_latent_batch(nextX, fix_params, data, fix_model, m, executor, obj_kwargs, telemetry,
+                                          profiler, objective)
 
     train_Y = torch.vstack((train_Y, next_feval))
 
     # train_Y = torch.cat((train_Y, next_feval), 0)
-    m = m + 1
     return train_X, train_X_norm, train_Y, m
 
 
 # @title Functions to plot KL trajectories at specific BO iterations
-def plot_iteration_results(train_X, train_Y, test_X, y_pred_means, y_pred_vars, fix_model, i):
+def plot_iteration_results(train_X, train_Y, test_X, y_pred_means, y_pred_vars, fix_model, i, plot=True):
+    # plot: False only decodes the best evaluated/estimated trajectories (no figures)
     pen = 10 ** 0
     # Best solution among the evaluated data
 
     loss = torch.max(train_Y)
     ind = torch.argmax(train_Y)
-    z_opt = torch.empty((1, 2))
+    z_opt = torch.empty((1, train_X.shape[1]))
     # X_opt = train_X[ind, :]
-    z_opt[0, 0] = train_X[ind, 0]
-    z_opt[0, 1] = train_X[ind, 1]
+    z_opt[0, :] = train_X[ind, :]
     decoded_traj = fix_model.decode(z_opt).numpy()
     decoded_traj1 = np.reshape(decoded_traj, (decoded_traj.shape[0] * decoded_traj.shape[1]))
     kl_scale_eval = torch.from_numpy(decoded_traj1)
+    if not plot:
+        z_opt_robust = test_X[torch.argmax(y_pred_means)].reshape(1, -1).float()
+        kl_scale_est = torch.from_numpy(fix_model.decode(z_opt_robust).numpy().reshape(-1))
+        return kl_scale_eval, kl_scale_est
     n = len(kl_scale_eval)
     plt.figure()
     plt.plot(np.linspace(1, n, n), kl_scale_eval.detach().numpy(), 'ro-', markersize=2, linewidth=1)
@@ -530,10 +631,9 @@ def plot_iteration_results(train_X, train_Y, test_X, y_pred_means, y_pred_vars,
     robust_Y = y_pred_means
     loss = torch.max(robust_Y)
     ind = torch.argmax(robust_Y)
-    z_opt_robust = torch.empty((1, 2))
+    z_opt_robust = torch.empty((1, test_X.shape[1]))
     # X_opt = train_X[ind, :]
-    z_opt_robust[0, 0] = test_X[ind, 0]
-    z_opt_robust[0, 1] = test_X[ind, 1]
+    z_opt_robust[0, :] = test_X[ind, :]
     decoded_traj = fix_model.decode(z_opt_robust).numpy()
     decoded_traj1 = np.reshape(decoded_traj, (decoded_traj.shape[0] * decoded_traj.shape[1]))
     kl_scale_est = torch.from_numpy(decoded_traj1)
@@ -574,31 +674,175 @@ def plot_iteration_results(train_X, train_Y, test_X, y_pred_means, y_pred_vars,
 
 
 # @title BO framework- Integrating the above functions
-def latentBO_KL(X, fix_params, data, fix_model, num_rows, num_start, N):
+def latentBO_KL(X, fix_params, data, fix_model, num_rows, num_start, N, executor=None, q=1, obj_kwargs=None,
+                bo_log=None, profile_eval=None, profile_dir=".", objective=None, plot=True, candidate_budget=None,
+                acq_optimizer="grid", acq_starts=8, trust_region=False, tr_candidates=2000, feasibility="scan",
+                candidates=None, dedup_tol=None, cost_aware=False, time_budget_s=None):
+    # executor: optional EvaluationExecutor (latentbo_parallel) to run objective evaluations concurrently
+    # q: number of candidates (highest EI values) acquired and evaluated per BO iteration
+    # obj_kwargs: extra keyword arguments of loss_obj for sequential evaluations (e.g. ssim_chunk)
+    # bo_log: JSON-lines file receiving the time breakdown of every BO iteration (None disables it)
+    # profile_eval: function evaluation number(s) captured with torch.profiler + cProfile (None: no profiling),
+    #               traces are written to profile_dir
+    # objective: sequential objective with the signature of loss_obj (None: loss_obj), e.g. a synthetic test problem
+    # plot: save the iteration figures (every 5th iteration and the final one)
+    # candidate_budget: maximum number of candidates (see getfeasible), None: the full grid of X
+    # feasibility: "scan", "quadtree" or "classifier" feasibility check of the candidates (see getfeasible); with
+    #              "classifier" a FeasibilityClassifier (latentbo_feasibility.py) screens the candidates, the trust
+    #              region and the L-BFGS refinement, and the acquired candidates are verified with the decoder
+    # candidates: explicit candidate points (n, d) instead of the grid of X (e.g. density_candidates); X still
+    #             sets the dimension and the box of the feasibility classifier
+    # dedup_tol: drop the candidates whose decoded trajectory is within dedup_tol (max-abs over the steps) of a kept
+    #            one, and mask the candidates within dedup_tol of an evaluated trajectory from the acquisition (None: off,
+    #            0: exact duplicates)
+    # cost_aware: acquire by expected improvement per unit of predicted evaluation cost; the cost model is a GP fitted
+    #             to the measured wall time of the evaluations
+    # time_budget_s: wall-clock budget of the campaign (seconds); the BO stops before an evaluation that the cost
+    #                model predicts to end past the budget (None: N iterations)
+    # acq_optimizer: "grid" (best scored candidate) or "lbfgs" (the acq_starts best candidates refined by multi-start
+    #                L-BFGS-B over the latent box with a feasibility penalty, see latentbo_acquisition.py)
+    # trust_region: score tr_candidates Sobol points of a trust region around the best evaluated point instead of the
+    #               global candidates every iteration (see latentbo_trust_region.py)
+    # Start of the campaign: time_budget_s includes the set-up and the initial design
+    t_start = time.perf_counter()
+    if acq_optimizer not in ACQ_OPTIMIZERS:
+        raise ValueError("Unknown acquisition optimizer: {}".format(acq_optimizer))
+    if feasibility not in ("scan", "quadtree", "classifier"):
+        raise ValueError("Unknown feasibility check: {}".format(feasibility))
+    # Latent models with candidates() are feasible everywhere, no feasibility check or penalty needed
+    constraint_model = None if hasattr(fix_model, "candidates") else fix_model
+    classifier = None
+    if feasibility == "classifier" and constraint_model is not None:
+        classifier = FeasibilityClassifier().fit(fix_model, torch.min(X, 1)[0], torch.max(X, 1)[0])
+        print("Feasibility classifier: train accuracy " + str(classifier.train_accuracy))
+        feasibility = classifier
+    dedup = None if dedup_tol is None else TrajectoryDeduplicator(fix_model, dedup_tol)
+    telemetry = bo_telemetry(bo_log, N)
+    track_cost = cost_aware or time_budget_s is not None
+    if track_cost:
+        telemetry = EvaluationCosts(telemetry)
+    profiler = evaluation_profiler(profile_eval, profile_dir)
     num = num_start
     m = 0
     # Initialization: evaluate few initial data normalize data
-    test_X, test_X_norm, train_X, train_X_norm, train_Y, m = \
-        normalize_get_initialdata_KL(X, fix_params, data, fix_model, num_rows, num, m)
+    telemetry.start_iteration(0)
+    with telemetry.phase("evaluation"):
+        test_X, test_X_norm, train_X, train_X_norm, train_Y, m = \
+            normalize_get_initialdata_KL(X, fix_params, data, fix_model, num_rows, num, m, executor, obj_kwargs,
+                                         telemetry, profiler, objective, candidate_budget, feasibility,
+                                         candidates, dedup)
 
     print("Initial evaluation complete. Start BO")
     ## Gp model fit
     # Calling function to fit and optimizize Hyperparameter of Gaussian Process (using Adam optimizer)
     # Input args- Torch arrays of normalized training data, parameter X and objective eval Y
     # Output args- Gaussian process model lists
-    gp_surro = optimize_hyperparam_trainGP(train_X_norm, train_Y)
+    with telemetry.phase("gp_fit"):
+        gp_surro = optimize_hyperparam_trainGP(train_X_norm, train_Y)
+        gp_cost = optimize_cost_model(train_X_norm, telemetry.run_s) if track_cost else None
+    telemetry.set(mll=gp_surro.final_mll, n_train=len(train_Y), best=float(train_Y.max()))
+    telemetry.end_iteration()
+    # Normalized box of the candidates (test_X_norm) in the latent space
+    lower = torch.min(test_X, 0)[0]
+    span = torch.max(test_X, 0)[0] - lower
+    if classifier is not None:
+        feasible_fn = lambda z: classifier.screen(fix_model, z)[0]
+    elif constraint_model is not None:
+        feasible_fn = lambda z: feasible_mask(constraint_model, z)
+    else:
+        feasible_fn = None
+    tr = TrustRegion(len(X), q) if trust_region else None
+    if dedup is not None:
+        test_traj = dedup.trajectories(test_X)
+        dedup.add(train_X)
+        print("Candidates after deduplication: " + str(len(test_X)))
 
     for i in range(1, N + 1):
+        telemetry.start_iteration(i)
+        # Candidates scored in this iteration: the global set, or the trust region around the incumbent
+        cand_X, cand_X_norm, box = test_X, test_X_norm, None
+        cand_traj = test_traj if dedup is not None else None
+        if tr is not None:
+            center = train_X_norm[torch.argmax(train_Y)]
+            lengthscale = gp_surro.covar_module.base_kernel.lengthscale
+            local = tr.candidates(center, tr_candidates, lengthscale, feasible_fn, lower, span, seed=i)
+            if len(local) > 0:
+                cand_X, cand_X_norm = lower + span * local, local.float()
+                cand_traj = dedup.trajectories(cand_X) if dedup is not None else None
+                box = tr.bounds(center, lengthscale)
+            telemetry.set(n_candidates=len(local), **tr.describe())
         # Calculate posterior for analysis for intermidiate iterations
-        y_pred_means, y_pred_vars = cal_posterior(gp_surro, test_X_norm)
-        if ((i - 1) % 5 == 0):
+        with telemetry.phase("posterior"):
+            y_pred_means, y_pred_vars = cal_posterior(gp_surro, cand_X_norm)
+        if plot and ((i - 1) % 5 == 0):
             # Plotting functions to check the current state exploration and Pareto fronts
-            kl_scale_eval, kl_scale_est = plot_iteration_results(train_X, train_Y, test_X, y_pred_means, y_pred_vars,
-                                                                 fix_model, i)
-
-        acq_cand, acq_val, EI_val = acqmanEI(y_pred_means, y_pred_vars, train_Y)
-        val = acq_val
-        ind = np.random.choice(acq_cand)
+            with telemetry.phase("plot"), memory_stage("plotting"):
+                kl_scale_eval, kl_scale_est = plot_iteration_results(train_X, train_Y, cand_X, y_pred_means,
+                                                                     y_pred_vars, fix_model, i)
+
+        with telemetry.phase("acquisition"):
+            acq_cand, acq_val, EI_val = acqmanEI(y_pred_means, y_pred_vars, train_Y)
+            if dedup is not None:
+                # Candidates decoding to an already evaluated trajectory are not acquired again
+                evaluated = dedup.evaluated_mask(cand_traj)
+                EI_val[evaluated] = -np.inf
+                acq_val = np.max(EI_val)
+                acq_cand = list(np.flatnonzero(EI_val == acq_val))
+                telemetry.set(n_masked=int(evaluated.sum()))
+            cost = None
+            if cost_aware:
+                # Expected improvement per second of predicted evaluation time (ei_max then logs EI per cost)
+                cost = predict_cost(gp_cost, cand_X_norm).numpy()
+                EI_val = EI_val / cost
+                acq_val = np.max(EI_val)
+                acq_cand = list(np.flatnonzero(EI_val == acq_val))
+            val = acq_val
+            if q == 1:
+                ind = [np.random.choice(acq_cand)]
+            else:
+                # Batch picked one point at a time with the GP conditioned on the previous picks (kriging believer), away
+                # from the previous picks and the evaluated points
+                ind = kriging_believer(gp_surro, cand_X_norm, y_pred_means, y_pred_vars, train_Y.max(), q,
+                                       np.isfinite(EI_val), cost, train_X_norm)
+                if ind:
+                    val = EI_val[ind[0]]
+            if classifier is not None:
+                # Candidates screened by the classifier: verify the acquired ones with the decoder
+                bad = [k for k, ok in zip(ind, feasible_mask(fix_model, cand_X[ind])) if not ok]
+                while bad:
+                    EI_val[bad] = -np.inf
+                    # Only candidates not rejected (or masked) yet; none left stops the BO (convergence check below)
+                    finite = np.flatnonzero(np.isfinite(EI_val))
+                    if q == 1:
+                        ind = list(finite[np.argsort(-EI_val[finite])][:1])
+                    else:
+                        ind = kriging_believer(gp_surro, cand_X_norm, y_pred_means, y_pred_vars, train_Y.max(), q,
+                                               np.isfinite(EI_val), cost, train_X_norm)
+                    if not ind:
+                        print("No feasible candidate left after decoder verification")
+                        break
+                    val = EI_val[ind[0]]
+                    bad = [k for k, ok in zip(ind, feasible_mask(fix_model, cand_X[ind])) if not ok]
+            if not ind:
+                val = -np.inf
+            elif acq_optimizer == "lbfgs":
+                seeds = list(ind) + [k for k in np.argsort(-EI_val)[:max(acq_starts, q)]
+                                     if k not in ind and np.isfinite(EI_val[k])]
+                # Refined points decoding to an evaluated trajectory fall back to their seed (dedup_tol)
+                reject = None if dedup is None else lambda z: dedup.evaluated_mask(dedup.trajectories(z))
+                x_norm, ei = refine_acquisition(gp_surro, cand_X_norm[seeds], train_Y.max(), constraint_model, lower,
+                                                span, box=box, classifier=classifier,
+                                                cost=cost_function(gp_cost) if cost_aware else None, reject=reject)
+                x_norm = x_norm[torch.isfinite(ei)][:q]
+                val = float(ei[0])
+                nextX_norm = x_norm.float()
+                nextX = (lower + span * x_norm).float()
+            else:
+                nextX = torch.empty((len(ind), len(X)))
+                nextX_norm = torch.empty(len(ind), len(X))
+                nextX[:, :] = cand_X[ind, :]
+                nextX_norm[:, :] = cand_X_norm[ind, :]
+        telemetry.set(ei_max=float(val))
 
         ################################################################
         ## Find next point which maximizes the learning through exploration-exploitation
@@ -607,26 +851,42 @@ def latentBO_KL(X, fix_params, data, fix_model, num_rows, num_start, N):
         # Check for convergence
         if ((val) < 0):  # Stop for negligible expected improvement
             print("Model converged due to sufficient learning over search space ")
+            telemetry.end_iteration()
             break
         else:
-            nextX = torch.empty((1, len(X)))
-            nextX_norm = torch.empty(1, len(X))
-            nextX[0, :] = test_X[ind, :]
-            nextX_norm[0, :] = test_X_norm[ind, :]
-
+            if time_budget_s is not None:
+                # Parallel evaluations of a batch run concurrently: the slowest one sets the end time
+                predicted_s = float(predict_cost(gp_cost, nextX_norm).max())
+                telemetry.set(predicted_cost=predicted_s)
+                if time.perf_counter() - t_start + predicted_s > time_budget_s:
+                    print("Wall-clock budget reached, model stopped")
+                    telemetry.end_iteration()
+                    break
+            best_before = float(train_Y.max())
             # Evaluate true function for new data, augment data
-            train_X, train_X_norm, train_Y, m = augment_newdata_KL(nextX, nextX_norm, train_X, train_X_norm, train_Y,
-                                                                   fix_params, data, fix_model, m)
+            with telemetry.phase("evaluation"):
+                train_X, train_X_norm, train_Y, m = augment_newdata_KL(nextX, nextX_norm, train_X, train_X_norm,
+                                                                       train_Y, fix_params, data, fix_model, m,
+                                                                       executor, obj_kwargs, telemetry, profiler,
+                                                                       objective)
+            if tr is not None:
+                tr.update(best_before, float(train_Y.max()))
+            if dedup is not None:
+                dedup.add(nextX)
 
             # Gp model fit
             # Updating GP with augmented training data
-            gp_surro = optimize_hyperparam_trainGP(train_X_norm, train_Y)
+            with telemetry.phase("gp_fit"):
+                gp_surro = optimize_hyperparam_trainGP(train_X_norm, train_Y)
+                gp_cost = optimize_cost_model(train_X_norm, telemetry.run_s) if track_cost else None
 
             # Saving/Updating data at each iterations
             np.save("train_X.npy", train_X)
             np.save("train_X_norm.npy", train_X_norm)
             np.save("train_Y.npy", train_Y)
             np.save("m.npy", m)
+            telemetry.set(mll=gp_surro.final_mll, n_train=len(train_Y), best=float(train_Y.max()))
+            telemetry.end_iteration()
 
     ## Final posterior prediction after all the sampling done
 
@@ -638,262 +898,324 @@ def latentBO_KL(X, fix_params, data, fix_model, num_rows, num_start, N):
     # Posterior calculation with converged GP model
     y_pred_means, y_pred_vars = cal_posterior(gp_opt, test_X_norm)
     # Plotting functions to check final iteration
-    kl_scale_eval_opt, kl_scale_est_opt = plot_iteration_results(train_X, train_Y, test_X, y_pred_means, y_pred_vars,
-                                                                 fix_model, i)
+    with memory_stage("plotting"):
+        kl_scale_eval_opt, kl_scale_est_opt = plot_iteration_results(train_X, train_Y, test_X, y_pred_means,
+                                                                     y_pred_vars, fix_model, i, plot)
 
     return kl_scale_eval_opt, kl_scale_est_opt, gp_opt, train_X, train_Y
 
 
-"""#Prepare a set of KL trajectories
-Create the set of the possible trajectories. Here, we define trajectories from different functionals in real space.
-With these, we 
-- define the 2D latent space to sample from (i.e. pretrain)
-- draw the point form the space and evaluate the jrVAE model
-- build a BO framework in the reduced 2D latent space for KL factor optimization 
-"""
-
-# Prepare training data to fit trajectory in a VAE model
-
-torch.manual_seed(100)
-num_samples1 = 2500
-num_samples2 = 2500
-num_samples3 = 2500
-# num_samples4 = 2000
-num_traj = 120
-
-#########Sampled trajectories defined from functional 1
-traj_sampled1 = torch.empty((num_samples1, num_traj))
-# Control parameters for defining KL trajectories -defined from functional 1
-X_start = torch.linspace(50, 30, num_samples1)
-X_stop = torch.linspace(5, 1, num_samples1)
-X_coolrate = torch.linspace(80, 1, num_samples1)
-X_timeout = torch.linspace(20, 1, num_samples1)
-
-X = torch.vstack((X_start, X_stop, X_coolrate, X_timeout))
-X = torch.transpose(X, 0, 1)
-# print(X.shape)
-
-for j in range(num_samples1):
-    kl_scale_sampled = torch.cat(
-        [torch.ones(int(np.round(X_timeout[j])), ) * X_start[j],
-         # put pressure on the continuous latent channel at the beginning
-         torch.linspace(X_start[j], X_stop[j], int(np.round(X_coolrate[j])))]  # gradually release the pressure
-    )
-
-    # Consider trajectory of 120 dimensions- defined by 4 variables (4D) in the real space
-    for i in range(num_traj):
-        traj_sampled1[j, i] = kl_scale_sampled[i] if i < len(kl_scale_sampled) else kl_scale_sampled[-1]
-
-print(traj_sampled1.shape)
-
-#########Sampled trajectories defined from functional 2
-traj_sampled2, points, slopes = generate_1Dspectra_Segment(2, num_samples2)
-
-# print(traj_sampled2.shape)
-# Rescaling to similar sample data defined from func 1
-traj_sampled2 = traj_sampled2.detach().numpy()
-
-traj_sampled22 = np.reshape(traj_sampled2, num_samples2 * num_traj)
-# print(traj_sampled2.shape, traj_sampled22.shape)
-
-traj_sampled22_norm = (traj_sampled22 - np.min(traj_sampled22)) / (np.max(traj_sampled22) - np.min(traj_sampled22))
-traj_sampled22_scaled = traj_sampled22_norm * (50 - 1) + 1
-# print(traj_sampled22_scaled.shape, np.min(traj_sampled22_scaled), np.max(traj_sampled22_scaled))
-
-traj_sampled22_scaled = np.reshape(traj_sampled22_scaled, (num_samples2, num_traj))
-traj_sampled22_scaled = torch.from_numpy(traj_sampled22_scaled)
-traj_sampled2 = torch.from_numpy(traj_sampled2)
-# print(traj_sampled22_scaled.shape, traj_sampled2.shape)
-
-####################Sampled trajs defined from functional 3
-params = lambda: {"A": np.random.lognormal(1, 1),
-                  "alpha": np.random.uniform(-2, 2),
-                  "omega": np.random.uniform(8, 14),
-                  "B": np.random.uniform(-1, 1)}
-
-traj_sampled3 = np.zeros((num_samples3, num_traj))
-n_traj3 = np.linspace(0, 2, num_traj)
-for i in range(num_samples3):
-    y = func_periodic(n_traj3, params())
-    y = 2 * ((y - y.min()) / y.ptp()) - 1
-    traj_sampled3[i, :] = y
-# traj_sampled3 = np.array(traj_sampled3, dtype=np.float32)
-print(traj_sampled3.shape)
-# Rescaling to similar sample data defined from func 1
-
-traj_sampled32 = np.reshape(traj_sampled3, num_samples3 * num_traj)
-
-traj_sampled32_norm = (traj_sampled32 - np.min(traj_sampled32)) / (np.max(traj_sampled32) - np.min(traj_sampled32))
-traj_sampled32_scaled = traj_sampled32_norm * (50 - 1) + 1
-# print(traj_sampled32_scaled.shape, np.min(traj_sampled32_scaled), np.max(traj_sampled32_scaled))
-
-traj_sampled32_scaled = np.reshape(traj_sampled32_scaled, (num_samples3, num_traj))
-traj_sampled32_scaled = torch.from_numpy(traj_sampled32_scaled)
-traj_sampled3 = torch.from_numpy(traj_sampled3)
-print(traj_sampled32_scaled.shape, traj_sampled3.shape)
-
-####################### Sampled traj from functional 4
-# traj_sampled4 = torch.normal(0, 1, size=(num_samples4, num_traj))
-# Rescaling to similar sample data defined from func 1
-# traj_sampled4_scaled = traj_sampled4*(50-1) + 1
-# print(traj_sampled4_scaled.shape, torch.min(traj_sampled4_scaled), torch.max(traj_sampled4_scaled))
-
-# Combine data sampled from multiple functionals
-traj_sampled = torch.vstack((traj_sampled1, traj_sampled22_scaled, traj_sampled32_scaled))
-
-print(traj_sampled.shape)
-
-# Plot the training data of sampled trajectories
-num_samples = num_samples1 + num_samples2 + num_samples3
-t = np.linspace(1, 120, 120)
-fig, axes = plt.subplots(
-    10, 10, figsize=(10, 10), subplot_kw={'xticks': [], 'yticks': []},
-    gridspec_kw=dict(hspace=0.1, wspace=0.1))
-
-for ax in axes.flat:
-    i = np.random.randint(0, num_samples
-                          )
-    y_i = traj_sampled[i, :].detach().numpy()
-    ax.plot(t, y_i)
-    # ax.set_ylim (-1.1, 1.1)
-
-plt.savefig('traj_sampled.png')
-
-"""# Train the VAE model with sampled trajectories
--Here we convert the trajectories in a 2D latent space
-"""
+if __name__ == "__main__":
+    """#Prepare a set of KL trajectories
+    Create the set of the possible trajectories. Here, we define trajectories from different functionals in real space.
+    With these, we 
+    - define the 2D latent space to sample from (i.e. pretrain)
+    - draw the point form the space and evaluate the jrVAE model
+    - build a BO framework in the reduced 2D latent space for KL factor optimization 
+    """
 
-traj_sampled = traj_sampled.float()
-train_loader_traj = pv.utils.init_dataloader(traj_sampled.unsqueeze(1), batch_size=64)
-
-# set the dimension of the spectra
-in_dim = (num_traj,)
-
-# Initialize invariant VAE
-vae_traj = pv.models.iVAE(in_dim, latent_dim=2, invariances=None,
-                          sampler_d="gaussian", decoder_sig=.3, sigmoid_d=False,
-                          seed=0)
-
-# Initialize SVI trainer
-trainer_traj = pv.trainers.SVItrainer(vae_traj, lr=1e-4)
-
-# Train for n epochs:
-for e in range(2000):
-    trainer_traj.step(train_loader_traj)
-    trainer_traj.print_statistics()
-
-"""View the learned latent manifold:"""
-
-vae_traj.manifold2d(d=10)
-plt.savefig('vae_traj.manifold2d.png')
-
-"""Encode the training data into the latent space:"""
-
-train_data = train_loader_traj.dataset.tensors[0]
-# train_data = traj_sampled
-z_mean_traj, z_sd_traj = vae_traj.encode(train_data)
-print(z_mean_traj.shape, z_sd_traj.shape)
-plt.figure(figsize=(6, 6))
-plt.scatter(z_mean_traj[:, -2], z_mean_traj[:, -1], s=10, alpha=0.15)
-plt.xlabel("$z_1$", fontsize=14)
-plt.ylabel("$z_2$", fontsize=14)
-plt.savefig('TD_Latentspace.png')
-# plt.show()
-
-"""- Lets divide the latent space into feasible and infeasible region"""
-
-z1_traj = np.linspace(torch.min(z_mean_traj[:, -2]), torch.max(z_mean_traj[:, -2]), 100)
-z2_traj = np.linspace(torch.min(z_mean_traj[:, -1]), torch.max(z_mean_traj[:, -1]), 100)
-z1_traj, z2_traj = np.meshgrid(z1_traj, z2_traj)
-decoded_traj_feas = np.zeros((100, 100))
-z = torch.empty((1, 2))
-m = 1
-for t1, (x1, x2) in enumerate(zip(z1_traj, z2_traj)):
-    for t2, (xx1, xx2) in enumerate(zip(x1, x2)):
-        # print("Evaluation # " +str(m))
-        m = m + 1
-        z[0, 0] = xx1
-        z[0, 1] = xx2
-        decoded_traj = vae_traj.decode(z).numpy()
-        if (np.min(decoded_traj) > 0):
-            decoded_traj_feas[t1, t2] = 1  # 1 denotes feasible
+    # High-water mark of the memory per pipeline stage, printed and written to the run log
+    memory_log = "memory.jsonl"
+    memory_tracker = install_memory_tracker(MemoryTracker(memory_log, use_tracemalloc=False))
+
+    # Prepare training data to fit trajectory in a VAE model
+
+    # Search space of the BO: "latent" (2D latent space of the pretrained trajectory VAE) or "parametric" (the
+    # 4 cool-down parameters start, stop, cool rate and time-out, see latentbo_parametric.py; no vae_traj
+    # pretraining and no feasibility scan). Can also be set with LATENTBO_SEARCH_SPACE=parametric
+    search_space = os.environ.get("LATENTBO_SEARCH_SPACE", "latent")
+    # Latent model of the "latent" search space: "vae" (pretrained iVAE), "pca" or "spline" (closed-form principal
+    # components of the trajectories or of their B-spline fit, see latentbo_pca.py). Also LATENTBO_TRAJ_BACKEND
+    traj_backend = os.environ.get("LATENTBO_TRAJ_BACKEND", "vae")
+    # Positivity-enforcing output transform of the latent model, e.g. {"transform": "exp", "low": 0.5, "high": 60}
+    # (latentbo_positive.py): every latent point decodes to a feasible trajectory, which skips the feasibility scan
+    # and keeps the whole candidate grid (None: decoder output used as is)
+    traj_positive = None
+    # Dimension of the trajectory latent space. Beyond 2 the candidate grid (num_rows ** traj_latent_dim points) is
+    # replaced by a Sobol sample of candidate_budget points, and the 2D manifold and feasibility plots are skipped
+    traj_latent_dim = 2
+    num_traj = 120
+
+    if search_space == "latent":
+        memory_begin("trajectory_generation")
+        # Seed both generators so that the trajectories (and thus the pretrained vae_traj) are reproducible
+        torch.manual_seed(100)
+        np.random.seed(100)
+        num_samples1 = 2500
+        num_samples2 = 2500
+        num_samples3 = 2500
+        # num_samples4 = 2000
+
+        # Functional 1: cool-down trajectories defined by 4 variables (start, stop, cool rate, time-out) in the real space
+        # Functional 2: random piecewise-linear trajectories, functional 3: periodic ones, both rescaled to [1, 50]
+        # Combine data sampled from multiple functionals
+        traj_sampled = trajectory_library((num_samples1, num_samples2, num_samples3), num_traj)
+
+        print(traj_sampled.shape)
+        memory_end("trajectory_generation")
+
+        # Plot the training data of sampled trajectories
+        num_samples = num_samples1 + num_samples2 + num_samples3
+        t = np.linspace(1, 120, 120)
+        fig, axes = plt.subplots(
+            10, 10, figsize=(10, 10), subplot_kw={'xticks': [], 'yticks': []},
+            gridspec_kw=dict(hspace=0.1, wspace=0.1))
+
+        for ax in axes.flat:
+            i = np.random.randint(0, num_samples
+                                  )
+            y_i = traj_sampled[i, :].detach().numpy()
+            ax.plot(t, y_i)
+            # ax.set_ylim (-1.1, 1.1)
+
+        plt.savefig('traj_sampled.png')
+
+        """# Train the VAE model with sampled trajectories
+        -Here we convert the trajectories in a 2D latent space
+        """
+
+        memory_begin("vae_traj_training")
+        traj_sampled = traj_sampled.float()
+        train_loader_traj = pv.utils.init_dataloader(traj_sampled.unsqueeze(1), batch_size=64)
+
+        # set the dimension of the spectra
+        in_dim = (num_traj,)
+
+        # Invariant VAE trained with SVI; reloaded from artifacts/ when a run with the same generator and
+        # training configuration already trained it, resumed from its checkpoint if interrupted.
+        # 2000 epochs over all the trajectories in batches of 64
+        traj_config = {"num_traj": num_traj, "num_samples": [num_samples1, num_samples2, num_samples3], "seed": 100,
+                       "latent_dim": traj_latent_dim, "decoder_sig": .3, "lr": 1e-4, "batch_size": 64, "epochs": 2000}
+        # Set to e.g. {"batch_size": 256, "warmup_epochs": 20, "holdout": 0.1, "eval_every": 10, "patience": 10} to
+        # train in batches of 256 with the learning rate scaled up after a 20-epoch warmup, stopping once the ELBO of
+        # 10% held-out trajectories has not improved for 10 evaluations (changes the learned latent space)
+        traj_schedule = None
+        if traj_schedule is not None:
+            traj_config.update(traj_schedule)
+        # Set to e.g. {"samples_per_epoch": 7500} to train on fresh trajectories of the functionals drawn every epoch
+        # by traj_workers DataLoader workers (traj_sampled then only sets the latent bounds)
+        traj_stream = None
+        traj_workers = 0
+        if traj_stream is not None:
+            traj_config["stream"] = traj_stream
+        if traj_backend == "vae":
+            if traj_positive is not None:
+                traj_config["output"] = traj_positive
+            vae_traj, traj_meta = pretrain_trajectory_vae(traj_sampled, traj_config, print_every=50,
+                                                          num_workers=traj_workers)
+        elif traj_positive is not None:
+            vae_traj = PositiveTrajectoryModel(LinearTrajectoryModel(num_traj, latent_dim=traj_latent_dim, basis=traj_backend),
+                                               **traj_positive).fit(traj_sampled)
         else:
-            decoded_traj_feas[t1, t2] = 0  # 0 denotes infeasible
-
-print(decoded_traj_feas.shape)
-print(np.sum(decoded_traj_feas))
-
-# Plot the latent space and check feasible region
-plt.figure()
-plt.imshow(decoded_traj_feas, origin="lower")
-a1 = (z_mean_traj[:, -2] - torch.min(z_mean_traj[:, -2])) / (
-            torch.max(z_mean_traj[:, -2]) - torch.min(z_mean_traj[:, -2]))
-a2 = (z_mean_traj[:, -1] - torch.min(z_mean_traj[:, -1])) / (
-            torch.max(z_mean_traj[:, -1]) - torch.min(z_mean_traj[:, -1]))
-b1 = a1 * (99 - 1) + 1
-b2 = a2 * (99 - 1) + 1
-plt.scatter(b1, b2, s=2, alpha=0.15)
-plt.savefig('TD_Latentspace_feasible.png')
-
-"""#Now we start Analysis- Graphene problem
-- KL trajectory optimization using BO over the 2D latent space which decodes sample trajectory into real space.
-- We run the BO with subset of data. This is to reduce the cost of function evaluation (Expensive) during BO since the VAE model cost increases with data size. We assume the optimal trajectory should not be dependent to the data size, given the data originates from same black-box model (Graphene data)
-Get training data and create a dataloader object
-Create a stack of submimages centered around a portion of the identified lattice atoms:
-- Here we considered 600 images and window size 70 to build training data
-- Added impurities
-Add impurities
-"""
+            # Closed-form linear latent model (principal components), fitted in seconds
+            vae_traj = LinearTrajectoryModel(num_traj, latent_dim=traj_latent_dim, basis=traj_backend).fit(traj_sampled)
+        # Weights of the trajectory decoder, needed to replay the campaign offline (latentbo_replay.py)
+        vae_traj.save_weights("vae_traj")
+        memory_end("vae_traj_training")
+
+        """View the learned latent manifold:"""
+
+        if traj_latent_dim == 2:
+            vae_traj.manifold2d(d=10)
+            plt.savefig('vae_traj.manifold2d.png')
+
+        """Encode the training data into the latent space:"""
+
+        train_data = train_loader_traj.dataset.tensors[0]
+        # train_data = traj_sampled
+        z_mean_traj, z_sd_traj = vae_traj.encode(train_data)
+        print(z_mean_traj.shape, z_sd_traj.shape)
+        plt.figure(figsize=(6, 6))
+        plt.scatter(z_mean_traj[:, -2], z_mean_traj[:, -1], s=10, alpha=0.15)
+        plt.xlabel("$z_1$", fontsize=14)
+        plt.ylabel("$z_2$", fontsize=14)
+        plt.savefig('TD_Latentspace.png')
+        # plt.show()
+
+        # A decoder with a positive output transform is feasible everywhere, no feasibility map needed
+        if traj_positive is None and traj_latent_dim == 2:
+            """- Lets divide the latent space into feasible and infeasible region"""
+
+            memory_begin("feasibility_scan")
+            z1_traj = np.linspace(torch.min(z_mean_traj[:, -2]), torch.max(z_mean_traj[:, -2]), 100)
+            z2_traj = np.linspace(torch.min(z_mean_traj[:, -1]), torch.max(z_mean_traj[:, -1]), 100)
+            # Quadtree refinement: only the cells along the feasibility boundary are decoded at full resolution.
+            # Rows of the map follow z2 and columns z1 (imshow layout)
+            feas_mask, n_decoded = quadtree_feasible(vae_traj, torch.from_numpy(np.vstack((z1_traj, z2_traj))))
+            decoded_traj_feas = feas_mask.numpy().T.astype(float)
+            print("Feasibility map: " + str(n_decoded) + " decoded latent points")
+            print(decoded_traj_feas.shape)
+            print(np.sum(decoded_traj_feas))
+            memory_end("feasibility_scan")
+
+            # Plot the latent space and check feasible region
+            plt.figure()
+            plt.imshow(decoded_traj_feas, origin="lower")
+            a1 = (z_mean_traj[:, -2] - torch.min(z_mean_traj[:, -2])) / (
+                        torch.max(z_mean_traj[:, -2]) - torch.min(z_mean_traj[:, -2]))
+            a2 = (z_mean_traj[:, -1] - torch.min(z_mean_traj[:, -1])) / (
+                        torch.max(z_mean_traj[:, -1]) - torch.min(z_mean_traj[:, -1]))
+            b1 = a1 * (99 - 1) + 1
+            b2 = a2 * (99 - 1) + 1
+            plt.scatter(b1, b2, s=2, alpha=0.15)
+            plt.savefig('TD_Latentspace_feasible.png')
+
+    """#Now we start Analysis- Graphene problem
+    - KL trajectory optimization using BO over the 2D latent space which decodes sample trajectory into real space.
+    - We run the BO with subset of data. This is to reduce the cost of function evaluation (Expensive) during BO since the VAE model cost increases with data size. We assume the optimal trajectory should not be dependent to the data size, given the data originates from same black-box model (Graphene data)
+    Get training data and create a dataloader object
+    Create a stack of submimages centered around a portion of the identified lattice atoms:
+    - Here we considered 600 images and window size 70 to build training data
+    - Added impurities
+    Add impurities
+    """
+
+    # !pip install -U gdown
+    # !gdown "https://drive.google.com/uc?id=1mpecY83LV0sqDbsCzvGgBw4XUhSkiTqZ"
+    # gdown https://drive.google.com/uc?id=14o8Yb7mPyBhPrU14ymlr4j5pVCUYJUpq
+
+    train_data = np.load("train_data_imp.npy")
+    # print(train_data.shape)
+    train_data = torch.from_numpy(train_data)
+    print(train_data.shape)
+    train_data = train_data.float()
+
+    fig, axes = plt.subplots(10, 10, figsize=(8, 8),
+                             subplot_kw={'xticks': [], 'yticks': []},
+                             gridspec_kw=dict(hspace=0.1, wspace=0.1))
+
+    for ax, im in zip(axes.flat, train_data):
+        ax.imshow(im.squeeze(), cmap='viridis', interpolation='nearest')
+
+    plt.savefig('TD_graphene.png')
+    plt.show()
 
-# !pip install -U gdown
-# !gdown "https://drive.google.com/uc?id=1mpecY83LV0sqDbsCzvGgBw4XUhSkiTqZ"
-# gdown https://drive.google.com/uc?id=14o8Yb7mPyBhPrU14ymlr4j5pVCUYJUpq
-
-train_data = np.load("train_data_imp.npy")
-# print(train_data.shape)
-train_data = torch.from_numpy(train_data)
-print(train_data.shape)
-train_data = train_data.float()
-
-fig, axes = plt.subplots(10, 10, figsize=(8, 8),
-                         subplot_kw={'xticks': [], 'yticks': []},
-                         gridspec_kw=dict(hspace=0.1, wspace=0.1))
-
-for ax, im in zip(axes.flat, train_data):
-    ax.imshow(im.squeeze(), cmap='viridis', interpolation='nearest')
-
-plt.savefig('TD_graphene.png')
-plt.show()
-
-"""#KL optimization using constrained BO over 2D latent space"""
-print("Start optimization")
-batch_size = 10
-B = 12  # grid size for manifold2D
-# Data dim size
-H = 70
-W = 70
-# Initialize # of discrete class
-discrete_dim = 10  # We dont have any prior knowledge with the actual # of discrete class of defects, we initialize arbitarily and changes which seems best fit with learning (classification) with VAE model
-#kl_d = 3
-#Initialize for BO
-num_rows =100
-num_start = 20  # Starting samples
-N= 120
-
-#latent parameters for defining KL trajectories
-z1_traj = torch.linspace(torch.min(z_mean_traj[:, -2]), torch.max(z_mean_traj[:, -2]), num_rows)
-z2_traj = torch.linspace(torch.min(z_mean_traj[:, -1]), torch.max(z_mean_traj[:, -1]), num_rows)
-
-Z= torch.vstack((z1_traj, z2_traj))
-#print(Z.shape[1])
-#Fixed parameters of VAE model
-fix_params = [batch_size, B, H, W, discrete_dim]
-latent_model = vae_traj
-#train_data_ss = train_data_ss.float()
-#Z_feas = getfeasible(Z, latent_model)
-kl_cont_eval_opt, kl_cont_est_opt, gp_opt, train_X, train_Y = latentBO_KL(Z, fix_params, train_data, latent_model, num_rows, num_start, N)
-
-np.save("kl_cont_eval_opt.npy", kl_cont_eval_opt)
-np.save("kl_cont_est_opt.npy", kl_cont_est_opt)
-np.save("train_X_final.npy", train_X)
-np.save("train_Y_final.npy", train_Y)
\ No newline at end of file
+    """#KL optimization using constrained BO over 2D latent space"""
+    print("Start optimization")
+    batch_size = 10  # None: use the batch size of the machine profile (see latentbo_autotune.py)
+    B = 12  # grid size for manifold2D
+    # Data dim size
+    H = 70
+    W = 70
+    # Initialize # of discrete class
+    discrete_dim = 10  # We dont have any prior knowledge with the actual # of discrete class of defects, we initialize arbitarily and changes which seems best fit with learning (classification) with VAE model
+    #kl_d = 3
+    #Initialize for BO
+    num_rows =100
+    num_rows_param = 10  # grid values per parameter of the parametric search space (10 ** 4 candidates)
+    candidate_budget = num_rows ** 2  # candidates of the BO whatever the dimension of the search space
+    # Candidates of the latent search space: "grid" (box of the encoded trajectories), or candidate_budget points near
+    # them, "kde" (kernel density sample) or "knn" (box points within k-nearest-neighbour reach), latentbo_candidates.py
+    candidate_mode = "grid"
+    # Candidates whose decoded KL trajectories agree within dedup_tol at every step count as one, and the ones
+    # within dedup_tol of evaluated trajectories are not acquired again, e.g. 0.05 (None: off)
+    dedup_tol = None
+    # Cost-aware acquisition (expected improvement per predicted second of evaluation) and a wall-clock budget of
+    # the BO campaign in seconds, e.g. 48 * 3600 (None: run the N iterations)
+    cost_aware = False
+    time_budget_s = None
+    # Feasibility check of the candidates: "scan" (decode all), "quadtree" (2D: refine along the boundary only) or
+    # "classifier" (learned from a decoded sample, for large candidate sets, latent_dim > 2 or acq_optimizer="lbfgs")
+    feasibility = "scan"
+    num_start = 20  # Starting samples
+    N= 120
+    # Concurrent objective evaluations (1 = sequential, None: machine profile). Each worker gets a disjoint core set.
+    n_workers = 1
+    threads = None  # torch threads per worker (None: machine profile, or measured by select_layout)
+    thread_policy = "auto"  # "spread" (many workers x 1 thread), "packed" (few workers x many threads) or "auto" (measured)
+    pin_cpus = False
+    q = 1  # candidates acquired per BO iteration (None: one per evaluation worker); batch acquisition is opt-in
+    # Acquisition maximizer: "grid" (best of the num_rows grid) or "lbfgs" (best grid cells refined by multi-start
+    # L-BFGS-B over the latent box, which gives sharper optima than a finer grid; a coarser num_rows then suffices)
+    acq_optimizer = "grid"
+    # Trust-region mode: every iteration scores tr_candidates points of a box around the best evaluated point that
+    # grows on improvement and shrinks otherwise, instead of the whole candidate grid (latentbo_trust_region.py)
+    trust_region = False
+    tr_candidates = 2000
+    ssim_chunk = None  # class-manifold pairs per ssim call in loss_obj (None: machine profile, or one call per pair)
+    phase_log = "loss_obj_phases.jsonl"  # per-phase timings of every loss_obj call (None: timers off)
+    bo_log = "bo_telemetry.jsonl"  # time breakdown and ETA of every BO iteration (None: off)
+    # Deep profile (torch.profiler Chrome trace + cProfile pstats) of this function evaluation, e.g. 25 (None: off).
+    # Can also be set without editing the script: LATENTBO_PROFILE_EVAL=25
+    profile_eval = os.environ.get("LATENTBO_PROFILE_EVAL")
+    profile_eval = int(profile_eval) if profile_eval else None
+    # Replay table for offline strategy comparisons (latentbo_replay.py): loss_obj recorded on every
+    # replay_stride-th feasible candidate before the BO starts, e.g. "replay_table.npz" (None: off)
+    replay_table = None
+    replay_stride = 10
+
+    # Settings tuned for this machine by latentbo_autotune.py fill in the ones left as None above
+    machine_profile = load_machine_profile("graphene")
+    if machine_profile is not None:
+        if ssim_chunk is None:
+            ssim_chunk = machine_profile["ssim_chunk"]
+        if batch_size is None:
+            batch_size = machine_profile["batch_size"]
+    if batch_size is None:
+        batch_size = 10
+    if n_workers is None and machine_profile is not None:
+        # Worker/thread layout calibrated at the batch size of this run; batch sizes that were not calibrated get
+        # their layout measured by select_layout below, with at most the workers of the profile
+        layout = profile_layout(machine_profile, batch_size)
+        n_workers = machine_profile["n_workers"] if layout is None else layout[0]
+        if threads is None and layout is not None:
+            threads = layout[1]
+    if n_workers is None:
+        n_workers = 1
+
+    if search_space == "latent":
+        #latent parameters for defining KL trajectories: num_rows values per latent coordinate
+        Z = latent_box_grid(z_mean_traj, num_rows)
+        latent_model = vae_traj
+        Z_candidates = None
+        if candidate_mode != "grid":
+            Z_candidates = density_candidates(z_mean_traj, candidate_budget, candidate_mode)
+    else:
+        # Grid of num_rows_param values per cool-down parameter (num_rows_param ** 4 candidates, all feasible)
+        latent_model = ParametricTrajectorySpace(num_traj)
+        num_rows = num_rows_param
+        Z = latent_model.grid(num_rows)
+        Z_candidates = None
+    #print(Z.shape[1])
+    #Fixed parameters of VAE model
+    fix_params = [batch_size, B, H, W, discrete_dim]
+    #train_data_ss = train_data_ss.float()
+    #Z_feas = getfeasible(Z, latent_model)
+    obj_kwargs = {"ssim_chunk": ssim_chunk, "phase_log": phase_log}
+    executor = None
+    if n_workers > 1:
+        workers = n_workers
+        if threads is None:
+            # Probe the layouts with a short training burst (2 epochs) of a constant trajectory
+            probe_traj = np.ones(num_traj, dtype=np.float32)
+            workers, threads = select_layout(loss_obj, (train_data, batch_size, B, H, W, discrete_dim), probe_traj,
+                                             policy=thread_policy, kwargs=dict(obj_kwargs, num_epochs=2),
+                                             max_workers=n_workers, pin_cpus=pin_cpus)
+        print("Evaluation executor: " + str(workers) + " workers x " + str(threads) + " threads")
+        executor = EvaluationExecutor(loss_obj, (train_data, batch_size, B, H, W, discrete_dim), obj_kwargs,
+                                      n_workers=workers, threads_per_worker=threads, pin_cpus=pin_cpus)
+    if q is None:
+        q = 1 if executor is None else executor.n_workers
+    if replay_table is not None:
+        Z_feasible = getfeasible(Z, latent_model, candidate_budget, feasibility, Z_candidates)
+        record_table(Z_feasible[::replay_stride], fix_params, train_data, latent_model, replay_table, Z=Z,
+                     executor=executor, obj_kwargs=obj_kwargs)
+    kl_cont_eval_opt, kl_cont_est_opt, gp_opt, train_X, train_Y = latentBO_KL(Z, fix_params, train_data, latent_model, num_rows, num_start, N,
+                                                                              executor=executor, q=q, obj_kwargs=obj_kwargs,
+                                                                              bo_log=bo_log, profile_eval=profile_eval,
+                                                                              candidate_budget=candidate_budget,
+                                                                              acq_optimizer=acq_optimizer,
+                                                                              trust_region=trust_region,
+                                                                              tr_candidates=tr_candidates,
+                                                                              feasibility=feasibility,
+                                                                              candidates=Z_candidates,
+                                                                              dedup_tol=dedup_tol, cost_aware=cost_aware,
+                                                                              time_budget_s=time_budget_s)
+    if executor is not None:
+        executor.shutdown()
+
+    np.save("kl_cont_eval_opt.npy", kl_cont_eval_opt)
+    np.save("kl_cont_est_opt.npy", kl_cont_est_opt)
+    np.save("train_X_final.npy", train_X)
+    np.save("train_Y_final.npy", train_Y)
+    memory_tracker.report()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Continuous optimization of the acquisition over the latent box
+
+latentBO_KL picks the next point among the scored candidate grid, so the acquired point is only as
+sharp as the grid spacing and a finer grid costs num_rows ** d posterior evaluations. With
+acq_optimizer="lbfgs" the best grid cells only seed a multi-start L-BFGS-B run over the normalized
+box [0, 1]^d: the expected improvement (same expression as acqmanEI) is differentiated through the GP
+posterior, and infeasible regions are avoided with a differentiable penalty on the negative parts of
+the decoded trajectory. Refined points are kept only when they are feasible (checked with the real
+decoder) and improve on their seed, so the result is never worse than the grid.
+
+kriging_believer() picks a batch of q candidates one at a time: after each pick the GP is conditioned
+on its posterior mean at that point, which leaves the means unchanged and shrinks the variance around
+it. With a strong noise floor that shrinkage is small, so candidates within about one candidate spacing
+of a pick or of an evaluated point are excluded as well: the batch never spends two evaluations on
+neighbouring cells of the same optimum or on a point that was already evaluated.
+"""
+
+import numpy as np
+import torch
+from scipy.optimize import minimize
+from scipy.stats import norm
+
+from latentbo_candidates import feasible_mask
+
+ACQ_OPTIMIZERS = ("grid", "lbfgs")
+
+
+def expected_improvement(gp_surro, X_norm, best_value, eta=0.001):
+    """EI of acqmanEI at the normalized points X_norm (n, d), differentiable w.r.t. X_norm"""
+    # Same dtype as the training inputs (and the prediction caches filled by cal_posterior)
+    posterior = gp_surro.posterior(X_norm.to(gp_surro.train_inputs[0].dtype))
+    mean = posterior.mean.reshape(-1).double()
+    var = posterior.variance.reshape(-1).double().clamp_min(1e-12)
+    improvement = mean - float(best_value) - eta
+    # acqmanEI scales the improvement by the posterior variance; keep the grid and the refinement consistent
+    u = improvement / var
+    normal = torch.distributions.Normal(torch.zeros_like(u), torch.ones_like(u))
+    return improvement * normal.cdf(u) + var * torch.exp(normal.log_prob(u))
+
+
+def kriging_believer(gp_surro, X_norm, means, variances, best_value, q, mask=None, cost=None, evaluated=None,
+                     radius=None, eta=0.001):
+    """Indices of q candidates of X_norm (n, d) picked one at a time by the EI of acqmanEI, the GP conditioned on the
+    posterior mean (means, variances: from cal_posterior) at every previous pick.
+
+    Args:
+        mask: boolean (n,) of the candidates that may be picked (None: all).
+        cost: predicted cost (n,) dividing the EI (cost-aware acquisition, None: plain EI).
+        evaluated: normalized evaluated points (m, d); candidates within radius of them are not picked.
+        radius: normalized distance within which candidates around the picks and the evaluated points are excluded
+            (None: 1.5 times the spacing of n points spread over the unit box, n ** (-1 / d), i.e. the neighbouring
+            cells of a grid).
+    Returns:
+        list of at most q indices, fewer when the allowed candidates run out.
+    """
+    means = np.asarray(torch.as_tensor(means).detach(), dtype=np.float64).reshape(-1)
+    var = np.asarray(torch.as_tensor(variances).detach(), dtype=np.float64).reshape(-1).copy()
+    allowed = np.ones(len(means), dtype=bool) if mask is None else np.array(mask, dtype=bool)
+    best = float(best_value)
+    with torch.no_grad():
+        train_X = gp_surro.train_inputs[0].double()
+        X = torch.as_tensor(X_norm).double()
+        if radius is None:
+            radius = 1.5 * len(X) ** (-1.0 / X.shape[1])
+        if evaluated is not None and len(evaluated):
+            evaluated = torch.as_tensor(evaluated).double()
+            allowed &= np.concatenate([(torch.cdist(X[start:start + 4096], evaluated).min(1)[0] > radius).numpy()
+                                       for start in range(0, len(X), 4096)])
+        noise = float(gp_surro.likelihood.noise)
+        K = gp_surro.covar_module(train_X).to_dense() + noise * torch.eye(len(train_X), dtype=torch.float64)
+        L = torch.linalg.cholesky(K)
+        # Posterior cross-covariances: k(x, p) - A[:, x] . A[:, p], with A = L^-1 k(train_X, X)
+        A = torch.linalg.solve_triangular(L, gp_surro.covar_module(train_X, X).to_dense(), upper=False)
+        picks, updates = [], []
+        while len(picks) < q:
+            improvement = means - best - eta
+            with np.errstate(divide="ignore", invalid="ignore"):
+                u = improvement / var
+                ei = np.where(var > 0, improvement * norm.cdf(u) + var * norm.pdf(u), 0.0)
+            if cost is not None:
+                ei = ei / cost
+            ei[~allowed] = -np.inf
+            p = int(np.argmax(ei))
+            if not np.isfinite(ei[p]):
+                break
+            picks.append(p)
+            allowed &= (torch.norm(X - X[p], dim=1) > radius).numpy()
+            # Condition on a noisy observation at p: rank-one update of the variances (sequential conditioning)
+            col = (gp_surro.covar_module(X, X[p:p + 1]).to_dense()[:, 0] - A.T @ A[:, p]).numpy()
+            for prev, v in updates:
+                col = col - prev * prev[p] / v
+            v = var[p] + noise
+            var = np.maximum(var - col ** 2 / v, 0.0)
+            updates.append((col, v))
+            best = max(best, means[p])
+    return picks
+
+
+def differentiable_decoder(fix_model):
+    """Decoder of the latent model that keeps the autograd graph (pyroved's decode() runs under no_grad)"""
+    decoder = getattr(fix_model, "decoder", None)
+    if isinstance(decoder, torch.nn.Module) and not getattr(fix_model, "invariances", None):
+        return lambda z: decoder(z.float())
+    return fix_model.decode
+
+
+def refine_acquisition(gp_surro, seeds_norm, best_value, fix_model=None, lower=None, span=None, penalty=10.0,
+                       maxiter=50, eta=0.001, box=None, classifier=None, cost=None, reject=None):
+    """Multi-start L-BFGS-B maximization of the EI from the normalized seed points (n, d).
+
+    Args:
+        fix_model: decoder whose negative outputs are penalized (None: every point of the box is feasible).
+        lower, span: map from the normalized box to the latent space, z = lower + span * x.
+        penalty: weight of the summed negative decoded values, relative to the best EI of the seeds.
+        box: (low, high) normalized bounds of the search, e.g. a trust region (None: [0, 1]^d).
+        classifier: FeasibilityClassifier (latentbo_feasibility) whose probability below 1/2 is penalized instead
+            of the decoded values; the decoder then only verifies the refined points.
+        cost: differentiable predicted evaluation cost of normalized points (n, d) -> (n,); the refinement then
+            maximizes the EI per unit cost, like the cost-aware grid acquisition (None: plain EI).
+        reject: boolean mask of the latent points (n, d) that must not be acquired, e.g. the ones decoding to an
+            evaluated trajectory (TrajectoryDeduplicator); rejected refinements fall back to their seed, and rejected
+            seeds get an EI of -inf.
+    Returns:
+        (x_norm (n, d), EI (n,)), sorted by decreasing EI; a seed is kept where its refinement is worse,
+        infeasible, rejected or duplicates the refinement of a better start.
+    """
+    seeds = torch.as_tensor(seeds_norm, dtype=torch.float64)
+
+    def acquisition(X):
+        ei = expected_improvement(gp_surro, X, best_value, eta)
+        return ei if cost is None else ei / cost(X)
+
+    with torch.no_grad():
+        seed_ei = acquisition(seeds)
+    decode = None if fix_model is None or classifier is not None else differentiable_decoder(fix_model)
+    scale = max(float(seed_ei.max()), 1e-12)
+
+    def negative_acquisition(x):
+        X = torch.from_numpy(x).reshape(seeds.shape).requires_grad_(True)
+        value = acquisition(X)
+        if classifier is not None:
+            value = value - penalty * scale * torch.relu(0.5 - classifier.predict_proba(lower + span * X))
+        elif decode is not None:
+            traj = decode(lower + span * X).reshape(len(X), -1)
+            value = value - penalty * scale * torch.relu(-traj).sum(-1)
+        loss = -value.sum()
+        grad, = torch.autograd.grad(loss, X)
+        return loss.item(), grad.numpy().ravel()
+
+    # The starts are independent: one L-BFGS-B run over their concatenation
+    low, high = (torch.zeros(seeds.shape[1]), torch.ones(seeds.shape[1])) if box is None else box
+    bounds = list(zip(low.tolist(), high.tolist())) * len(seeds)
+    result = minimize(negative_acquisition, seeds.numpy().ravel(), jac=True, method="L-BFGS-B", bounds=bounds,
+                      options={"maxiter": maxiter})
+    x = torch.from_numpy(result.x).reshape(seeds.shape).clamp(0, 1)
+    with torch.no_grad():
+        ei = acquisition(x)
+    keep = ei > seed_ei
+    if fix_model is not None:
+        keep &= feasible_mask(fix_model, lower + span * x)
+    if reject is not None:
+        keep &= ~torch.as_tensor(reject(lower + span * x))
+    x = torch.where(keep[:, None], x, seeds)
+    ei = torch.where(keep, ei, seed_ei)
+    if reject is not None:
+        ei[~keep & torch.as_tensor(reject(lower + span * seeds))] = -float("inf")
+    # Starts that converged to the point of a better start fall back to their seed (distinct grid cells for q > 1)
+    ranked = torch.argsort(ei, descending=True).tolist()
+    for j, k in enumerate(ranked):
+        if keep[k] and any(torch.all(torch.abs(x[k] - x[b]) < 1e-6) for b in ranked[:j]):
+            x[k], ei[k] = seeds[k], seed_ei[k]
+    order = torch.argsort(ei, descending=True)
+    return x[order], ei[order].detach()
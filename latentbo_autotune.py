@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Calibrate objective-evaluation throughput on the current machine
+
+The fastest combination of jiVAE batch size, torch threads, number of concurrent workers and SSIM
+chunk size for loss_obj differs between nodes (e.g. 16 vs 128 cores). This command runs short timed
+jiVAE training bursts at the real dataset shape, searches that space and writes the winner to the
+machine profile, together with the best worker/thread layout of every calibrated batch size. The
+graphene driver fills its unset settings from the profile; the plasmonic scripts evaluate
+sequentially, their profile sets the parallel layout of `latentbo_estimate.py --problem plasmonic`.
+
+Usage:
+    python latentbo_autotune.py --problem graphene                        # 70x70, discrete_dim=10
+    python latentbo_autotune.py --problem plasmonic --data train_plas.npy  # 96x96, discrete_dim=7
+
+Without --data, random images of the problem shape are used (the timings only depend on the shape).
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import pyroved as pv
+
+from latentbo_parallel import (available_cores, candidate_layouts, machine_id, measure_throughput,
+                               save_machine_profile)
+
+# Dataset shape and manifold settings of the BO problems
+PROBLEMS = {
+    "graphene": {"H": 70, "W": 70, "discrete_dim": 10, "B": 12, "n_images": 600, "num_traj": 120},
+    "plasmonic": {"H": 96, "W": 96, "discrete_dim": 7, "B": 12, "n_images": 1400, "num_traj": 200},
+}
+
+
+def load_problem_data(problem, path=None, n_images=None):
+    """Training images of shape (n, 1, H, W): loaded from `path` or random images of the problem shape"""
+    cfg = PROBLEMS[problem]
+    n_images = n_images or cfg["n_images"]
+    if path is None:
+        return torch.rand(n_images, 1, cfg["H"], cfg["W"])
+    data = torch.from_numpy(np.load(path)).float()
+    data = torch.reshape(data, (data.shape[0], 1, cfg["H"], cfg["W"]))
+    return data[:n_images]
+
+
+def time_ssim_chunks(problem, chunks, repeats=3):
+    """Best-of-`repeats` wall time of the inter-manifold SSIM for each chunk size"""
+    from graphene_latentbo_jrvae_gpurun import collect_manifolds, inter_manifold_loss
+    cfg = PROBLEMS[problem]
+    jvae = pv.models.jiVAE((cfg["H"], cfg["W"]), latent_dim=2, discrete_dim=cfg["discrete_dim"],
+                           invariances=['r'], seed=42)
+    M = collect_manifolds(jvae, cfg["B"], cfg["H"], cfg["W"], cfg["discrete_dim"])
+    timings = {}
+    for chunk in chunks:
+        best = np.inf
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            inter_manifold_loss(M, cfg["discrete_dim"], chunk)
+            best = min(best, time.perf_counter() - t0)
+        timings[chunk] = best
+    return timings
+
+
+def calibrate(problem, data, batch_sizes=(10, 32, 64), chunks=(None, 5, 15, 45), burst_epochs=3,
+              max_threads=8, max_workers=None, pin_cpus=False, verbose=True):
+    """Search batch size x (workers, threads) layout x SSIM chunk size for the highest evaluation throughput.
+
+    The chunk size is searched first (it does not interact with the training), then every batch size is
+    timed on every worker/thread layout with a loss_obj burst of `burst_epochs` epochs.
+    Returns the settings dict stored in the machine profile: the fastest batch size with its layout, and the
+    fastest layout of every batch size ("layouts"), since a run at another batch size needs the layout measured at it.
+    """
+    from graphene_latentbo_jrvae_gpurun import loss_obj
+    cfg = PROBLEMS[problem]
+    n_cores = len(available_cores())
+
+    chunk_times = time_ssim_chunks(problem, chunks)
+    ssim_chunk = min(chunk_times, key=chunk_times.get)
+    if verbose:
+        for chunk, t in chunk_times.items():
+            print("ssim_chunk {}: {:.4f} s".format(chunk, t))
+
+    probe_traj = np.ones(cfg["num_traj"], dtype=np.float32)
+    trials = []
+    for batch_size in batch_sizes:
+        args = (data, batch_size, cfg["B"], cfg["H"], cfg["W"], cfg["discrete_dim"])
+        for (w, t) in candidate_layouts(n_cores, "auto", max_threads):
+            w = max(1, w if max_workers is None else min(w, max_workers))
+            rate = measure_throughput(loss_obj, args, probe_traj, w, t, pin_cpus=pin_cpus,
+                                      kwargs={"num_epochs": burst_epochs, "ssim_chunk": ssim_chunk})
+            trials.append({"batch_size": batch_size, "n_workers": w, "threads_per_worker": t,
+                           "evals_per_s": rate})
+            if verbose:
+                print("batch_size {}, {} workers x {} threads: {:.4f} bursts/s".format(batch_size, w, t, rate))
+
+    layouts = {}
+    for trial in trials:
+        key = str(trial["batch_size"])
+        if key not in layouts or trial["evals_per_s"] > layouts[key]["evals_per_s"]:
+            layouts[key] = {k: trial[k] for k in ("n_workers", "threads_per_worker", "evals_per_s")}
+    best = max(trials, key=lambda trial: trial["evals_per_s"])
+    settings = dict(best)
+    settings["layouts"] = layouts
+    settings.update({"ssim_chunk": ssim_chunk, "burst_epochs": burst_epochs, "n_images": len(data),
+                     "shape": [cfg["H"], cfg["W"]], "discrete_dim": cfg["discrete_dim"],
+                     "calibrated": time.strftime("%Y-%m-%d %H:%M:%S"), "trials": trials,
+                     "ssim_chunk_times": {str(k): v for k, v in chunk_times.items()}})
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--problem", choices=sorted(PROBLEMS), default="graphene")
+    parser.add_argument("--data", default=None, help="npy file with the training images (default: random images)")
+    parser.add_argument("--n-images", type=int, default=None, help="number of training images to use")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[10, 32, 64])
+    parser.add_argument("--chunks", type=int, nargs="+", default=[5, 15, 45],
+                        help="SSIM chunk sizes to try (the unchunked loop is always tried)")
+    parser.add_argument("--burst-epochs", type=int, default=3)
+    parser.add_argument("--max-threads", type=int, default=8, help="largest torch thread count per worker")
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--pin-cpus", action="store_true")
+    parser.add_argument("--out", default=None, help="machine profile path (default: machine_profile.json)")
+    args = parser.parse_args()
+
+    data = load_problem_data(args.problem, args.data, args.n_images)
+    print("Calibrating " + args.problem + " " + str(tuple(data.shape)) + " on " + str(machine_id()))
+    settings = calibrate(args.problem, data, args.batch_sizes, [None] + args.chunks, args.burst_epochs,
+                         args.max_threads, args.max_workers, args.pin_cpus)
+    path = save_machine_profile(args.problem, settings, args.out)
+    print("Best: batch_size {batch_size}, {n_workers} workers x {threads_per_worker} threads, "
+          "ssim_chunk {ssim_chunk}".format(**settings))
+    print("Machine profile written to " + path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks of the objective and surrogate hot paths
+
+Every benchmark runs on synthetic tensors at production shapes (graphene 70x70, discrete_dim=10, B=12;
+plasmonic 96x96, discrete_dim=7, B=12) with untrained models, so no data or training is needed:
+- ssim_loss, manifold collection (manifold2d per class), inter- and intra-class SSIM loops of loss_obj
+- getfeasible on the trajectory decoder
+- optimize_hyperparam_trainGP, cal_posterior and acqmanEI for 20-500 training points
+
+The report (median/min wall time per benchmark) is written as JSON. Compare it against a stored
+baseline to flag regressions (exit code 1 when a benchmark got slower than the tolerance):
+    python latentbo_benchmarks.py --save-baseline            # on the reference commit
+    python latentbo_benchmarks.py                            # after a change, compares to the baseline
+    python latentbo_benchmarks.py --filter "trainGP|posterior" --repeats 3
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import pyroved as pv
+
+from latentbo_autotune import PROBLEMS
+from latentbo_parallel import machine_id
+
+BENCHMARK_REPORT = "benchmark_report.json"
+BENCHMARK_BASELINE = "benchmark_baseline.json"
+
+# Training-set sizes of the surrogate benchmarks and the candidate grid (num_rows x num_rows) of the driver
+GP_SIZES = (20, 50, 100, 200, 500)
+NUM_ROWS = 100
+
+
+def time_call(fn, repeats=5, warmup=1):
+    """Median, min and standard deviation of the wall time of fn() over `repeats` calls"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {"median_s": float(np.median(times)), "min_s": float(np.min(times)), "std_s": float(np.std(times)),
+            "repeats": repeats}
+
+
+def _objective_cases(problem):
+    from graphene_latentbo_jrvae_gpurun import collect_manifolds, inter_manifold_loss, intra_manifold_loss, ssim_loss
+    cfg = PROBLEMS[problem]
+    H, W, B, d = cfg["H"], cfg["W"], cfg["B"], cfg["discrete_dim"]
+    torch.manual_seed(0)
+    img1, img2 = torch.rand(1, 1, H, W), torch.rand(1, 1, H, W)
+    jvae = pv.models.jiVAE((H, W), latent_dim=2, discrete_dim=d, invariances=['r'], seed=42)
+    M = collect_manifolds(jvae, B, H, W, d)
+    return [
+        ("ssim_loss/" + problem, lambda: ssim_loss(img1, img2, 5)),
+        ("collect_manifolds/" + problem, lambda: collect_manifolds(jvae, B, H, W, d)),
+        ("inter_manifold_loss/" + problem, lambda: inter_manifold_loss(M, d)),
+        ("inter_manifold_loss_chunk15/" + problem, lambda: inter_manifold_loss(M, d, 15)),
+        ("intra_manifold_loss/" + problem, lambda: intra_manifold_loss(M, B, d)),
+    ]
+
+
+def _feasibility_cases(num_traj=120, num_rows=NUM_ROWS):
+    from graphene_latentbo_jrvae_gpurun import getfeasible
+    vae_traj = pv.models.iVAE((num_traj,), latent_dim=2, invariances=None, sampler_d="gaussian", decoder_sig=.3,
+                              sigmoid_d=False, seed=0)
+    X = torch.vstack((torch.linspace(-2, 2, num_rows), torch.linspace(-2, 2, num_rows)))
+    return [("getfeasible/grid{}".format(num_rows), lambda: getfeasible(X, vae_traj))]
+
+
+def _surrogate_cases(sizes=GP_SIZES, num_rows=NUM_ROWS):
+    from graphene_latentbo_jrvae_gpurun import acqmanEI, cal_posterior, optimize_hyperparam_trainGP
+    g = torch.linspace(0, 1, num_rows, dtype=torch.float64)
+    test_X = torch.cartesian_prod(g, g)
+    cases = []
+    for n in sizes:
+        rng = np.random.RandomState(n)
+        train_X = torch.from_numpy(rng.rand(n, 2))
+        # Smooth objective with the magnitude of the SSIM-based loss
+        train_Y = (0.1 * torch.sin(6 * train_X[:, :1]) * torch.cos(4 * train_X[:, 1:])).double()
+        gp_surro = optimize_hyperparam_trainGP(train_X, train_Y)
+        y_pred_means, y_pred_vars = cal_posterior(gp_surro, test_X)
+        cases.extend([
+            ("optimize_hyperparam_trainGP/n{}".format(n),
+             lambda train_X=train_X, train_Y=train_Y: optimize_hyperparam_trainGP(train_X, train_Y)),
+            ("cal_posterior/n{}".format(n), lambda gp_surro=gp_surro: cal_posterior(gp_surro, test_X)),
+            ("acqmanEI/n{}".format(n), lambda m=y_pred_means, v=y_pred_vars, Y=train_Y: acqmanEI(m, v, Y)),
+        ])
+    return cases
+
+
+def _groups(problems, sizes):
+    # (benchmark names, set-up returning [(name, fn)]); the set-up of a group (model construction, GP
+    # fits) is skipped when none of its benchmarks is selected
+    groups = []
+    for problem in problems:
+        names = [name + "/" + problem for name in ("ssim_loss", "collect_manifolds", "inter_manifold_loss",
+                                                   "inter_manifold_loss_chunk15", "intra_manifold_loss")]
+        groups.append((names, lambda problem=problem: _objective_cases(problem)))
+    groups.append((["getfeasible/grid{}".format(NUM_ROWS)], _feasibility_cases))
+    names = [name.format(n) for n in sizes
+             for name in ("optimize_hyperparam_trainGP/n{}", "cal_posterior/n{}", "acqmanEI/n{}")]
+    groups.append((names, lambda: _surrogate_cases(sizes)))
+    return groups
+
+
+def run_benchmarks(problems=("graphene", "plasmonic"), pattern=None, repeats=5, sizes=GP_SIZES, verbose=True):
+    """Time every benchmark whose name matches `pattern` (regex), returns the report dict"""
+    selected = lambda name: pattern is None or re.search(pattern, name) is not None
+    results = OrderedDict()
+    for names, set_up in _groups(problems, sizes):
+        if not any(selected(name) for name in names):
+            continue
+        for name, fn in set_up():
+            if not selected(name):
+                continue
+            results[name] = time_call(fn, repeats)
+            if verbose:
+                print("{:<40s} median {:10.5f} s  min {:10.5f} s".format(
+                    name, results[name]["median_s"], results[name]["min_s"]))
+    report = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "torch": torch.__version__,
+              "threads": torch.get_num_threads(), "results": results}
+    report.update(machine_id())
+    return report
+
+
+def compare_reports(report, baseline, tolerance=0.25):
+    """Benchmarks whose median time exceeds the baseline median by more than `tolerance` (relative)
+
+    Returns a list of (name, baseline median, current median, ratio), slowest first.
+    """
+    regressions = []
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["median_s"] / base["median_s"]
+        if ratio > 1 + tolerance:
+            regressions.append((name, base["median_s"], result["median_s"], ratio))
+    return sorted(regressions, key=lambda r: -r[3])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--problem", nargs="+", choices=sorted(PROBLEMS), default=["graphene", "plasmonic"])
+    parser.add_argument("--filter", default=None, help="regex selecting the benchmarks to run")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(GP_SIZES), help="GP training-set sizes")
+    parser.add_argument("--out", default=BENCHMARK_REPORT)
+    parser.add_argument("--baseline", default=BENCHMARK_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slow-down")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.problem, args.filter, args.repeats, args.sizes)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Report written to " + args.out)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Baseline written to " + args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline " + args.baseline + " to compare to (create it with --save-baseline)")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if {k: baseline.get(k) for k in ("host", "n_cores")} != machine_id():
+        print("Warning: baseline " + args.baseline + " was recorded on another machine")
+    regressions = compare_reports(report, baseline, args.tolerance)
+    for name, base, current, ratio in regressions:
+        print("REGRESSION {:<40s} {:10.5f} s -> {:10.5f} s (x{:.2f})".format(name, base, current, ratio))
+    if not regressions:
+        print("No regressions against " + args.baseline + " (tolerance {:.0%})".format(args.tolerance))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Candidate sets of the latent BO for any latent dimension
+
+The candidate set of latentBO_KL is the full grid spanned by the rows of X (one row of values per
+latent coordinate), i.e. num_rows ** latent_dim points, filtered by the feasibility of the decoded
+trajectories. That is fine in 2D but explodes beyond. With a candidate budget, the full grid is used
+only while it fits the budget; otherwise a scrambled Sobol sample of `budget` points of the same box
+is drawn, so the candidate count (and the cost of the posterior and feasibility passes) stays fixed
+whatever the latent dimension. Feasibility is checked by decoding the candidates in chunks, or, for a 2D
+grid, by quadtree refinement (quadtree_feasible): coarse cells are decoded at their corners and only
+the cells whose corners disagree are subdivided, so the decoder calls follow the length of the
+feasibility boundary instead of the area of the grid.
+
+density_candidates() concentrates the candidates on the encoded training trajectories instead of
+their bounding box, where the decoder has seen data: a sample of their kernel density ("kde") or the
+Sobol points of the box within the k-nearest-neighbour reach of the cloud ("knn").
+
+TrajectoryDeduplicator compares decoded trajectories by their max-abs distance over the steps:
+latentBO_KL keeps a candidate only if its trajectory is farther than `tol` from every candidate kept
+before it (greedy radius clustering), and masks the candidates within `tol` of an evaluated trajectory
+from the acquisition.
+"""
+
+import numpy as np
+import torch
+
+FEASIBILITY_CHUNK = 4096
+DENSITY_MODES = ("kde", "knn")
+
+
+def candidate_set(X, budget=None, seed=0):
+    """Candidates (n, d) in the box spanned by the rows of X (d, num_rows).
+
+    The full grid (in the order of the nested loops of getfeasible) when budget is None or the grid has at most
+    `budget` points, a scrambled Sobol sample of `budget` points otherwise.
+    """
+    X = torch.as_tensor(X, dtype=torch.float64)
+    if budget is None or X.shape[1] ** X.shape[0] <= budget:
+        return torch.cartesian_prod(*X).reshape(-1, X.shape[0])
+    low, high = torch.min(X, 1)[0], torch.max(X, 1)[0]
+    sobol = torch.quasirandom.SobolEngine(X.shape[0], scramble=True, seed=seed)
+    return low + (high - low) * sobol.draw(budget, dtype=torch.float64)
+
+
+def feasible_mask(fix_model, candidates, chunk=FEASIBILITY_CHUNK):
+    """Boolean mask of the candidates whose decoded trajectory is positive everywhere (vectorized)"""
+    mask = np.zeros(len(candidates), dtype=bool)
+    for start in range(0, len(candidates), chunk):
+        decoded = fix_model.decode(candidates[start:start + chunk].float())
+        decoded = np.reshape(torch.as_tensor(decoded).detach().numpy(), (len(decoded), -1))
+        mask[start:start + chunk] = np.min(decoded, axis=1) > 0
+    return torch.from_numpy(mask)
+
+
+def quadtree_feasible(fix_model, X, base=8, chunk=FEASIBILITY_CHUNK):
+    """Feasibility mask (num_rows, num_rows) of the 2D grid X (2, num_rows), indexed like the nested loops of
+    getfeasible, and the number of decoded grid points.
+
+    The grid is split into base x base cells; cells whose four corners agree are filled with their value, the
+    others are halved along each axis until they are one grid step wide. Infeasible (or feasible) islands that fit
+    inside a coarse cell without touching its corners are missed; a larger `base` narrows the cells.
+    """
+    X = torch.as_tensor(X, dtype=torch.float64)
+    n = X.shape[1]
+    value = np.full((n, n), -1, dtype=np.int8)  # decoded feasibility of the grid points, -1: not decoded
+    n_decoded = 0
+
+    def decode(nodes):
+        nonlocal n_decoded
+        nodes = np.unique(np.asarray(nodes).reshape(-1, 2), axis=0)
+        nodes = nodes[value[nodes[:, 0], nodes[:, 1]] < 0]
+        if len(nodes):
+            z = torch.stack((X[0, nodes[:, 0]], X[1, nodes[:, 1]]), 1)
+            value[nodes[:, 0], nodes[:, 1]] = feasible_mask(fix_model, z, chunk).numpy()
+            n_decoded += len(nodes)
+
+    edges = np.unique(np.round(np.linspace(0, n - 1, base + 1)).astype(int))
+    spans = list(zip(edges[:-1], edges[1:]))
+    cells = [(i0, i1, j0, j1) for i0, i1 in spans for j0, j1 in spans]
+    mask = np.zeros((n, n), dtype=bool)
+    while cells:
+        # One batched decode per level: the corners of all cells of the level
+        decode([(i, j) for i0, i1, j0, j1 in cells for i in (i0, i1) for j in (j0, j1)])
+        children = []
+        for i0, i1, j0, j1 in cells:
+            corners = value[[i0, i0, i1, i1], [j0, j1, j0, j1]]
+            if corners.min() == corners.max():
+                mask[i0:i1 + 1, j0:j1 + 1] = corners[0] == 1
+            else:
+                halves_i = [(i0, (i0 + i1) // 2), ((i0 + i1) // 2, i1)] if i1 - i0 > 1 else [(i0, i1)]
+                halves_j = [(j0, (j0 + j1) // 2), ((j0 + j1) // 2, j1)] if j1 - j0 > 1 else [(j0, j1)]
+                if len(halves_i) + len(halves_j) > 2:
+                    children += [(a, b, c, d) for a, b in halves_i for c, d in halves_j]
+        cells = children
+    decoded = value >= 0
+    mask[decoded] = value[decoded] == 1
+    return torch.from_numpy(mask), n_decoded
+
+
+def kth_neighbour_distance(queries, points, k, exclude_self=False, chunk=2048):
+    """Distance (n,) of every query to its k-th nearest point (the query itself skipped with exclude_self)"""
+    out = []
+    for start in range(0, len(queries), chunk):
+        dist = torch.cdist(queries[start:start + chunk], points)
+        out.append(torch.topk(dist, k + int(exclude_self), dim=1, largest=False)[0][:, -1])
+    return torch.cat(out)
+
+
+def density_candidates(z_mean, budget, mode="knn", k=10, quantile=0.95, seed=0):
+    """At most `budget` candidates (n, d) near the encoded trajectories z_mean (N, d).
+
+    kde: Gaussian kernel density sample (Scott bandwidth per coordinate), clipped to the box of z_mean.
+    knn: Sobol points of the box whose distance to their k-th nearest encoded point (coordinates scaled by their
+         std) is within the `quantile` of that distance among the encoded points themselves.
+    """
+    if mode not in DENSITY_MODES:
+        raise ValueError("Unknown density candidate mode: {}".format(mode))
+    z_mean = torch.as_tensor(z_mean, dtype=torch.float64).detach()
+    low, high = torch.min(z_mean, 0)[0], torch.max(z_mean, 0)[0]
+    std = torch.std(z_mean, 0)
+    if mode == "kde":
+        generator = torch.Generator().manual_seed(seed)
+        bandwidth = std * len(z_mean) ** (-1.0 / (z_mean.shape[1] + 4))
+        centers = z_mean[torch.randint(len(z_mean), (budget,), generator=generator)]
+        noise = torch.randn(centers.shape, generator=generator, dtype=torch.float64)
+        return torch.minimum(torch.maximum(centers + bandwidth * noise, low), high)
+    reach = torch.quantile(kth_neighbour_distance(z_mean / std, z_mean / std, k, exclude_self=True), quantile)
+    sobol = torch.quasirandom.SobolEngine(z_mean.shape[1], scramble=True, seed=seed)
+    # Oversample the box, keep the points within reach in Sobol order (a uniform prefix of the region)
+    points = low + (high - low) * sobol.draw(8 * budget, dtype=torch.float64)
+    inside = kth_neighbour_distance(points / std, z_mean / std, k) <= reach
+    return points[inside][:budget]
+
+
+class TrajectoryDeduplicator:
+    """Equivalence of latent points whose decoded trajectories differ by at most `tol` at every step (max-abs
+    distance; 0: identical trajectories)"""
+
+    def __init__(self, fix_model, tol, chunk=FEASIBILITY_CHUNK):
+        self.fix_model, self.tol, self.chunk = fix_model, tol, chunk
+        self.evaluated = None
+
+    def trajectories(self, z):
+        """Decoded trajectories (n, steps) of the latent points z (n, d)"""
+        decoded = []
+        for start in range(0, len(z), self.chunk):
+            traj = self.fix_model.decode(torch.as_tensor(z[start:start + self.chunk]).float())
+            decoded.append(torch.as_tensor(traj).detach().double().reshape(len(traj), -1))
+        return torch.cat(decoded)
+
+    def _near(self, traj, reference):
+        """Boolean mask of the trajectories within tol of any reference trajectory"""
+        if reference is None or len(reference) == 0:
+            return np.zeros(len(traj), dtype=bool)
+        return np.concatenate([
+            (torch.cdist(traj[start:start + self.chunk], reference, p=float("inf")).min(1)[0] <= self.tol).numpy()
+            for start in range(0, len(traj), self.chunk)])
+
+    def unique(self, z, block=256):
+        """Indices (in order) of the kept points of z and the trajectories of z.
+
+        Greedy radius clustering: a point is kept unless its trajectory is within tol of a trajectory kept before it.
+        """
+        traj = self.trajectories(z)
+        kept = []
+        for start in range(0, len(traj), block):
+            # Drop the block points near the points kept so far, then scan the rest of the block in order
+            candidates = np.flatnonzero(~self._near(traj[start:start + block], traj[kept])) + start
+            new = []
+            for k in candidates:
+                if not new or torch.max(torch.abs(traj[new] - traj[k]), 1)[0].min() > self.tol:
+                    new.append(k)
+            kept += new
+        return torch.tensor(kept, dtype=torch.long), traj
+
+    def add(self, z):
+        """Register evaluated latent points"""
+        traj = self.trajectories(z)
+        self.evaluated = traj if self.evaluated is None else torch.cat((self.evaluated, traj))
+
+    def evaluated_mask(self, traj):
+        """Boolean mask of the trajectories (n, steps) within tol of an evaluated one"""
+        return self._near(traj, self.evaluated)
+
+
+def latent_box_grid(z_mean, num_rows):
+    """Grid rows (latent_dim, num_rows) spanning the encoded trajectories z_mean (n, latent_dim)"""
+    return torch.vstack([torch.linspace(torch.min(z_mean[:, k]), torch.max(z_mean[:, k]), num_rows)
+                         for k in range(z_mean.shape[1])])
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""Dry-run cost estimate of a BO campaign before launching it
+
+Times a short loss_obj burst (a few jiVAE epochs plus one full scoring pass: manifold2d and the
+inter-/intra-class SSIM) at the real shapes, and the BO machinery (GP fit, posterior over the
+candidate grid, EI) at the training-set sizes of the campaign, then extrapolates the total wall time
+and peak memory for sequential and parallel execution:
+    python latentbo_estimate.py --problem graphene --N 120 --num-start 20 --epochs 200 --n-workers 4
+    python latentbo_estimate.py --problem plasmonic --n-images 35000 --batch-size 64 --budget-hours 168
+
+The exit code is 2 when the campaign does not fit into the available memory or the time budget, or when
+the worker layout oversubscribes the cores.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from latentbo_autotune import PROBLEMS
+from latentbo_parallel import available_cores, load_machine_profile, profile_layout
+from latentbo_profiling import MemoryTracker, rss_bytes
+from latentbo_telemetry import format_duration, read_jsonl
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_MB = 1024.0 ** 2
+
+
+def available_memory_bytes():
+    """Memory available for new allocations (psutil, /proc/meminfo, or None when unknown)"""
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def time_evaluation(data, batch_size, B, H, W, discrete_dim, burst_epochs=2, threads=None, ssim_chunk=None,
+                    num_traj=120):
+    """Per-phase times of one loss_obj burst and the peak RSS of the process during it.
+
+    Returns (fixed_s, epoch_s, scoring_s, peak_rss_bytes): set-up time, mean time per epoch and time of the
+    scoring pass (manifold2d + SSIM).
+    """
+    from graphene_latentbo_jrvae_gpurun import loss_obj
+    n_threads = torch.get_num_threads()
+    if threads is not None:
+        torch.set_num_threads(threads)
+    tracker = MemoryTracker(verbose=False)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            phase_log = os.path.join(tmp, "phases.jsonl")
+            probe_traj = np.ones(num_traj, dtype=np.float32)
+            with tracker.stage("loss_obj"):
+                loss_obj(probe_traj, data, batch_size, B, H, W, discrete_dim, num_epochs=burst_epochs,
+                         ssim_chunk=ssim_chunk, phase_log=phase_log)
+            phases = read_jsonl(phase_log)[0]["phases"]
+    finally:
+        torch.set_num_threads(n_threads)
+    total = lambda *names: sum(phases[name]["total_s"] for name in names if name in phases)
+    # The first epoch includes one-off warm-up costs
+    steps = phases["epoch"]["steps_s"]
+    epoch_s = float(np.mean(steps[1:] if len(steps) > 1 else steps))
+    return (total("dataloader", "model_init"), epoch_s, total("manifold2d", "ssim_inter", "ssim_intra"),
+            tracker.summary["loss_obj"]["rss_peak_mb"] * _MB)
+
+
+def time_bo_iteration(n_train, n_candidates, n_posterior=400):
+    """Wall time of one BO iteration (GP fit, posterior over n_candidates, EI) at n_train training points.
+
+    The posterior is timed on n_posterior candidates and scaled, it is computed point by point.
+    """
+    from graphene_latentbo_jrvae_gpurun import acqmanEI, cal_posterior, optimize_hyperparam_trainGP
+    rng = np.random.RandomState(0)
+    train_X = torch.from_numpy(rng.rand(n_train, 2))
+    train_Y = (0.1 * torch.sin(6 * train_X[:, :1]) * torch.cos(4 * train_X[:, 1:])).double()
+    t0 = time.perf_counter()
+    gp_surro = optimize_hyperparam_trainGP(train_X, train_Y)
+    gp_s = time.perf_counter() - t0
+    test_X = torch.from_numpy(rng.rand(min(n_posterior, n_candidates), 2))
+    t0 = time.perf_counter()
+    y_pred_means, y_pred_vars = cal_posterior(gp_surro, test_X)
+    posterior_s = (time.perf_counter() - t0) * n_candidates / len(test_X)
+    t0 = time.perf_counter()
+    acqmanEI(y_pred_means, y_pred_vars, train_Y)
+    ei_s = (time.perf_counter() - t0) * n_candidates / len(test_X)
+    return gp_s + posterior_s + ei_s
+
+
+def estimate_campaign(problem="graphene", N=120, num_start=20, num_epochs=120, batch_size=10, n_images=None,
+                      H=None, W=None, discrete_dim=None, B=None, num_rows=100, feasible_fraction=1.0, q=None,
+                      n_workers=None, threads_per_worker=None, burst_epochs=2, ssim_chunk=None, verbose=True):
+    """Extrapolated wall time and peak memory of a campaign, sequential and with n_workers concurrent evaluations"""
+    cfg = dict(PROBLEMS[problem])
+    for key, value in (("n_images", n_images), ("H", H), ("W", W), ("discrete_dim", discrete_dim), ("B", B)):
+        if value is not None:
+            cfg[key] = value
+    n_cores = len(available_cores())
+    if n_workers is None:
+        # Layout calibrated at this batch size (latentbo_autotune.py)
+        profile = load_machine_profile(problem, verbose=False)
+        layout = profile_layout(profile, batch_size) if profile is not None else None
+        n_workers = layout[0] if layout is not None else max(1, n_cores // 8)
+        threads_per_worker = threads_per_worker or (layout[1] if layout is not None else None)
+    threads_per_worker = threads_per_worker or max(1, n_cores // n_workers)
+    q = q or n_workers
+
+    data = torch.rand(cfg["n_images"], 1, cfg["H"], cfg["W"])
+    shape = (data, batch_size, cfg["B"], cfg["H"], cfg["W"], cfg["discrete_dim"])
+    rss_base = rss_bytes()
+    if verbose:
+        print("Timing a {}-epoch loss_obj burst on {} ...".format(burst_epochs, tuple(data.shape)))
+    fixed_s, epoch_s, scoring_s, eval_peak = time_evaluation(*shape, burst_epochs=burst_epochs,
+                                                             ssim_chunk=ssim_chunk, num_traj=cfg["num_traj"])
+    eval_s = fixed_s + num_epochs * epoch_s + scoring_s
+    if threads_per_worker == torch.get_num_threads():
+        eval_s_par = eval_s
+    else:
+        f, e, s, _ = time_evaluation(*shape, burst_epochs=burst_epochs, threads=threads_per_worker,
+                                     ssim_chunk=ssim_chunk, num_traj=cfg["num_traj"])
+        eval_s_par = f + num_epochs * e + s
+
+    n_candidates = max(1, int(num_rows ** 2 * feasible_fraction))
+    if verbose:
+        print("Timing the BO machinery on {} candidates ...".format(n_candidates))
+    bo_start = time_bo_iteration(num_start, n_candidates)
+    bo_s = {}
+    for label, q_ in (("sequential", 1), ("parallel", q)):
+        bo_end = time_bo_iteration(num_start + N * q_, n_candidates)
+        bo_s[label] = 0.5 * (bo_start + bo_end)
+
+    sequential_s = (num_start + N) * eval_s + N * bo_s["sequential"]
+    parallel_s = (math.ceil(num_start / n_workers) + N * math.ceil(q / n_workers)) * eval_s_par + N * bo_s["parallel"]
+
+    # Every worker process holds its own copy of the data and of the jiVAE training (eval_peak includes rss_base)
+    sequential_peak = eval_peak
+    parallel_peak = rss_base + n_workers * (eval_peak - rss_base)
+    available = available_memory_bytes()
+    rss_now = rss_bytes()
+    return OrderedDict([
+        ("problem", problem), ("config", OrderedDict([
+            ("N", N), ("num_start", num_start), ("num_epochs", num_epochs), ("batch_size", batch_size),
+            ("n_images", cfg["n_images"]), ("shape", [cfg["H"], cfg["W"]]), ("discrete_dim", cfg["discrete_dim"]),
+            ("B", cfg["B"]), ("num_rows", num_rows), ("n_candidates", n_candidates), ("q", q),
+            ("n_workers", n_workers), ("threads_per_worker", threads_per_worker), ("n_cores", n_cores)])),
+        ("eval_setup_s", fixed_s), ("epoch_s", epoch_s), ("scoring_s", scoring_s), ("eval_s", eval_s),
+        ("eval_s_parallel", eval_s_par), ("bo_iteration_s", bo_s),
+        ("sequential", OrderedDict([("n_evals", num_start + N), ("wall_s", sequential_s),
+                                    ("peak_rss_mb", sequential_peak / _MB)])),
+        ("parallel", OrderedDict([("n_evals", num_start + N * q), ("wall_s", parallel_s),
+                                  ("peak_rss_mb", parallel_peak / _MB)])),
+        ("available_mb", None if available is None else (available + rss_now) / _MB),
+    ])
+
+
+def check_estimate(estimate, budget_hours=None):
+    """Problems of a campaign estimate (oversubscribed cores, memory larger than available, wall time over budget)"""
+    problems = []
+    cfg = estimate["config"]
+    if cfg["n_workers"] * cfg["threads_per_worker"] > cfg["n_cores"]:
+        problems.append("parallel: {} workers x {} threads oversubscribe the {} cores".format(
+            cfg["n_workers"], cfg["threads_per_worker"], cfg["n_cores"]))
+    for mode in ("sequential", "parallel"):
+        e = estimate[mode]
+        if estimate["available_mb"] is not None and e["peak_rss_mb"] > estimate["available_mb"]:
+            problems.append("{}: peak memory {:.0f} MB exceeds the {:.0f} MB available".format(
+                mode, e["peak_rss_mb"], estimate["available_mb"]))
+        if budget_hours is not None and e["wall_s"] > 3600 * budget_hours:
+            problems.append("{}: wall time {} exceeds the budget of {} h".format(
+                mode, format_duration(e["wall_s"]), budget_hours))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--problem", choices=sorted(PROBLEMS), default="graphene")
+    parser.add_argument("--N", type=int, default=120)
+    parser.add_argument("--num-start", type=int, default=20)
+    parser.add_argument("--epochs", type=int, default=120, help="jiVAE epochs per evaluation")
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--n-images", type=int, default=None, help="training images (default: problem preset)")
+    parser.add_argument("--H", type=int, default=None)
+    parser.add_argument("--W", type=int, default=None)
+    parser.add_argument("--discrete-dim", type=int, default=None)
+    parser.add_argument("--B", type=int, default=None, help="manifold grid size")
+    parser.add_argument("--num-rows", type=int, default=100, help="candidate grid is num_rows x num_rows")
+    parser.add_argument("--feasible-fraction", type=float, default=1.0, help="share of feasible candidates")
+    parser.add_argument("--q", type=int, default=None, help="candidates per BO iteration (default: n_workers)")
+    parser.add_argument("--n-workers", type=int, default=None, help="concurrent evaluations (default: profile)")
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--burst-epochs", type=int, default=2)
+    parser.add_argument("--ssim-chunk", type=int, default=None)
+    parser.add_argument("--budget-hours", type=float, default=None)
+    parser.add_argument("--out", default=None, help="write the estimate as JSON")
+    args = parser.parse_args(argv)
+
+    estimate = estimate_campaign(args.problem, args.N, args.num_start, args.epochs, args.batch_size, args.n_images,
+                                 args.H, args.W, args.discrete_dim, args.B, args.num_rows, args.feasible_fraction,
+                                 args.q, args.n_workers, args.threads_per_worker, args.burst_epochs, args.ssim_chunk)
+    print("One evaluation: {:.1f} s set-up + {} epochs x {:.2f} s + {:.1f} s scoring = {}".format(
+        estimate["eval_setup_s"], args.epochs, estimate["epoch_s"], estimate["scoring_s"],
+        format_duration(estimate["eval_s"])))
+    cfg = estimate["config"]
+    for mode, label in (("sequential", "sequential"),
+                        ("parallel", "{} workers x {} threads, q={}".format(cfg["n_workers"],
+                                                                           cfg["threads_per_worker"], cfg["q"]))):
+        e = estimate[mode]
+        print("{:<32s} {:4d} evaluations, wall time {:>12s}, peak memory {:.0f} MB".format(
+            label, e["n_evals"], format_duration(e["wall_s"]), e["peak_rss_mb"]))
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(estimate, f, indent=2)
+    problems = check_estimate(estimate, args.budget_hours)
+    for problem in problems:
+        print("WARNING " + problem)
+    return 2 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
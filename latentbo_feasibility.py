@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Learned feasibility classifier of the latent space
+
+getfeasible, the trust region and the L-BFGS refinement check min(decoded trajectory) > 0 by calling
+the decoder on every point. FeasibilityClassifier learns that label from one batched decode of a
+Sobol sample of the latent box (a small MLP, trained in about a second), after which screening costs
+a fraction of a microsecond per point. Only the points the classifier is unsure about (probability
+inside `band`) are verified with the decoder; latentBO_KL also verifies the acquired candidates
+before evaluating them, and the L-BFGS refinement penalizes low feasibility probability instead of
+differentiating through the decoder.
+"""
+
+import torch
+
+from latentbo_candidates import feasible_mask
+
+
+class FeasibilityClassifier:
+    """MLP estimate of P(feasible | z) on the latent box [low, high].
+
+    Args:
+        hidden: width of the two hidden layers.
+        band: probabilities (lo, hi) between which screen() asks the decoder.
+    """
+
+    def __init__(self, hidden=32, epochs=500, lr=1e-2, band=(0.05, 0.95), seed=0):
+        self.hidden, self.epochs, self.lr, self.band, self.seed = hidden, epochs, lr, band, seed
+        self.net = None
+        self.low = self.high = None
+
+    def fit(self, fix_model, low, high, n=2000):
+        """Train on n Sobol points of the box labelled by the decoder; returns self"""
+        self.low = torch.as_tensor(low, dtype=torch.float64)
+        self.high = torch.as_tensor(high, dtype=torch.float64)
+        dim = len(self.low)
+        sobol = torch.quasirandom.SobolEngine(dim, scramble=True, seed=self.seed)
+        z = self.low + (self.high - self.low) * sobol.draw(n, dtype=torch.float64)
+        labels = feasible_mask(fix_model, z).float()
+        # Keep the global torch RNG (seeded by the drivers) untouched by the weight initialization
+        with torch.random.fork_rng():
+            torch.manual_seed(self.seed)
+            self.net = torch.nn.Sequential(torch.nn.Linear(dim, self.hidden), torch.nn.Tanh(),
+                                           torch.nn.Linear(self.hidden, self.hidden), torch.nn.Tanh(),
+                                           torch.nn.Linear(self.hidden, 1)).double()
+        optimizer = torch.optim.Adam(self.net.parameters(), lr=self.lr)
+        x = self._scale(z)
+        for _ in range(self.epochs):
+            optimizer.zero_grad()
+            loss = torch.nn.functional.binary_cross_entropy_with_logits(self.net(x).reshape(-1), labels.double())
+            loss.backward()
+            optimizer.step()
+        self.train_accuracy = float(((self.predict_proba(z) > 0.5) == labels.bool()).float().mean())
+        self.feasible_fraction = float(labels.mean())
+        return self
+
+    def _scale(self, z):
+        return (torch.as_tensor(z).double() - self.low) / (self.high - self.low)
+
+    def predict_proba(self, z):
+        """P(feasible) of the latent points z (n, d), differentiable w.r.t. z"""
+        return torch.sigmoid(self.net(self._scale(z))).reshape(-1)
+
+    def screen(self, fix_model, z):
+        """Feasibility mask of z (n, d): the classifier decides where confident, the decoder inside the band.
+
+        Returns (mask, number of decoded points).
+        """
+        with torch.no_grad():
+            p = self.predict_proba(z)
+        mask = p >= self.band[1]
+        unsure = (p > self.band[0]) & ~mask
+        if unsure.any():
+            mask[unsure] = feasible_mask(fix_model, torch.as_tensor(z)[unsure])
+        return mask, int(unsure.sum())
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Parallel evaluation of the KL-trajectory objective
+
+Every jiVAE training started with default PyTorch threading grabs all cores of the node for
+intra-op parallelism, so running several objective evaluations side by side oversubscribes the
+machine. The executor below gives each worker process a disjoint set of cores, sets the torch
+intra-op/inter-op thread counts to match and (optionally) pins the worker to its cores.
+
+Two layouts are usually worth comparing:
+- "packed": few workers x many threads (good when a single training scales well with threads)
+- "spread": many workers x 1 thread (good when the per-step work is small, e.g. small batches)
+With policy "auto" both (and the layouts in between) are probed with a short evaluation burst and
+the one with the highest measured throughput (evaluations per second) is used.
+"""
+
+import json
+import math
+import multiprocessing as mp
+import os
+import platform
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import torch
+
+# Objective, its fixed arguments and the cores of the current worker process (set by _init_worker)
+_WORKER_STATE = {}
+
+# Machine profile written by latentbo_autotune.py (override the location with LATENTBO_MACHINE_PROFILE)
+MACHINE_PROFILE = "machine_profile.json"
+
+
+def available_cores():
+    """Cores the current process is allowed to run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_core_sets(n_workers, threads_per_worker=None, cores=None):
+    """Split the available cores into disjoint, contiguous sets (one per worker).
+
+    Args:
+        n_workers: number of worker processes.
+        threads_per_worker: cores (= torch intra-op threads) per worker. Defaults to an even split.
+        cores: cores to distribute. Defaults to the cores available to this process.
+    Returns:
+        List of core lists, one per worker.
+    """
+    cores = available_cores() if cores is None else list(cores)
+    n_workers = max(1, min(int(n_workers), len(cores)))
+    if threads_per_worker is None:
+        threads_per_worker = len(cores) // n_workers
+    threads_per_worker = max(1, int(threads_per_worker))
+    if n_workers * threads_per_worker > len(cores):
+        raise ValueError("Cannot place {} workers x {} threads on {} cores".format(
+            n_workers, threads_per_worker, len(cores)))
+    return [cores[k * threads_per_worker:(k + 1) * threads_per_worker] for k in range(n_workers)]
+
+
+def candidate_layouts(n_cores=None, policy="auto", packed_threads=8):
+    """(n_workers, threads_per_worker) layouts for a thread policy.
+
+    "spread" is n_cores x 1, "packed" is n_cores // packed_threads x packed_threads, and "auto" returns
+    every power-of-two thread count in between so that select_layout can measure them.
+    """
+    n_cores = len(available_cores()) if n_cores is None else int(n_cores)
+    packed_threads = max(1, min(int(packed_threads), n_cores))
+    if policy == "spread":
+        return [(n_cores, 1)]
+    if policy == "packed":
+        return [(n_cores // packed_threads, packed_threads)]
+    if policy != "auto":
+        raise ValueError("Unknown thread policy: {}".format(policy))
+    layouts = []
+    threads = 1
+    while threads <= packed_threads:
+        layouts.append((n_cores // threads, threads))
+        threads = threads * 2
+    return layouts
+
+
+def configure_worker_threads(cores, interop_threads=1, pin_cpus=False):
+    """Match the torch thread pools (and optionally the CPU affinity) of this process to `cores`"""
+    n_threads = len(cores)
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(n_threads)
+    torch.set_num_threads(n_threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # Inter-op pool can only be sized once, before any parallel work has started
+        pass
+    if pin_cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+def _init_worker(core_queue, objective, args, kwargs, interop_threads, pin_cpus):
+    cores = core_queue.get()
+    configure_worker_threads(cores, interop_threads, pin_cpus)
+    _WORKER_STATE["objective"] = objective
+    _WORKER_STATE["args"] = args
+    _WORKER_STATE["kwargs"] = kwargs
+    _WORKER_STATE["cores"] = cores
+
+
+def _run_objective(traj):
+    started = time.time()
+    value = _WORKER_STATE["objective"](traj, *_WORKER_STATE["args"], **_WORKER_STATE["kwargs"])
+    return value, started, time.time()
+
+
+def _resolve(future, pool_future):
+    # Unpack (value, started, finished) from the worker into the user-facing future
+    if pool_future.cancelled():
+        future.cancel()
+        return
+    error = pool_future.exception()
+    if error is not None:
+        future.set_exception(error)
+        return
+    value, started, finished = pool_future.result()
+    future.timing = {"submitted": future.submitted, "started": started, "finished": finished,
+                     "queue_wait_s": max(0.0, started - future.submitted), "run_s": finished - started}
+    future.set_result(value)
+
+
+class EvaluationExecutor:
+    """Process pool running `objective(traj, *args, **kwargs)` with one disjoint core set per worker.
+
+    The fixed arguments (e.g. the training images) are shipped once per worker at start-up instead of
+    with every task.
+
+    Args:
+        objective: picklable (module-level) objective function, e.g. loss_obj.
+        args: fixed positional arguments following the trajectory.
+        kwargs: fixed keyword arguments.
+        n_workers: number of worker processes.
+        threads_per_worker: torch intra-op threads (and cores) per worker. Defaults to an even split.
+        interop_threads: torch inter-op threads per worker.
+        pin_cpus: pin each worker to its core set (Linux only).
+        mp_context: multiprocessing start method. "spawn" avoids forking a parent with live thread pools.
+    Examples:
+        >>> with EvaluationExecutor(loss_obj, (data, batch_size, B, H, W, discrete_dim), n_workers=4) as ex:
+        >>>     values = ex.map(trajectories)
+    """
+
+    def __init__(self, objective, args=(), kwargs=None, n_workers=1, threads_per_worker=None,
+                 interop_threads=1, pin_cpus=False, mp_context="spawn"):
+        self.core_sets = plan_core_sets(n_workers, threads_per_worker)
+        self.n_workers = len(self.core_sets)
+        self.threads_per_worker = len(self.core_sets[0])
+        ctx = mp.get_context(mp_context)
+        core_queue = ctx.Queue()
+        for cores in self.core_sets:
+            core_queue.put(cores)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.n_workers, mp_context=ctx, initializer=_init_worker,
+            initargs=(core_queue, objective, tuple(args), dict(kwargs or {}), interop_threads, pin_cpus))
+
+    def submit(self, traj):
+        """Schedule one evaluation, returns a concurrent.futures.Future of the objective value.
+
+        Once resolved, `future.timing` holds the submit/start/finish wall times, the time spent waiting
+        for a free worker (queue_wait_s) and the evaluation run time (run_s).
+        """
+        future = Future()
+        future.submitted = time.time()
+        future.timing = None
+        pool_future = self._pool.submit(_run_objective, traj)
+        pool_future.add_done_callback(lambda f: _resolve(future, f))
+        return future
+
+    def map(self, trajs):
+        """Evaluate all trajectories, results in input order"""
+        return [f.result() for f in [self.submit(traj) for traj in trajs]]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+
+def measure_throughput(objective, args, probe_traj, n_workers, threads_per_worker, kwargs=None,
+                       pin_cpus=False, rounds=1):
+    """Evaluations per second of one layout, measured on `rounds` full rounds of probe evaluations.
+
+    Worker start-up is excluded by running one warm-up round first.
+    """
+    with EvaluationExecutor(objective, args, kwargs, n_workers, threads_per_worker,
+                            pin_cpus=pin_cpus) as ex:
+        ex.map([probe_traj] * ex.n_workers)
+        t0 = time.perf_counter()
+        ex.map([probe_traj] * (ex.n_workers * rounds))
+        elapsed = time.perf_counter() - t0
+    return ex.n_workers * rounds / elapsed
+
+
+def select_layout(objective, args, probe_traj, policy="auto", kwargs=None, packed_threads=8,
+                  max_workers=None, pin_cpus=False, verbose=True):
+    """Pick the (n_workers, threads_per_worker) layout for a thread policy.
+
+    For "spread"/"packed" the layout is returned directly; for "auto" each candidate layout is timed
+    with `objective(probe_traj, *args, **kwargs)` (use a short-burst objective, e.g. few epochs) and the
+    layout with the highest throughput wins.
+    """
+    layouts = candidate_layouts(policy=policy, packed_threads=packed_threads)
+    if max_workers is not None:
+        layouts = [(min(w, max_workers), t) for (w, t) in layouts]
+    layouts = list(dict.fromkeys((max(1, w), t) for (w, t) in layouts))
+    if len(layouts) == 1:
+        return layouts[0]
+    best, best_rate = None, -math.inf
+    for (w, t) in layouts:
+        rate = measure_throughput(objective, args, probe_traj, w, t, kwargs=kwargs, pin_cpus=pin_cpus)
+        if verbose:
+            print("Layout {} workers x {} threads: {:.4f} evals/s".format(w, t, rate))
+        if rate > best_rate:
+            best, best_rate = (w, t), rate
+    return best
+
+
+def machine_id():
+    """Host name and number of usable cores, used to check that a machine profile belongs to this node"""
+    return {"host": platform.node(), "n_cores": len(available_cores())}
+
+
+def load_machine_profile(problem, path=None, verbose=True):
+    """Tuned evaluation settings of `problem` (e.g. "graphene") for this machine, or None.
+
+    Profiles calibrated on another host or with a different number of usable cores are ignored.
+    """
+    path = path or os.environ.get("LATENTBO_MACHINE_PROFILE", MACHINE_PROFILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        profile = json.load(f)
+    if {k: profile.get(k) for k in ("host", "n_cores")} != machine_id():
+        if verbose:
+            print("Machine profile " + path + " was calibrated on another machine, ignored")
+        return None
+    settings = profile.get("problems", {}).get(problem)
+    if settings is not None and verbose:
+        print("Loaded machine profile for " + problem + ": " + str(
+            {k: settings[k] for k in ("batch_size", "n_workers", "threads_per_worker", "ssim_chunk")}))
+    return settings
+
+
+def profile_layout(settings, batch_size):
+    """(n_workers, threads_per_worker) calibrated at `batch_size` in the machine profile settings, or None"""
+    layout = settings.get("layouts", {}).get(str(batch_size))
+    if layout is None and settings.get("batch_size") == batch_size:
+        layout = settings
+    return None if layout is None else (layout["n_workers"], layout["threads_per_worker"])
+
+
+def save_machine_profile(problem, settings, path=None):
+    """Add/replace the settings of `problem` in the machine profile of this machine"""
+    path = path or os.environ.get("LATENTBO_MACHINE_PROFILE", MACHINE_PROFILE)
+    profile = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profile = json.load(f)
+        if {k: profile.get(k) for k in ("host", "n_cores")} != machine_id():
+            profile = {}
+    profile.update(machine_id())
+    profile["torch"] = torch.__version__
+    profile.setdefault("problems", {})[problem] = settings
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+    return path
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Parametric 4-D search space of cool-down trajectories
+
+The KL trajectories of functional 1 are governed by four quantities: start value, stop value,
+cool-down rate and time-out. Instead of searching the latent space of the pretrained vae_traj, the
+BO can search these parameters directly: ParametricTrajectorySpace plays the role of the trajectory
+decoder (decode() builds the trajectories of a batch of parameter vectors) and of the feasibility
+scan (every parameter vector in the bounds gives a valid trajectory, so candidates() returns the
+whole grid). It is passed to latentBO_KL in place of vae_traj, with the grid of grid() in place of
+the latent grid, and reuses the GP, acquisition and evaluation machinery unchanged.
+"""
+
+import numpy as np
+import torch
+
+from latentbo_candidates import candidate_set
+from latentbo_trajectories import NUM_TRAJ, cooldown_trajectories
+
+PARAM_NAMES = ("start", "stop", "coolrate", "timeout")
+# Ranges of the control parameters of functional 1 in the pretraining set
+PARAM_BOUNDS = ((30.0, 50.0), (1.0, 5.0), (1.0, 80.0), (1.0, 20.0))
+
+
+class ParametricTrajectorySpace:
+    """Cool-down trajectories parametrized by (start, stop, cool rate, time-out) within `bounds`"""
+
+    def __init__(self, num_traj=NUM_TRAJ, bounds=PARAM_BOUNDS):
+        self.num_traj = num_traj
+        self.bounds = torch.tensor(bounds, dtype=torch.float64)
+
+    def decode(self, X):
+        """Trajectories (n, num_traj) of the parameter vectors X (n, 4)"""
+        X = torch.as_tensor(X, dtype=torch.float64).reshape(-1, len(PARAM_NAMES))
+        return cooldown_trajectories(X[:, 0], X[:, 1], X[:, 2], X[:, 3], self.num_traj).float()
+
+    def grid(self, num_rows):
+        """Values of every parameter on the grid, shape (4, num_rows) (as the latent grid Z of the driver)"""
+        return torch.vstack([torch.linspace(low, high, num_rows, dtype=torch.float64) for low, high in self.bounds])
+
+    def candidates(self, X, budget=None):
+        """Grid points (or `budget` Sobol points, see candidate_set); no feasibility scan, every parameter vector is feasible"""
+        return candidate_set(X, budget)
+
+    def describe(self, x):
+        """Parameter vector as a dict, e.g. for reporting the optimum"""
+        return {name: float(v) for name, v in zip(PARAM_NAMES, np.asarray(x, dtype=np.float64).reshape(-1))}
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Closed-form linear latent model of the trajectories (PCA or B-spline + PCA)
+
+Alternative to the 2000-epoch vae_traj fit: the latent coordinates are the leading principal
+components of the pretraining trajectories, scaled to unit variance (like the N(0, 1) prior of the
+VAE). With basis="spline" the trajectories are first projected onto a cubic B-spline basis by least
+squares, so decoded trajectories are smooth. Fitting is one SVD (seconds for millions of
+trajectories), and decoding a whole candidate grid is one matrix multiply.
+
+LinearTrajectoryModel has the interface of vae_traj used by the drivers (encode, decode, manifold2d,
+save_weights/load_weights) and is passed to getfeasible/latentBO_KL in its place.
+"""
+
+import numpy as np
+import torch
+from scipy.interpolate import BSpline
+from pyroved.utils import generate_latent_grid, plot_spect_grid
+
+from latentbo_trajectories import NUM_TRAJ
+
+
+def bspline_basis(num_traj=NUM_TRAJ, n_basis=16, degree=3):
+    """Design matrix (num_traj, n_basis) of a clamped B-spline basis with uniform knots over the time steps"""
+    inner = np.linspace(0, 1, n_basis - degree + 1)
+    knots = np.concatenate((np.zeros(degree), inner, np.ones(degree)))
+    # Keep the last time step inside the base interval of the design matrix
+    t = np.linspace(0, 1 - 1e-12, num_traj)
+    return torch.from_numpy(BSpline.design_matrix(t, knots, degree).toarray())
+
+
+class LinearTrajectoryModel:
+    """Linear trajectory latent model fitted in closed form.
+
+    Args:
+        latent_dim: number of principal components (latent coordinates).
+        basis: "pca" (components of the raw trajectories) or "spline" (of their B-spline fit).
+        n_basis: B-spline basis functions (basis="spline").
+    """
+
+    def __init__(self, num_traj=NUM_TRAJ, latent_dim=2, basis="pca", n_basis=16):
+        if basis not in ("pca", "spline"):
+            raise ValueError("Unknown basis: {}".format(basis))
+        self.num_traj = num_traj
+        self.latent_dim = latent_dim
+        self.basis = basis
+        self.n_basis = n_basis
+        self.mean = None
+        self.components = None  # (latent_dim, num_traj) decoding matrix, scaled by the component std
+
+    def fit(self, traj):
+        """Fit to trajectories (n, num_traj) (or (n, 1, num_traj)); returns self"""
+        traj = torch.as_tensor(traj, dtype=torch.float64).reshape(len(traj), -1)
+        if self.basis == "spline":
+            # Least-squares projection onto the spline basis
+            basis = bspline_basis(self.num_traj, self.n_basis)
+            traj = traj @ (basis @ torch.linalg.pinv(basis)).T
+        self.mean = traj.mean(0)
+        _, s, vt = torch.linalg.svd(traj - self.mean, full_matrices=False)
+        std = s[:self.latent_dim] / np.sqrt(max(len(traj) - 1, 1))
+        self.components = std[:, None] * vt[:self.latent_dim]
+        self.explained_variance_ratio = (s[:self.latent_dim] ** 2 / torch.sum(s ** 2)).tolist()
+        return self
+
+    def encode(self, x_new, **kwargs):
+        """(z_mean, z_sd) of trajectories (n, num_traj) or (n, 1, num_traj); z_sd is zero (deterministic)"""
+        x = torch.as_tensor(x_new, dtype=torch.float64).reshape(len(x_new), -1)
+        # components has orthogonal rows of norm std: least-squares coordinates
+        z = (x - self.mean) @ self.components.T / torch.sum(self.components ** 2, 1)
+        return z.float(), torch.zeros_like(z, dtype=torch.float32)
+
+    def decode(self, z, **kwargs):
+        """Trajectories (n, num_traj) of latent points z (n, latent_dim)"""
+        z = torch.as_tensor(z, dtype=torch.float64).reshape(-1, self.latent_dim)
+        return (self.mean + z @ self.components).float()
+
+    def manifold2d(self, d, plot=True, **kwargs):
+        """Decoded trajectories on a d x d grid of the first two latent coordinates (as pyroved's manifold2d)"""
+        z, _ = generate_latent_grid(d, **kwargs)
+        z = torch.hstack((z, torch.zeros(len(z), self.latent_dim - 2)))
+        loc = self.decode(z)
+        if plot:
+            plot_spect_grid(loc, d, **kwargs)
+        return loc
+
+    def save_weights(self, filepath):
+        torch.save({"num_traj": self.num_traj, "latent_dim": self.latent_dim, "basis": self.basis,
+                    "n_basis": self.n_basis, "mean": self.mean, "components": self.components}, filepath + ".pt")
+
+    def load_weights(self, filepath):
+        state = torch.load(filepath)
+        self.num_traj, self.latent_dim = state["num_traj"], state["latent_dim"]
+        self.basis, self.n_basis = state["basis"], state["n_basis"]
+        self.mean, self.components = state["mean"], state["components"]
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Trajectory latent models that are feasible by construction
+
+The vae_traj decoder (sigmoid_d=False) can emit non-positive KL scales, which is why getfeasible and
+the feasibility map of the drivers scan the latent grid and discard the infeasible cells. Here the
+latent model is fitted to transformed trajectories u = inverse(traj) and its decoded output is passed
+through a positivity-enforcing transform with a bounded range:
+    exp       traj = exp(u), u clamped to [log(low), log(high)]
+    softplus  traj = softplus(u), u clamped to the preimage of [low, high]
+    sigmoid   traj = low + (high - low) * sigmoid(u)
+Every latent point then decodes to a trajectory in [low, high], so the whole latent box is feasible:
+PositiveTrajectoryModel.candidates() returns the full grid and getfeasible skips the scan.
+"""
+
+import json
+import os
+
+import torch
+from pyroved.utils import plot_spect_grid
+
+from latentbo_candidates import candidate_set
+
+TRANSFORMS = ("exp", "softplus", "sigmoid")
+
+
+class OutputTransform:
+    """Positive, bounded map from the model output u to the trajectory value, and its inverse"""
+
+    def __init__(self, transform="exp", low=0.5, high=60.0):
+        if transform not in TRANSFORMS:
+            raise ValueError("Unknown output transform: {}".format(transform))
+        if not 0 < low < high:
+            raise ValueError("The output range must satisfy 0 < low < high")
+        self.transform, self.low, self.high = transform, float(low), float(high)
+
+    def config(self):
+        return {"transform": self.transform, "low": self.low, "high": self.high}
+
+    def forward(self, u):
+        u = torch.as_tensor(u)
+        if self.transform == "sigmoid":
+            return self.low + (self.high - self.low) * torch.sigmoid(u)
+        u_low, u_high = self.inverse(torch.tensor([self.low, self.high], dtype=u.dtype))
+        u = torch.clamp(u, float(u_low), float(u_high))
+        return torch.exp(u) if self.transform == "exp" else torch.nn.functional.softplus(u)
+
+    def inverse(self, traj):
+        traj = torch.as_tensor(traj)
+        if self.transform == "sigmoid":
+            # Trajectory values at the bounds would map to +-inf, keep them strictly inside
+            frac = torch.clamp((traj - self.low) / (self.high - self.low), 1e-4, 1 - 1e-4)
+            return torch.log(frac) - torch.log1p(-frac)
+        traj = torch.clamp(traj, self.low, self.high)
+        return torch.log(traj) if self.transform == "exp" else torch.log(torch.expm1(traj))
+
+
+class PositiveTrajectoryModel:
+    """Latent model (vae_traj or LinearTrajectoryModel) fitted to inverse(traj), decoding through forward()"""
+
+    def __init__(self, model, transform="exp", low=0.5, high=60.0):
+        self.model = model
+        self.output = OutputTransform(transform, low, high)
+
+    def fit(self, traj):
+        """Fit a closed-form inner model (LinearTrajectoryModel) to the transformed trajectories; returns self"""
+        self.model.fit(self.output.inverse(torch.as_tensor(traj, dtype=torch.float64)))
+        return self
+
+    def encode(self, x_new, **kwargs):
+        return self.model.encode(self.output.inverse(x_new).float(), **kwargs)
+
+    def decode(self, z, **kwargs):
+        return self.output.forward(self.model.decode(z, **kwargs))
+
+    def candidates(self, X, budget=None):
+        """All points of the latent grid X (rows: values of every latent coordinate), or `budget` Sobol points of its
+        box (see candidate_set); no scan needed"""
+        return candidate_set(X, budget)
+
+    def manifold2d(self, d, plot=True, **kwargs):
+        loc = self.output.forward(self.model.manifold2d(d, plot=False, **kwargs))
+        if plot:
+            plot_spect_grid(loc, d, **kwargs)
+        return loc
+
+    def save_weights(self, filepath):
+        """Weights of the inner model (filepath.pt) and the output transform (filepath.transform.json)"""
+        self.model.save_weights(filepath)
+        with open(filepath + ".transform.json", "w") as f:
+            json.dump(self.output.config(), f)
+
+
+def output_transform_file(weights_path):
+    """Output transform saved next to the weights `weights_path` (*.pt) by save_weights, or None"""
+    path = os.path.splitext(weights_path)[0] + ".transform.json"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Cached, resumable pretraining of the trajectory VAE (vae_traj)
+
+Every run used to retrain vae_traj (iVAE, latent_dim=2) for 2000 epochs on the synthetic trajectories
+before the BO could start, although the result only depends on the trajectory generator settings,
+the model/training settings and the seeds. The trained weights are now stored as a versioned
+artifact, keyed by a hash of that configuration, together with the latent bounds of the encoded
+training trajectories:
+    artifacts/vae_traj-v1-<key>/vae_traj.pt   weights
+    artifacts/vae_traj-v1-<key>/meta.json     configuration, latent bounds, loss history, data checksum
+Runs with the same configuration (graphene and plasmonic scripts share num_traj) load the artifact
+instead of training. While training, a checkpoint (weights, optimizer state, RNG states, epoch) is
+written every `checkpoint_every` epochs, and an interrupted pretraining resumes from it.
+
+Optional configuration entries turn the fixed epoch count into a convergence-aware schedule:
+    holdout        fraction of the trajectories held out to monitor the ELBO (default 0, off)
+    eval_every     epochs between held-out evaluations (default 10)
+    patience       held-out evaluations without a relative improvement of min_delta (default 1e-3)
+                   before stopping; the best weights are kept. "epochs" becomes the maximum
+    warmup_epochs  the learning rate is scaled linearly with batch_size / base_batch_size (default 64)
+                   and ramped up from "lr" to the scaled value over these epochs
+
+With a "stream" entry, e.g. {"samples_per_epoch": 7500, "weights": {"cooldown": 1, "periodic": 1}}, the
+model is trained on fresh trajectories drawn every epoch (latentbo_trajectories.StreamingTrajectories)
+instead of the fixed set; the held-out trajectories are a separate draw of the stream.
+
+With an "output" entry, e.g. {"transform": "exp", "low": 0.5, "high": 60}, the VAE is fitted to the
+inverse-transformed trajectories and returned wrapped in latentbo_positive.PositiveTrajectoryModel,
+so that every latent point decodes to a positive trajectory.
+
+Set LATENTBO_ARTIFACT_DIR to share the artifacts between run directories.
+"""
+
+import hashlib
+import json
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import pyro
+import pyroved as pv
+
+from latentbo_positive import OutputTransform, PositiveTrajectoryModel
+from latentbo_trajectories import StreamingTrajectories, streaming_loader
+
+# Bump when the artifact layout or the meaning of the configuration changes
+TRAJ_ARTIFACT_VERSION = 1
+ARTIFACT_DIR = "artifacts"
+
+
+def artifact_key(config):
+    """Short hash of the pretraining configuration (generator settings, model, training, seeds)"""
+    blob = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1("{}:{}".format(TRAJ_ARTIFACT_VERSION, blob).encode()).hexdigest()[:12]
+
+
+def artifact_path(config, artifact_dir=None):
+    artifact_dir = artifact_dir or os.environ.get("LATENTBO_ARTIFACT_DIR", ARTIFACT_DIR)
+    return os.path.join(artifact_dir, "vae_traj-v{}-{}".format(TRAJ_ARTIFACT_VERSION, artifact_key(config)))
+
+
+def data_checksum(traj_data):
+    return hashlib.sha1(np.ascontiguousarray(torch.as_tensor(traj_data).float().numpy()).tobytes()).hexdigest()
+
+
+def build_trajectory_vae(config):
+    """vae_traj as configured by the driver"""
+    return pv.models.iVAE((config["num_traj"],), latent_dim=config.get("latent_dim", 2), invariances=None,
+                          sampler_d="gaussian", decoder_sig=config.get("decoder_sig", .3), sigmoid_d=False,
+                          seed=config.get("model_seed", 0))
+
+
+def wrap_output(vae_traj, config):
+    """vae_traj decoding through the positivity-enforcing output transform of config["output"], if any"""
+    if not config.get("output"):
+        return vae_traj
+    return PositiveTrajectoryModel(vae_traj, **config["output"])
+
+
+def _save_atomic(obj, path):
+    tmp = path + ".tmp"
+    if path.endswith(".json"):
+        with open(tmp, "w") as f:
+            json.dump(obj, f, indent=2)
+    else:
+        torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+def _rng_state():
+    return {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "random": random.getstate(),
+            "pyro": pyro.util.get_rng_state()}
+
+
+def _set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+    pyro.util.set_rng_state(state["pyro"])
+
+
+def latent_bounds(vae_traj, traj_data):
+    """Min/max of the encoded means of the training trajectories (spans the BO candidate grid)"""
+    z_mean, _ = vae_traj.encode(torch.as_tensor(traj_data).float().unsqueeze(1))
+    return {"z_min": torch.min(z_mean, 0)[0].tolist(), "z_max": torch.max(z_mean, 0)[0].tolist()}
+
+
+def load_pretrained(config, artifact_dir=None, traj_data=None, verbose=True):
+    """(vae_traj, meta) of a finished artifact matching `config`, or None.
+
+    With `traj_data`, an artifact trained on different trajectories (e.g. an unseeded generator) is ignored.
+    """
+    path = artifact_path(config, artifact_dir)
+    meta_file = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta.get("version") != TRAJ_ARTIFACT_VERSION:
+        return None
+    if traj_data is not None and meta.get("data_sha1") != data_checksum(traj_data):
+        if verbose:
+            print("Pretrained vae_traj " + path + " was trained on different trajectories, ignored")
+        return None
+    vae_traj = build_trajectory_vae(config)
+    vae_traj.load_weights(os.path.join(path, "vae_traj.pt"))
+    if verbose:
+        print("Loaded pretrained vae_traj from " + path)
+    return wrap_output(vae_traj, config), meta
+
+
+def _set_lr(trainer, lr):
+    # Learning rate of the pyro optimizer: existing parameters and the ones created later
+    trainer.svi.optim.pt_optim_args["lr"] = lr
+    for opt in trainer.svi.optim.optim_objs.values():
+        for group in opt.param_groups:
+            group["lr"] = lr
+
+
+def scheduled_lr(config, epoch):
+    """Learning rate of `epoch`: linear batch-size scaling with a linear warmup from config["lr"]"""
+    target = config["lr"] * config["batch_size"] / config.get("base_batch_size", 64)
+    warmup = config.get("warmup_epochs", 0)
+    if epoch >= warmup:
+        return target
+    return config["lr"] + (target - config["lr"]) * epoch / warmup
+
+
+def holdout_loss(trainer, loader):
+    """ELBO loss per sample on `loader`, without a parameter update"""
+    loss = 0.
+    with torch.no_grad():
+        for (x,) in loader:
+            loss += trainer.svi.evaluate_loss(x.to(trainer.device))
+    return loss / len(loader.dataset)
+
+
+def split_holdout(traj_data, fraction, seed=0):
+    """(training, held-out) trajectories; the split only depends on `seed`"""
+    n_holdout = int(round(fraction * len(traj_data)))
+    perm = torch.randperm(len(traj_data), generator=torch.Generator().manual_seed(seed))
+    return traj_data[perm[n_holdout:]], traj_data[perm[:n_holdout]]
+
+
+def pretrain_trajectory_vae(traj_data, config, artifact_dir=None, checkpoint_every=50, print_every=1,
+                            num_workers=0, prefetch=2, verbose=True):
+    """Trained vae_traj for the trajectories `traj_data` (n, num_traj): loaded, resumed or trained from scratch.
+
+    Args:
+        config: generator and training configuration; the artifact key. Uses num_traj, epochs, lr and
+            batch_size (and optionally latent_dim, decoder_sig, model_seed and the schedule entries of the
+            module docstring); the remaining entries (e.g. sample counts, generator seed) only enter the key.
+        checkpoint_every: epochs between checkpoints (0 disables checkpointing).
+        print_every: epochs between printed statistics.
+        num_workers, prefetch: DataLoader workers generating the stream and batches buffered per worker
+            (streaming mode; `traj_data` may then be None, otherwise it only sets the latent bounds).
+    Returns:
+        (vae_traj, meta) with meta["latent_bounds"] holding the min/max of the encoded trajectories.
+    """
+    cached = load_pretrained(config, artifact_dir, traj_data, verbose)
+    if cached is not None:
+        return cached
+
+    path = artifact_path(config, artifact_dir)
+    os.makedirs(path, exist_ok=True)
+    checkpoint_file = os.path.join(path, "checkpoint.pt")
+    holdout = config.get("holdout", 0)
+    eval_every = config.get("eval_every", 10)
+    patience = config.get("patience")
+    min_delta = config.get("min_delta", 1e-3)
+    stream = config.get("stream")
+    # With an output transform the VAE is fitted to the inverse-transformed trajectories (latentbo_positive)
+    output = OutputTransform(**config["output"]) if config.get("output") else None
+    to_model = output.inverse if output is not None else (lambda traj: traj)
+    holdout_traj = None
+    if stream is not None:
+        dataset = StreamingTrajectories(stream.get("samples_per_epoch", 7500), config["batch_size"], config["num_traj"],
+                                        stream.get("weights"), config.get("seed", 0),
+                                        transform=None if output is None else output.inverse)
+        # Epoch -1 of the stream is never trained on
+        reference = dataset.batch(0, int(round(max(holdout, 0.1) * len(dataset))), epoch=-1)
+        holdout_traj = to_model(reference) if holdout else None
+        traj_data = reference if traj_data is None else traj_data
+        train_loader = streaming_loader(dataset, num_workers, prefetch)
+    traj_data = torch.as_tensor(traj_data).float()
+    if stream is None:
+        train_traj = to_model(traj_data)
+        if holdout:
+            train_traj, holdout_traj = split_holdout(train_traj, holdout, config.get("seed", 0))
+        train_loader = pv.utils.init_dataloader(train_traj.unsqueeze(1), batch_size=config["batch_size"])
+    holdout_loader = None
+    if holdout_traj is not None:
+        holdout_loader = pv.utils.init_dataloader(holdout_traj.unsqueeze(1), batch_size=1024, shuffle=False)
+    vae_traj = build_trajectory_vae(config)
+    trainer = pv.trainers.SVItrainer(vae_traj, lr=config["lr"])
+
+    # Early stopping state: best held-out loss, its weights and epoch, evaluations without improvement
+    state = {"best_loss": float("inf"), "best_model": None, "best_epoch": None, "bad_evals": 0, "stop_reason": "epochs"}
+    start = 0
+    if os.path.exists(checkpoint_file):
+        checkpoint = torch.load(checkpoint_file, weights_only=False)
+        if checkpoint["data_sha1"] == data_checksum(traj_data):
+            vae_traj.load_state_dict(checkpoint["model"])
+            # Applied by pyro when the parameters are seen in the first step, with the learning rate of that step
+            for opt_state in checkpoint["optimizer"].values():
+                for group in opt_state["param_groups"]:
+                    group["lr"] = scheduled_lr(config, checkpoint["epoch"])
+            trainer.svi.optim.set_state(checkpoint["optimizer"])
+            trainer.loss_history = checkpoint["loss_history"]
+            trainer.current_epoch = checkpoint["epoch"]
+            state = checkpoint["early_stopping"]
+            _set_rng_state(checkpoint["rng"])
+            start = checkpoint["epoch"]
+            if verbose:
+                print("Resuming vae_traj pretraining at epoch {} from {}".format(start, checkpoint_file))
+
+    t0 = time.perf_counter()
+    for e in range(start, config["epochs"]):
+        _set_lr(trainer, scheduled_lr(config, e))
+        if stream is not None:
+            dataset.set_epoch(e)
+        trainer.step(train_loader)
+        if holdout_loader is not None and (e + 1) % eval_every == 0:
+            loss = holdout_loss(trainer, holdout_loader)
+            trainer.loss_history["test_loss"].append(loss)
+            if state["best_epoch"] is None or loss < state["best_loss"] - min_delta * abs(state["best_loss"]):
+                state.update(best_loss=loss, best_epoch=e + 1, bad_evals=0,
+                             best_model={k: v.clone() for k, v in vae_traj.state_dict().items()})
+            else:
+                state["bad_evals"] += 1
+        if verbose and ((e + 1) % print_every == 0 or e + 1 == config["epochs"]):
+            trainer.print_statistics()
+        if patience is not None and state["bad_evals"] >= patience:
+            state["stop_reason"] = "plateau"
+            if verbose:
+                print("Held-out ELBO plateaued, stopping at epoch {} (best at epoch {})".format(
+                    e + 1, state["best_epoch"]))
+            break
+        if checkpoint_every and (e + 1) % checkpoint_every == 0 and e + 1 < config["epochs"]:
+            _save_atomic({"epoch": e + 1, "model": vae_traj.state_dict(), "optimizer": trainer.svi.optim.get_state(),
+                          "loss_history": trainer.loss_history, "early_stopping": state, "rng": _rng_state(),
+                          "data_sha1": data_checksum(traj_data)}, checkpoint_file)
+    if state["best_model"] is not None:
+        vae_traj.load_state_dict(state["best_model"])
+    model = wrap_output(vae_traj, config)
+
+    meta = {"version": TRAJ_ARTIFACT_VERSION, "key": artifact_key(config), "config": config,
+            "data_sha1": data_checksum(traj_data), "latent_bounds": latent_bounds(model, traj_data),
+            "epochs_trained": trainer.current_epoch, "stop_reason": state["stop_reason"],
+            "best_epoch": state["best_epoch"], "train_s": time.perf_counter() - t0,
+            "loss_history": trainer.loss_history["training_loss"],
+            "holdout_loss_history": trainer.loss_history["test_loss"], "torch": torch.__version__,
+            "pyroved": pv.__version__, "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    _save_atomic(vae_traj.state_dict(), os.path.join(path, "vae_traj.pt"))
+    # meta.json marks the artifact as complete, write it last
+    _save_atomic(meta, os.path.join(path, "meta.json"))
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    if verbose:
+        print("Pretrained vae_traj saved to " + path)
+    return model, meta
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""Memory instrumentation of the pipeline stages and deep profiling of single evaluations
+
+MemoryTracker reports the high-water mark of each tagged stage (trajectory generation, vae_traj
+training, feasibility scan, dataset balancing, every loss_obj call, plotting, ...) from three sources:
+- RSS of the process (and of its child processes, e.g. evaluation workers, when psutil is installed),
+  sampled by a background thread
+- tracemalloc peak of Python/numpy allocations (optional, it slows allocation-heavy code down)
+- torch CUDA allocator peak (when running on a GPU)
+
+Stages are tagged either with the context manager `memory_stage(name)` or, in notebook-style scripts,
+with `memory_begin(name)` / `memory_end(name)`. Both are no-ops until a tracker is installed:
+    >>> tracker = install_memory_tracker(MemoryTracker("memory.jsonl"))
+    >>> memory_begin("balancing")
+    >>> ...
+    >>> memory_end("balancing")
+    >>> tracker.report()
+
+EvaluationProfiler captures operator-level hotspots of one objective evaluation (pyro TraceEnum ELBO,
+the rotation spatial transformer, kornia SSIM, ...) with torch.profiler and cProfile, and writes a
+Chrome trace (open in chrome://tracing or https://ui.perfetto.dev), a pstats file (inspect with
+`python -m pstats` or snakeviz) and the operator table into the run directory.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from latentbo_telemetry import append_jsonl
+
+try:
+    import psutil
+except ImportError:  # RSS is then read from /proc (Linux) or getrusage
+    psutil = None
+
+_MB = 1024.0 ** 2
+
+
+def rss_bytes(children=False):
+    """Current resident set size of this process (plus its children if requested and psutil is available)"""
+    if psutil is not None:
+        proc = psutil.Process()
+        rss = proc.memory_info().rss
+        if children:
+            for child in proc.children(recursive=True):
+                try:
+                    rss = rss + child.memory_info().rss
+                except psutil.Error:
+                    pass
+        return rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Only the high-water mark of the process is available
+        return max_rss_bytes()
+
+
+def max_rss_bytes():
+    """High-water mark of the process RSS since start-up (ru_maxrss is in bytes on macOS, KiB on Linux)"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class _Frame:
+    def __init__(self, name, rss):
+        self.name = name
+        self.t0 = time.perf_counter()
+        self.rss_start = rss
+        self.rss_peak = rss
+        self.py_peak = 0
+        self.cuda_peak = 0
+
+
+class MemoryTracker:
+    """High-water marks of tagged pipeline stages.
+
+    Args:
+        log_path: JSON-lines file receiving one record per finished stage (None: print only).
+        use_tracemalloc: also track the peak of Python/numpy allocations.
+        sample_interval: RSS sampling period in seconds.
+        children: include the RSS of child processes (needs psutil).
+        verbose: print one line per finished stage.
+    """
+
+    def __init__(self, log_path=None, use_tracemalloc=False, sample_interval=0.05, children=True, verbose=True):
+        self.log_path = log_path
+        self.use_tracemalloc = use_tracemalloc
+        self.sample_interval = sample_interval
+        self.children = children
+        self.verbose = verbose
+        self.frames = []
+        self.summary = OrderedDict()
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            rss = rss_bytes(self.children)
+            with self._lock:
+                for frame in self.frames:
+                    frame.rss_peak = max(frame.rss_peak, rss)
+
+    def begin(self, name):
+        rss = rss_bytes(self.children)
+        with self._lock:
+            if self.use_tracemalloc:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                # Fold the peak so far into the open stages before resetting it for the new one
+                peak = tracemalloc.get_traced_memory()[1]
+                for frame in self.frames:
+                    frame.py_peak = max(frame.py_peak, peak)
+                tracemalloc.reset_peak()
+            if torch.cuda.is_available():
+                peak = torch.cuda.max_memory_allocated()
+                for frame in self.frames:
+                    frame.cuda_peak = max(frame.cuda_peak, peak)
+                torch.cuda.reset_peak_memory_stats()
+            self.frames.append(_Frame(name, rss))
+        if self._sampler is None:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def end(self, name=None):
+        rss = rss_bytes(self.children)
+        with self._lock:
+            frame = self.frames.pop()
+            if name is not None and frame.name != name:
+                raise RuntimeError("Memory stage '{}' ended while '{}' is open".format(name, frame.name))
+            frame.rss_peak = max(frame.rss_peak, rss)
+            if self.use_tracemalloc:
+                frame.py_peak = max(frame.py_peak, tracemalloc.get_traced_memory()[1])
+            if torch.cuda.is_available():
+                frame.cuda_peak = max(frame.cuda_peak, torch.cuda.max_memory_allocated())
+            for parent in self.frames:
+                parent.rss_peak = max(parent.rss_peak, frame.rss_peak)
+                parent.py_peak = max(parent.py_peak, frame.py_peak)
+                parent.cuda_peak = max(parent.cuda_peak, frame.cuda_peak)
+        if not self.frames:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        record = OrderedDict([
+            ("stage", frame.name),
+            ("wall_s", time.perf_counter() - frame.t0),
+            ("rss_start_mb", frame.rss_start / _MB),
+            ("rss_end_mb", rss / _MB),
+            ("rss_peak_mb", frame.rss_peak / _MB),
+            ("py_peak_mb", frame.py_peak / _MB if self.use_tracemalloc else None),
+            ("cuda_peak_mb", frame.cuda_peak / _MB if torch.cuda.is_available() else None),
+            ("max_rss_mb", max_rss_bytes() / _MB),
+        ])
+        self._update_summary(record)
+        if self.log_path is not None:
+            append_jsonl(self.log_path, dict(record, time=time.strftime("%Y-%m-%d %H:%M:%S")))
+        if self.verbose:
+            print("Memory [{}]: peak RSS {:.0f} MB (start {:.0f} MB, end {:.0f} MB){}".format(
+                frame.name, record["rss_peak_mb"], record["rss_start_mb"], record["rss_end_mb"],
+                "" if record["py_peak_mb"] is None else ", python peak {:.0f} MB".format(record["py_peak_mb"])))
+        return record
+
+    @contextmanager
+    def stage(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def _update_summary(self, record):
+        s = self.summary.setdefault(record["stage"], {"count": 0, "wall_s": 0.0})
+        s["count"] += 1
+        s["wall_s"] += record["wall_s"]
+        for key in ("rss_peak_mb", "py_peak_mb", "cuda_peak_mb"):
+            if record[key] is not None:
+                s[key] = max(s.get(key, 0.0), record[key])
+
+    def report(self):
+        """Print (and log) the high-water mark of every stage seen so far"""
+        print("Memory high-water marks per stage:")
+        for name, s in self.summary.items():
+            extra = "".join(", {} {:.0f} MB".format(k[:-3], s[k]) for k in ("py_peak_mb", "cuda_peak_mb") if k in s)
+            print("  {:<24s} x{:<4d} peak RSS {:8.0f} MB{}".format(name, s["count"], s["rss_peak_mb"], extra))
+        if self.log_path is not None:
+            append_jsonl(self.log_path, {"summary": self.summary, "time": time.strftime("%Y-%m-%d %H:%M:%S")})
+        return self.summary
+
+
+# Tracker used by memory_stage/memory_begin/memory_end (None: tagging is a no-op)
+_ACTIVE_TRACKER = None
+
+
+def install_memory_tracker(tracker):
+    """Make `tracker` receive all tagged stages (pass None to switch tracking off again)"""
+    global _ACTIVE_TRACKER
+    _ACTIVE_TRACKER = tracker
+    return tracker
+
+
+def memory_begin(name):
+    if _ACTIVE_TRACKER is not None:
+        _ACTIVE_TRACKER.begin(name)
+
+
+def memory_end(name):
+    if _ACTIVE_TRACKER is not None:
+        return _ACTIVE_TRACKER.end(name)
+
+
+@contextmanager
+def memory_stage(name):
+    if _ACTIVE_TRACKER is None:
+        yield
+        return
+    with _ACTIVE_TRACKER.stage(name):
+        yield
+
+
+def iter_trace_events(trace_path, chunk_size=1 << 20):
+    """Events of the traceEvents array of a Chrome trace, decoded one at a time from chunks of the file"""
+    decoder = json.JSONDecoder()
+    with open(trace_path) as f:
+        buf, pos = "", -1
+        while pos < 0:
+            more = f.read(chunk_size)
+            if not more:
+                return
+            buf += more
+            key = buf.find('"traceEvents"')
+            pos = -1 if key < 0 else buf.find("[", key)
+        pos += 1
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                event, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Event cut at the end of the buffer: read on
+                more = f.read(chunk_size)
+                if not more:
+                    if pos >= len(buf):
+                        return
+                    raise
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield event
+
+
+def operator_table(trace_path, row_limit=25):
+    """Count, total and self time per operator of a Chrome trace exported by torch.profiler.
+
+    Computed from the trace file with one sweep per thread; torch's key_averages() is quadratic in
+    practice and takes far longer than the profiled evaluation itself on traces with ~1e6 operators.
+    The trace is streamed and only (start, duration, name) of the operators is kept, so a multi-GB trace
+    is never loaded at once.
+    """
+    threads = {}
+    for e in iter_trace_events(trace_path):
+        if e.get("ph") == "X" and e.get("cat") in ("cpu_op", "kernel", "gpu_memcpy"):
+            threads.setdefault((e["pid"], e["tid"]), []).append((e["ts"], e["dur"], sys.intern(e["name"])))
+    stats = {}
+    for thread_events in threads.values():
+        thread_events.sort(key=lambda e: (e[0], -e[1]))
+        stack = []  # [end time, name, time covered by children, duration]
+        for e in thread_events + [None]:
+            while stack and (e is None or e[0] >= stack[-1][0]):
+                end, name, child_time, dur = stack.pop()
+                s = stats.setdefault(name, [0, 0.0, 0.0])
+                s[0] += 1
+                s[1] += dur
+                s[2] += dur - child_time
+                if stack:
+                    stack[-1][2] += dur
+            if e is not None:
+                stack.append([e[0] + e[1], e[2], 0.0, e[1]])
+    total_self = sum(s[2] for s in stats.values()) or 1.0
+    rows = sorted(stats.items(), key=lambda item: -item[1][2])[:row_limit]
+    lines = ["{:<48s} {:>9s} {:>12s} {:>12s} {:>7s}".format("operator", "count", "total ms", "self ms", "self %")]
+    for name, (count, total, self_time) in rows:
+        lines.append("{:<48s} {:>9d} {:>12.1f} {:>12.1f} {:>6.1f}%".format(
+            name[:48], count, total / 1e3, self_time / 1e3, 100 * self_time / total_self))
+    return "\n".join(lines)
+
+
+class EvaluationProfiler:
+    """Deep profile of selected objective evaluations.
+
+    Args:
+        evals: 1-based evaluation number(s) to profile (the count printed as "Function eval #").
+        out_dir: directory receiving profile_eval<k>.trace.json, .pstats and _ops.txt.
+        record_shapes: record the input shapes of every operator (larger trace).
+            A full evaluation records ~1e6 operators (~0.3 GB of trace per 1e6), keep the extras off for
+            production-size runs.
+        with_stack: record Python stacks of the operators (much larger trace).
+        row_limit: rows of the printed operator/function tables.
+    Examples:
+        >>> profiler = EvaluationProfiler(3)
+        >>> if profiler.wants(m + 1):
+        >>>     value = profiler.run(m + 1, loss_obj, traj, data, batch_size, B, H, W, discrete_dim)
+    """
+
+    def __init__(self, evals, out_dir=".", record_shapes=False, with_stack=False, row_limit=25):
+        self.evals = {int(evals)} if np.isscalar(evals) else {int(k) for k in evals}
+        self.out_dir = out_dir
+        self.record_shapes = record_shapes
+        self.with_stack = with_stack
+        self.row_limit = row_limit
+        self.files = []
+
+    def wants(self, n):
+        return n in self.evals
+
+    def run(self, n, fn, *args, **kwargs):
+        """fn(*args, **kwargs) under torch.profiler and cProfile, returns its result"""
+        os.makedirs(self.out_dir, exist_ok=True)
+        prefix = os.path.join(self.out_dir, "profile_eval{}".format(n))
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        cprof = cProfile.Profile()
+        with torch.profiler.profile(activities=activities, record_shapes=self.record_shapes,
+                                    with_stack=self.with_stack) as prof:
+            cprof.enable()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                cprof.disable()
+
+        prof.export_chrome_trace(prefix + ".trace.json")
+        cprof.dump_stats(prefix + ".pstats")
+        ops = operator_table(prefix + ".trace.json", self.row_limit)
+        stream = io.StringIO()
+        pstats.Stats(cprof, stream=stream).sort_stats("cumulative").print_stats(self.row_limit)
+        with open(prefix + "_ops.txt", "w") as f:
+            f.write(ops + "\n\n" + stream.getvalue())
+        self.files.extend([prefix + ".trace.json", prefix + ".pstats", prefix + "_ops.txt"])
+        print("Profiled function eval #{}: {}.trace.json, {}.pstats".format(n, prefix, prefix))
+        print(ops)
+        return result
+
+
+def evaluation_profiler(evals=None, out_dir=".", **kwargs):
+    """EvaluationProfiler for `evals`, or None when no evaluation is to be profiled"""
+    return None if evals is None else EvaluationProfiler(evals, out_dir, **kwargs)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Offline replay of BO campaigns on recorded objective values
+
+Once loss_obj has been evaluated on a dense set of latent grid points (record_table), acquisition
+settings, batch sizes and stopping rules can be compared without any jiVAE training: ReplayObjective
+answers the queries of latentBO_KL from the stored table, either with the value of the nearest
+recorded trajectory or with an inverse-distance interpolation of the k nearest ones. The objective
+is a function of the trajectory, so the lookup is done in trajectory space.
+
+Every replayed campaign reports the number of evaluations and the (simulated) time needed to reach
+the best recorded value: replayed evaluations are charged the recorded evaluation cost, the BO
+machinery its measured wall time.
+    python latentbo_replay.py --table replay_table.npz --decoder vae_traj.pt --q 1 2 4 --mode nearest idw
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import pyroved as pv
+
+from latentbo_pca import LinearTrajectoryModel
+from latentbo_positive import PositiveTrajectoryModel, output_transform_file
+from latentbo_synthetic import run_latent_bo
+
+REPLAY_REPORT = "replay_report.json"
+
+
+class _CostRecorder:
+    # Collects the per-evaluation run times reported by evaluate_latent_batch (telemetry interface)
+    def __init__(self):
+        self.run_s = []
+
+    def add_evaluation(self, run_s, queue_wait_s=0.0, profiled=False):
+        self.run_s.append(run_s)
+
+
+def record_table(X, fix_params, data, fix_model, path, Z=None, executor=None, obj_kwargs=None, objective=None,
+                 chunk=None):
+    """Evaluate the objective at the latent points X (n, 2) and store them as a replay table.
+
+    The table (npz: X, Y, traj, cost_s and the candidate grid Z) is rewritten after every chunk of
+    points, and points already in an existing table at `path` are skipped, so an interrupted recording
+    resumes where it stopped.
+    """
+    from graphene_latentbo_jrvae_gpurun import evaluate_latent_batch
+    X = torch.as_tensor(X)
+    chunk = chunk or (1 if executor is None else executor.n_workers)
+    table = load_table(path) if os.path.exists(path) else {"X": np.zeros((0, X.shape[1])), "Y": np.zeros(0),
+                                                             "traj": None, "cost_s": np.zeros(0)}
+    m = len(table["Y"])
+    for start in range(m, len(X), chunk):
+        Z_batch = X[start:start + chunk]
+        costs = _CostRecorder()
+        Y, m = evaluate_latent_batch(Z_batch, fix_params, data, fix_model, m, executor, obj_kwargs, costs,
+                                     objective=objective)
+        traj = np.reshape(fix_model.decode(Z_batch.float()).numpy(), (len(Z_batch), -1))
+        table["X"] = np.vstack((table["X"], Z_batch.numpy()))
+        table["Y"] = np.concatenate((table["Y"], Y[:, 0].numpy()))
+        table["traj"] = traj if table["traj"] is None else np.vstack((table["traj"], traj))
+        table["cost_s"] = np.concatenate((table["cost_s"], costs.run_s))
+        save_table(path, table, Z)
+    return table
+
+
+def save_table(path, table, Z=None):
+    arrays = {k: np.asarray(v) for k, v in table.items() if v is not None and k != "Z"}
+    if Z is not None or table.get("Z") is not None:
+        arrays["Z"] = np.asarray(Z if Z is not None else table["Z"])
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def load_table(path):
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def table_from_run(train_X, train_Y, fix_model, cost_s=None):
+    """Replay table from the evaluations of a finished BO run (e.g. train_X_final.npy, train_Y_final.npy)"""
+    X = np.asarray(train_X, dtype=np.float64)
+    traj = np.reshape(fix_model.decode(torch.from_numpy(X).float()).numpy(), (len(X), -1))
+    cost_s = np.zeros(len(X)) if cost_s is None else np.broadcast_to(cost_s, (len(X),)).astype(float)
+    return {"X": X, "Y": np.asarray(train_Y, dtype=np.float64).reshape(-1), "traj": traj, "cost_s": cost_s}
+
+
+class ReplayObjective:
+    """Objective with the signature of loss_obj answering from a replay table.
+
+    Args:
+        table: dict with the recorded trajectories ("traj"), values ("Y") and evaluation costs ("cost_s").
+        mode: "nearest" (value of the nearest recorded trajectory) or "idw" (inverse-distance weighting of
+            the k nearest ones).
+        k, power: neighbours and distance exponent of "idw".
+    The distance of every query to its nearest record and the charged cost are kept in `distances` and
+    `costs`.
+    """
+
+    def __init__(self, table, mode="nearest", k=4, power=2):
+        if mode not in ("nearest", "idw"):
+            raise ValueError("Unknown replay mode: {}".format(mode))
+        self.traj = np.asarray(table["traj"], dtype=np.float64)
+        self.Y = np.asarray(table["Y"], dtype=np.float64)
+        self.cost_s = np.asarray(table.get("cost_s", np.zeros(len(self.Y))), dtype=np.float64)
+        self.mode = mode
+        self.k = min(k, len(self.Y))
+        self.power = power
+        self.distances = []
+        self.costs = []
+
+    def __call__(self, X, *args, **kwargs):
+        traj = np.asarray(X, dtype=np.float64).reshape(1, -1)
+        # RMS distance between trajectories
+        d = np.sqrt(np.mean((self.traj - traj) ** 2, axis=1))
+        if self.mode == "nearest" or np.min(d) == 0:
+            idx = np.array([np.argmin(d)])
+            w = np.ones(1)
+        else:
+            idx = np.argpartition(d, self.k - 1)[:self.k]
+            w = 1.0 / d[idx] ** self.power
+        w = w / np.sum(w)
+        self.distances.append(float(np.min(d)))
+        self.costs.append(float(np.sum(w * self.cost_s[idx])))
+        return torch.tensor(float(np.sum(w * self.Y[idx])))
+
+
+def _iteration_eval_time(costs, n_workers):
+    # Wall time of evaluating `costs` on n_workers (each evaluation goes to the first free worker)
+    finish = np.zeros(max(1, n_workers))
+    for c in costs:
+        finish[np.argmin(finish)] += c
+    return float(np.max(finish)) if len(costs) else 0.0
+
+
+def replay_metrics(train_Y, costs, bo_records, target, tol=0.0, n_workers=1):
+    """Evaluations and simulated time to reach `target` - tol, from a replayed campaign.
+
+    The simulated time of an iteration is its measured BO machinery time (everything but the
+    evaluation) plus the recorded cost of its evaluations run on `n_workers`.
+    """
+    values = np.asarray(train_Y, dtype=np.float64).reshape(-1)
+    incumbent = np.maximum.accumulate(values)
+    reached = np.nonzero(incumbent >= target - tol)[0]
+    evals_to_target = int(reached[0]) + 1 if len(reached) else None
+
+    # Completion time of every evaluation
+    t, done, eval_times = 0.0, 0, []
+    for record in bo_records:
+        n = record.get("n_evals", 0)
+        overhead = record["iteration_s"] - record.get("evaluation_s", 0.0)
+        t = t + overhead + _iteration_eval_time(costs[done:done + n], n_workers)
+        eval_times.extend([t] * n)
+        done = done + n
+    time_to_target = eval_times[evals_to_target - 1] if evals_to_target is not None else None
+    return OrderedDict([
+        ("target", float(target)), ("best", float(incumbent[-1])), ("n_evals", len(values)),
+        ("evals_to_target", evals_to_target), ("time_to_target_s", time_to_target),
+        ("simulated_time_s", t), ("incumbent_curve", incumbent.tolist()),
+    ])
+
+
+def replay_campaign(table, decoder, Z, N=120, num_start=20, q=1, mode="nearest", k=4, tol=0.0, n_workers=1,
+                    plot=False, run_dir=None, verbose=False, **bo_kwargs):
+    """latentBO_KL on the replay table; returns the replay metrics with the BO wall time and phase summary"""
+    objective = ReplayObjective(table, mode, k)
+    num_rows = Z.shape[1]
+    run = run_latent_bo(Z, decoder, objective, num_rows, num_start, N, q, None, plot, run_dir, verbose,
+                        **bo_kwargs)
+    report = OrderedDict([("mode", mode), ("q", q), ("N", N), ("num_start", num_start)])
+    report.update(replay_metrics(run["train_Y"], objective.costs, run["bo_records"], np.max(table["Y"]), tol,
+                                 n_workers))
+    report.update([("bo_wall_s", run["wall_s"]), ("mean_iteration_s", run["mean_iteration_s"]),
+                   ("phases", run["phases"]), ("max_replay_distance", float(np.max(objective.distances)))])
+    return report
+
+
+def load_trajectory_decoder(path, num_traj=120):
+    """vae_traj (architecture of the driver, or the closed-form linear model) with the weights saved by the driver
+
+    A positive output transform saved next to the weights (latentbo_positive) is applied as well. The latent
+    dimension is read from the saved weights.
+    """
+    state = torch.load(path)
+    if "components" in state:
+        vae_traj = LinearTrajectoryModel()
+    else:
+        latent_dim = state["encoder_z.fc11.weight"].shape[0]
+        vae_traj = pv.models.iVAE((num_traj,), latent_dim=latent_dim, invariances=None, sampler_d="gaussian",
+                                  decoder_sig=.3, sigmoid_d=False, seed=0)
+    vae_traj.load_weights(path)
+    output = output_transform_file(path)
+    return vae_traj if output is None else PositiveTrajectoryModel(vae_traj, **output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--table", required=True, help="replay table (npz) written by record_table")
+    parser.add_argument("--decoder", required=True, help="vae_traj weights used for the recording")
+    parser.add_argument("--N", type=int, default=120)
+    parser.add_argument("--num-start", type=int, default=20)
+    parser.add_argument("--q", type=int, nargs="+", default=[1], help="batch sizes to compare")
+    parser.add_argument("--mode", nargs="+", choices=["nearest", "idw"], default=["nearest"])
+    parser.add_argument("--k", type=int, default=4, help="neighbours of the idw interpolation")
+    parser.add_argument("--tol", type=float, default=0.0, help="target is the best recorded value minus tol")
+    parser.add_argument("--n-workers", type=int, default=1, help="concurrent evaluations assumed for the time")
+    parser.add_argument("--out", default=REPLAY_REPORT)
+    args = parser.parse_args(argv)
+
+    table = load_table(args.table)
+    decoder = load_trajectory_decoder(args.decoder, table["traj"].shape[1])
+    Z = torch.from_numpy(table["Z"]).float()
+    reports = []
+    for mode in args.mode:
+        for q in args.q:
+            report = replay_campaign(table, decoder, Z, args.N, args.num_start, q, mode, args.k, args.tol,
+                                     args.n_workers)
+            reports.append(report)
+            time_to_target = report["time_to_target_s"]
+            print("mode {:<8s} q {:<3d}: evals to target {}, time to target {}, best {:.4g} (target {:.4g})".format(
+                mode, q, report["evals_to_target"],
+                "-" if time_to_target is None else "{:.1f} s".format(time_to_target),
+                report["best"], report["target"]))
+    with open(args.out, "w") as f:
+        json.dump({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "table": args.table, "campaigns": reports}, f,
+                  indent=2)
+    print("Report written to " + args.out)
+
+
+if __name__ == "__main__":
+    main()
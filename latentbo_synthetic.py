@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Synthetic test problem for end-to-end BO campaigns
+
+The real objective (loss_obj) trains a jiVAE for every evaluation, so testing a change of latentBO_KL
+takes hours. Here the objective is an analytic function of the decoded KL trajectory instead: a
+smooth two-mode similarity to target cooldown trajectories. The latent space comes from a small
+trajectory VAE trained in seconds on the same trajectory families as the driver, so the feasible
+region (decoded trajectory > 0) is as irregular as in the real problem. The objective has the
+signature of loss_obj and is plugged into the unchanged BO loop with latentBO_KL(..., objective=...).
+
+A campaign reports the wall time per BO phase (from the BO telemetry) and the simple regret, i.e. the
+gap between the best feasible candidate of the grid and the best evaluated point:
+    python latentbo_synthetic.py --N 120 --seeds 0 1 2
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import pyroved as pv
+
+from latentbo_candidates import latent_box_grid
+from latentbo_parametric import ParametricTrajectorySpace
+from latentbo_telemetry import read_jsonl, summarize_bo_log
+from latentbo_trajectories import NUM_TRAJ, cooldown_trajectories, periodic_trajectories, rescale
+
+CAMPAIGN_REPORT = "campaign_report.json"
+
+# Targets of the analytic objective: a sharp early cooldown (global optimum) and a late one (local optimum)
+TARGETS = cooldown_trajectories([40.0, 30.0], [2.0, 10.0], [60, 30], [10, 70]).numpy()
+TARGET_WEIGHTS = np.array([0.5, 0.3])
+TARGET_WIDTH = 8.0
+
+
+def synthetic_value(trajs):
+    """Objective of trajectories of shape (n, num_traj), vectorized (larger is better)"""
+    trajs = np.reshape(np.asarray(trajs, dtype=np.float64), (-1, 1, NUM_TRAJ))
+    rms = np.sqrt(np.mean((trajs - TARGETS[None]) ** 2, axis=-1))
+    return np.sum(TARGET_WEIGHTS * np.exp(-0.5 * (rms / TARGET_WIDTH) ** 2), axis=-1)
+
+
+def synthetic_obj(X, data, batch_size, B, H, W, discrete_dim, noise=0.0, **kwargs):
+    """Drop-in replacement of loss_obj: analytic objective of the trajectory X (other arguments unused)"""
+    value = synthetic_value(X)[0]
+    if noise > 0:
+        value = value + noise * np.random.randn()
+    return torch.tensor(value)
+
+
+def train_synthetic_decoder(n_samples=600, epochs=150, seed=0, verbose=False):
+    """Small trajectory VAE (same families and architecture as vae_traj), returns (model, latent means)"""
+    rng = np.random.RandomState(seed)
+    n1 = n_samples // 2
+    trajs = torch.vstack((cooldown_trajectories(np.linspace(50, 30, n1), np.linspace(5, 1, n1),
+                                                np.linspace(80, 1, n1), np.linspace(20, 1, n1)),
+                          rescale(periodic_trajectories(n_samples - n1, NUM_TRAJ, rng)))).float()
+    vae = pv.models.iVAE((NUM_TRAJ,), latent_dim=2, invariances=None, sampler_d="gaussian", decoder_sig=.3,
+                         sigmoid_d=False, seed=seed)
+    trainer = pv.trainers.SVItrainer(vae, lr=1e-3)
+    loader = pv.utils.init_dataloader(trajs.unsqueeze(1), batch_size=64)
+    for e in range(epochs):
+        trainer.step(loader)
+        if verbose and (e + 1) % 50 == 0:
+            trainer.print_statistics()
+    z_mean, _ = vae.encode(trajs.unsqueeze(1))
+    return vae, z_mean
+
+
+def latent_grid(z_mean, num_rows):
+    """Candidate grid spanning the encoded trajectories, as built by the driver"""
+    return latent_box_grid(z_mean, num_rows)
+
+
+def run_latent_bo(Z, decoder, objective, num_rows, num_start, N, q=1, obj_kwargs=None, plot=False, run_dir=None,
+                  verbose=False, **bo_kwargs):
+    """latentBO_KL with a cheap objective, run in `run_dir` (temporary if None) with its output silenced.
+
+    Returns a dict with train_X, train_Y, the wall time, the BO telemetry records and their phase summary.
+    """
+    from graphene_latentbo_jrvae_gpurun import latentBO_KL
+    with contextlib.ExitStack() as stack:
+        if run_dir is None:
+            run_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(run_dir, exist_ok=True)
+        run_dir = os.path.abspath(run_dir)
+        cwd = os.getcwd()
+        os.chdir(run_dir)
+        stack.callback(os.chdir, cwd)
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        bo_log = os.path.join(run_dir, "bo_telemetry.jsonl")
+        if os.path.exists(bo_log):
+            os.remove(bo_log)
+        t0 = time.perf_counter()
+        _, _, _, train_X, train_Y = latentBO_KL(Z, [10, 12, 70, 70, 10], None, decoder, num_rows, num_start, N,
+                                                q=q, obj_kwargs=obj_kwargs, bo_log=bo_log, objective=objective,
+                                                plot=plot, **bo_kwargs)
+        wall_s = time.perf_counter() - t0
+        n_iter, mean_iter_s, phases = summarize_bo_log(bo_log)
+        records = read_jsonl(bo_log)
+    return {"train_X": train_X, "train_Y": train_Y, "wall_s": wall_s, "n_iterations": n_iter,
+            "mean_iteration_s": mean_iter_s, "phases": phases, "bo_records": records}
+
+
+def run_campaign(N=120, num_start=20, num_rows=30, q=1, seed=0, decoder=None, noise=0.0, plot=False,
+                 run_dir=None, verbose=False, space="latent", param_rows=8):
+    """One complete latentBO_KL campaign on the synthetic objective.
+
+    Args:
+        decoder: (trajectory VAE, latent means) from train_synthetic_decoder (trained with `seed` if None).
+        space: "latent" (grid of num_rows x num_rows over the latent space of the decoder) or "parametric"
+            (param_rows values per cool-down parameter, latentbo_parametric).
+        run_dir: directory receiving the npy files, figures and BO log of the run (temporary if None).
+    Returns:
+        Report dict with the wall time, per-phase time breakdown, simple regret and incumbent curve.
+    """
+    from graphene_latentbo_jrvae_gpurun import getfeasible
+    if space == "parametric":
+        vae = ParametricTrajectorySpace()
+        num_rows = param_rows
+        Z = vae.grid(num_rows)
+    else:
+        vae, z_mean = train_synthetic_decoder(seed=seed) if decoder is None else decoder
+        Z = latent_grid(z_mean, num_rows)
+
+    # Best feasible candidate of the grid (the BO searches the same candidate set)
+    X_feas = getfeasible(Z, vae)
+    f_star = float(np.max(synthetic_value(vae.decode(X_feas.float()).numpy())))
+
+    run = run_latent_bo(Z, vae, synthetic_obj, num_rows, num_start, N, q, {"noise": noise}, plot, run_dir, verbose)
+
+    # Regret of the noise-free objective of the evaluated points
+    values = synthetic_value(vae.decode(run["train_X"].float()).numpy())
+    incumbent = np.maximum.accumulate(values)
+    return OrderedDict([
+        ("space", space), ("seed", seed), ("N", N), ("num_start", num_start), ("num_rows", num_rows), ("q", q),
+        ("n_feasible", len(X_feas)), ("n_evals", len(run["train_Y"])), ("n_iterations", run["n_iterations"]),
+        ("wall_s", run["wall_s"]), ("mean_iteration_s", run["mean_iteration_s"]), ("phases", run["phases"]),
+        ("f_star", f_star), ("best", float(incumbent[-1])), ("simple_regret", f_star - float(incumbent[-1])),
+        ("regret_curve", (f_star - incumbent).tolist()),
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--N", type=int, default=120, help="BO iterations")
+    parser.add_argument("--num-start", type=int, default=20)
+    parser.add_argument("--num-rows", type=int, default=30, help="candidate grid is num_rows x num_rows")
+    parser.add_argument("--q", type=int, default=1, help="candidates per BO iteration")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0], help="one campaign (and decoder) per seed")
+    parser.add_argument("--noise", type=float, default=0.0, help="std of Gaussian observation noise")
+    parser.add_argument("--plot", action="store_true", help="save the iteration figures (slow)")
+    parser.add_argument("--space", choices=["latent", "parametric"], default="latent", help="BO search space")
+    parser.add_argument("--param-rows", type=int, default=8, help="grid values per parameter (parametric space)")
+    parser.add_argument("--out", default=CAMPAIGN_REPORT)
+    args = parser.parse_args(argv)
+
+    campaigns = []
+    for seed in args.seeds:
+        report = run_campaign(args.N, args.num_start, args.num_rows, args.q, seed, noise=args.noise,
+                              plot=args.plot, space=args.space, param_rows=args.param_rows)
+        campaigns.append(report)
+        print("seed {}: {} evaluations in {:.1f} s ({:.3f} s per iteration), simple regret {:.4g}".format(
+            seed, report["n_evals"], report["wall_s"], report["mean_iteration_s"], report["simple_regret"]))
+        for name, s in report["phases"].items():
+            print("  {:<16s} mean {:9.4f} s  {:5.1f} %".format(name, s["mean_s"], 100 * s["share"]))
+    with open(args.out, "w") as f:
+        json.dump({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "campaigns": campaigns}, f, indent=2)
+    print("Mean simple regret {:.4g}, mean wall time {:.1f} s; report written to {}".format(
+        np.mean([c["simple_regret"] for c in campaigns]), np.mean([c["wall_s"] for c in campaigns]), args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""Lightweight timing instrumentation written as JSON lines
+
+PhaseTimer splits one objective evaluation (loss_obj) into its phases - dataloader setup, jiVAE
+construction, the epoch loop (with per-epoch step times), manifold2d generation, inter-class SSIM and
+intra-class SSIM - and appends one record per evaluation to a JSON-lines file. When no log file is
+given, NULL_TIMER is used instead; its methods do nothing, so the instrumentation stays in the code
+at near-zero cost.
+
+BOTelemetry does the same for the iterations of latentBO_KL: GP fit time and final MLL, posterior,
+acquisition, evaluation wall time, queue wait of parallel evaluations and plotting, with a rolling
+estimate of the time left for the remaining budget.
+
+Summarize a log (either kind) with:
+    python latentbo_telemetry.py loss_obj_phases.jsonl bo_telemetry.jsonl
+"""
+
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+
+def append_jsonl(path, record):
+    """Append one record to a JSON-lines file (a single write, so concurrent workers do not interleave)"""
+    line = json.dumps(record, default=float) + "\n"
+    with open(path, "a") as f:
+        f.write(line)
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class PhaseTimer:
+    """Accumulates wall time per named phase of one evaluation.
+
+    Args:
+        log_path: JSON-lines file the record is appended to by emit().
+        keep_steps: phases whose individual step times are kept in the record (e.g. "epoch").
+    Examples:
+        >>> timer = PhaseTimer("loss_obj_phases.jsonl")
+        >>> for e in range(num_epochs):
+        >>>     with timer.phase("epoch"):
+        >>>         trainer.step(train_loader)
+        >>> timer.emit(objective=obj)
+    """
+    enabled = True
+
+    def __init__(self, log_path, keep_steps=("epoch",)):
+        self.log_path = log_path
+        self.keep_steps = set(keep_steps)
+        self.totals = OrderedDict()
+        self.counts = {}
+        self.steps = {name: [] for name in self.keep_steps}
+        self.t_start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            self.totals[name] = self.totals.get(name, 0.0) + dt
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if name in self.steps:
+                self.steps[name].append(dt)
+
+    def record(self, **fields):
+        """Phase totals, counts and step times collected so far (plus any extra fields)"""
+        phases = OrderedDict()
+        for name, total in self.totals.items():
+            phases[name] = {"total_s": total, "count": self.counts[name]}
+            steps = self.steps.get(name)
+            if steps:
+                phases[name].update({"mean_s": float(np.mean(steps)), "max_s": float(np.max(steps)),
+                                     "steps_s": steps})
+        record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "pid": os.getpid(),
+                  "wall_s": time.perf_counter() - self.t_start}
+        record.update(fields)
+        record["phases"] = phases
+        return record
+
+    def emit(self, **fields):
+        record = self.record(**fields)
+        append_jsonl(self.log_path, record)
+        return record
+
+
+class _NullTimer:
+    """Stand-in for PhaseTimer when instrumentation is disabled"""
+    enabled = False
+    _null = nullcontext()
+
+    def phase(self, name):
+        return self._null
+
+    def record(self, **fields):
+        return None
+
+    def emit(self, **fields):
+        return None
+
+
+NULL_TIMER = _NullTimer()
+
+
+def phase_timer(log_path=None, **kwargs):
+    """PhaseTimer writing to `log_path`, or the no-op NULL_TIMER when `log_path` is None"""
+    return NULL_TIMER if log_path is None else PhaseTimer(log_path, **kwargs)
+
+
+def format_duration(seconds):
+    """h:mm:ss (hours are not wrapped at 24)"""
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class BOTelemetry:
+    """Per-iteration time breakdown of the BO loop with a rolling ETA.
+
+    Args:
+        log_path: JSON-lines file receiving one record per iteration (iteration 0 is the initial design).
+        N: BO budget (number of iterations), used for the ETA.
+        window: number of recent iterations averaged for the ETA.
+        verbose: print a one-line summary per iteration.
+    """
+    enabled = True
+
+    def __init__(self, log_path, N, window=10, verbose=True):
+        self.log_path = log_path
+        self.N = N
+        self.window = window
+        self.verbose = verbose
+        self.iter_times = []
+        self.current = None
+        self.t_iter = None
+
+    def start_iteration(self, i):
+        self.current = OrderedDict([("iteration", i)])
+        self.t_iter = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = name + "_s"
+            self.current[key] = self.current.get(key, 0.0) + time.perf_counter() - t0
+
+    def set(self, **fields):
+        self.current.update(fields)
+
+    def add_evaluation(self, run_s, queue_wait_s=0.0, profiled=False):
+        """One objective evaluation: its run time and (parallel only) the wait for a free worker"""
+        self.current["n_evals"] = self.current.get("n_evals", 0) + 1
+        self.current["eval_run_s"] = self.current.get("eval_run_s", 0.0) + run_s
+        self.current["queue_wait_s"] = self.current.get("queue_wait_s", 0.0) + queue_wait_s
+
+    def end_iteration(self):
+        record = self.current
+        record["iteration_s"] = time.perf_counter() - self.t_iter
+        if record["iteration"] > 0:
+            # The initial design is not representative of a BO iteration, keep it out of the ETA
+            self.iter_times.append(record["iteration_s"])
+        recent = self.iter_times[-self.window:]
+        remaining = self.N - record["iteration"]
+        record["eta_s"] = float(np.mean(recent)) * remaining if recent else None
+        record["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        append_jsonl(self.log_path, record)
+        if self.verbose:
+            print(self.format(record))
+        self.current = None
+        return record
+
+    def format(self, record):
+        parts = ["{} {:.2f} s".format(k[:-2], v) for k, v in record.items()
+                 if k.endswith("_s") and k not in ("iteration_s", "eta_s") and v is not None]
+        eta = "" if record["eta_s"] is None else ", ETA " + format_duration(record["eta_s"])
+        return "BO iteration {}/{}: {:.2f} s ({}){}".format(record["iteration"], self.N, record["iteration_s"],
+                                                           ", ".join(parts), eta)
+
+
+class _NullBOTelemetry:
+    """Stand-in for BOTelemetry when the BO log is disabled"""
+    enabled = False
+    _null = nullcontext()
+
+    def start_iteration(self, i):
+        pass
+
+    def phase(self, name):
+        return self._null
+
+    def set(self, **fields):
+        pass
+
+    def add_evaluation(self, run_s, queue_wait_s=0.0, profiled=False):
+        pass
+
+    def end_iteration(self):
+        return None
+
+
+NULL_BO_TELEMETRY = _NullBOTelemetry()
+
+
+class EvaluationCosts:
+    """Wraps a BO telemetry and also keeps the run time of every objective evaluation, in evaluation order
+    (the training data of the cost model of latentBO_KL); profiled evaluations, slowed down by the profiler,
+    are kept as NaN"""
+
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.run_s = []
+
+    def add_evaluation(self, run_s, queue_wait_s=0.0, profiled=False):
+        self.run_s.append(float("nan") if profiled else run_s)
+        self.telemetry.add_evaluation(run_s, queue_wait_s, profiled)
+
+    def __getattr__(self, name):
+        return getattr(self.telemetry, name)
+
+
+def bo_telemetry(log_path=None, N=0, **kwargs):
+    """BOTelemetry writing to `log_path`, or the no-op NULL_BO_TELEMETRY when `log_path` is None"""
+    return NULL_BO_TELEMETRY if log_path is None else BOTelemetry(log_path, N, **kwargs)
+
+
+def summarize_phase_log(path):
+    """Mean/max wall time and share of each phase over all evaluations in a phase log"""
+    records = read_jsonl(path)
+    names = list(OrderedDict.fromkeys(name for r in records for name in r["phases"]))
+    wall = np.array([r["wall_s"] for r in records])
+    summary = OrderedDict()
+    for name in names:
+        totals = np.array([r["phases"].get(name, {}).get("total_s", 0.0) for r in records])
+        summary[name] = {"mean_s": float(totals.mean()), "max_s": float(totals.max()),
+                         "share": float(totals.sum() / wall.sum())}
+    return len(records), float(wall.mean()), summary
+
+
+def summarize_bo_log(path):
+    """Mean/max time and share of each phase over the BO iterations (initial design excluded)"""
+    records = [r for r in read_jsonl(path) if r["iteration"] > 0]
+    total = sum(r["iteration_s"] for r in records)
+    names = list(OrderedDict.fromkeys(k for r in records for k in r
+                                      if k.endswith("_s") and k not in ("iteration_s", "eta_s")))
+    summary = OrderedDict()
+    for name in names:
+        values = np.array([r.get(name, 0.0) for r in records])
+        summary[name[:-2]] = {"mean_s": float(values.mean()), "max_s": float(values.max()),
+                              "share": float(values.sum() / total)}
+    return len(records), total / max(len(records), 1), summary
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    for path in argv:
+        if "iteration" in read_jsonl(path)[0]:
+            n, mean_iter, summary = summarize_bo_log(path)
+            print("{}: {} BO iterations, mean iteration time {:.2f} s".format(path, n, mean_iter))
+            for name, s in summary.items():
+                print("  {:<16s} mean {:9.3f} s  max {:9.3f} s  {:5.1f} %".format(
+                    name, s["mean_s"], s["max_s"], 100 * s["share"]))
+            continue
+        n, mean_wall, summary = summarize_phase_log(path)
+        print("{}: {} evaluations, mean wall time {:.2f} s".format(path, n, mean_wall))
+        for name, s in summary.items():
+            print("  {:<16s} mean {:9.3f} s  max {:9.3f} s  {:5.1f} %".format(
+                name, s["mean_s"], s["max_s"], 100 * s["share"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Vectorized library of the synthetic KL trajectories used to pretrain vae_traj
+
+The drivers built the pretraining set sample by sample (functional 1 element by element, one scipy
+interp1d per piecewise-linear sample, one func_periodic call per periodic sample). Here every
+functional is generated for all samples at once with broadcasted numpy operations:
+    functional 1  cooldown_trajectories  hold at start for `timeout` steps, then cool linearly to stop
+    functional 2  segment_trajectories   random piecewise-linear curves (batched interpolation)
+    functional 3  periodic_trajectories  damped/growing oscillations
+trajectory_library() assembles the pretraining set of the drivers, StreamingTrajectories draws fresh
+trajectories from the functionals every epoch instead. Random draws come from `rng`
+(default: the global np.random state); functionals 1 and 2 reproduce the original loops (up to float
+rounding), functional 3 draws its parameters in a different order, i.e. from the same distributions.
+"""
+
+import numpy as np
+import torch
+
+NUM_TRAJ = 120
+
+
+def cooldown_trajectories(start, stop, coolrate, timeout, num_traj=NUM_TRAJ):
+    """Functional 1: `start` for round(timeout) steps, then linspace(start, stop, round(coolrate)), then held.
+
+    The control parameters are scalars or arrays of length n; returns a float64 tensor (n, num_traj).
+    """
+    start, stop, coolrate, timeout = [torch.as_tensor(v, dtype=torch.float64).reshape(-1, 1)
+                                      for v in (start, stop, coolrate, timeout)]
+    steps = torch.arange(num_traj, dtype=torch.float64).reshape(1, -1)
+    timeout, coolrate = torch.round(timeout), torch.round(coolrate)
+    frac = torch.clamp((steps - timeout) / torch.clamp(coolrate - 1, min=1), 0, 1)
+    # A cool-down of a single step is linspace(start, stop, 1) = [start]: the trajectory never leaves start
+    frac = torch.where(coolrate <= 1, torch.zeros_like(frac), frac)
+    return start + (stop - start) * frac
+
+
+def interp_rows(x, xp, fp):
+    """Piecewise-linear interpolation of every row: x (m,) on the sorted breakpoints xp (n, k) with values fp (n, k)"""
+    x = np.asarray(x, dtype=np.float64)[None, :]
+    # Segment of every point: number of inner breakpoints at or left of it
+    idx = np.sum(x[:, :, None] >= xp[:, None, 1:-1], axis=-1)
+    x0, x1 = np.take_along_axis(xp, idx, 1), np.take_along_axis(xp, idx + 1, 1)
+    y0, y1 = np.take_along_axis(fp, idx, 1), np.take_along_axis(fp, idx + 1, 1)
+    return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+
+def segment_trajectories(degree, nsamples, num_traj=NUM_TRAJ, rng=np.random):
+    """Functional 2 (generate_1Dspectra_Segment): `degree` random inner breakpoints on [-1, 1], random values.
+
+    Returns (dataset (n, num_traj) float32, breakpoints (n, degree + 2), slopes (n, degree + 1)).
+    """
+    # Same stream as the per-sample loop: degree breakpoints, then degree + 2 values for every sample
+    draws = rng.uniform(0, 1, (nsamples, 2 * degree + 2))
+    inner = np.sort(2 * draws[:, :degree] - 1, axis=1)
+    segment_x = np.hstack((-np.ones((nsamples, 1)), inner, np.ones((nsamples, 1))))
+    segment_y = draws[:, degree:]
+    slopes = np.diff(segment_y, axis=1) / np.diff(segment_x, axis=1)
+    x = np.linspace(-1, 1, num_traj)
+    dataset = interp_rows(x, segment_x, segment_y)
+    return torch.from_numpy(dataset).float(), torch.from_numpy(segment_x), torch.from_numpy(slopes)
+
+
+def periodic_trajectories(nsamples, num_traj=NUM_TRAJ, rng=np.random):
+    """Functional 3 (func_periodic): A exp(alpha x) cos(omega x) + B x on [0, 2], each sample scaled to [-1, 1]"""
+    x = np.linspace(0, 2, num_traj)
+    A = rng.lognormal(1, 1, (nsamples, 1))
+    alpha = rng.uniform(-2, 2, (nsamples, 1))
+    omega = rng.uniform(8, 14, (nsamples, 1))
+    B = rng.uniform(-1, 1, (nsamples, 1))
+    y = A * np.exp(alpha * x) * np.cos(omega * x) + B * x
+    y_min, y_max = y.min(axis=1, keepdims=True), y.max(axis=1, keepdims=True)
+    return torch.from_numpy(2 * (y - y_min) / (y_max - y_min) - 1)
+
+
+def rescale(traj, low=1, high=50):
+    """Global min-max rescaling to [low, high] (range of functional 1)"""
+    return (traj - traj.min()) / (traj.max() - traj.min()) * (high - low) + low
+
+
+def trajectory_library(num_samples=(2500, 2500, 2500), num_traj=NUM_TRAJ, degree=2, rng=np.random):
+    """Pretraining set of the drivers: functionals 1-3 stacked, functionals 2 and 3 rescaled to [1, 50]
+
+    Functional 1 sweeps its control parameters (start 50->30, stop 5->1, cool rate 80->1, time-out 20->1).
+    Returns a float32 tensor (sum(num_samples), num_traj).
+    """
+    n1, n2, n3 = num_samples
+    traj1 = cooldown_trajectories(torch.linspace(50, 30, n1), torch.linspace(5, 1, n1), torch.linspace(80, 1, n1),
+                                  torch.linspace(20, 1, n1), num_traj)
+    traj2, _, _ = segment_trajectories(degree, n2, num_traj, rng)
+    traj3 = periodic_trajectories(n3, num_traj, rng)
+    return torch.vstack((traj1.float(), rescale(traj2), rescale(traj3).float()))
+
+
+def random_cooldown(nsamples, num_traj=NUM_TRAJ, rng=np.random):
+    """Functional 1 with independently drawn control parameters (the library sweeps them jointly)"""
+    return cooldown_trajectories(rng.uniform(30, 50, nsamples), rng.uniform(1, 5, nsamples),
+                                 rng.uniform(1, 80, nsamples), rng.uniform(1, 20, nsamples), num_traj)
+
+
+def exponential_cooldown(nsamples, num_traj=NUM_TRAJ, rng=np.random):
+    """Hold at start for `timeout` steps, then relax exponentially towards stop with a random time constant"""
+    start, stop = rng.uniform(30, 50, (nsamples, 1)), rng.uniform(1, 5, (nsamples, 1))
+    timeout, tau = np.round(rng.uniform(1, 20, (nsamples, 1))), rng.uniform(2, 40, (nsamples, 1))
+    steps = np.arange(num_traj)[None, :]
+    return torch.from_numpy(stop + (start - stop) * np.exp(-np.clip(steps - timeout, 0, None) / tau))
+
+
+# The global rescaling of functionals 2 and 3 to [1, 50] is fixed in the stream: their values span [0, 1] and
+# [-1, 1] by construction
+def _scaled_segment(nsamples, num_traj=NUM_TRAJ, rng=np.random):
+    return segment_trajectories(2, nsamples, num_traj, rng)[0].double() * 49 + 1
+
+
+def _scaled_periodic(nsamples, num_traj=NUM_TRAJ, rng=np.random):
+    return (periodic_trajectories(nsamples, num_traj, rng) + 1) * 24.5 + 1
+
+
+# Functionals of the streaming dataset: fn(nsamples, num_traj, rng) -> (nsamples, num_traj) on the [1, 50] scale
+FUNCTIONALS = {
+    "cooldown": random_cooldown,
+    "segment": _scaled_segment,
+    "periodic": _scaled_periodic,
+    "exponential": exponential_cooldown,
+}
+
+
+class StreamingTrajectories(torch.utils.data.IterableDataset):
+    """Fresh trajectories every epoch, generated batch by batch (constant memory, no upfront generation).
+
+    Every batch is drawn with its own generator seeded by (seed, epoch, batch index), so the stream is
+    reproducible and does not depend on the number of DataLoader workers; the workers split the batches
+    of an epoch. Call set_epoch() before each epoch to draw new trajectories.
+
+    Args:
+        samples_per_epoch: trajectories per epoch (len() of the dataset, as used by SVItrainer).
+        weights: {functional name: weight} of the mixture, names from FUNCTIONALS or `functionals`.
+        functionals: additional generators fn(nsamples, num_traj, rng) on the [1, 50] scale.
+        transform: optional function applied to every yielded batch (e.g. the inverse output transform of
+            latentbo_positive).
+    """
+
+    def __init__(self, samples_per_epoch=7500, batch_size=64, num_traj=NUM_TRAJ, weights=None, seed=0,
+                 functionals=None, transform=None):
+        self.samples_per_epoch = samples_per_epoch
+        self.batch_size = batch_size
+        self.num_traj = num_traj
+        self.functionals = dict(FUNCTIONALS, **(functionals or {}))
+        weights = weights or {"cooldown": 1, "segment": 1, "periodic": 1}
+        self.names = sorted(weights)
+        p = np.array([weights[name] for name in self.names], dtype=np.float64)
+        self.p = p / p.sum()
+        self.seed = seed
+        self.transform = transform
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.samples_per_epoch
+
+    def batch(self, index, size=None, epoch=None):
+        """Trajectories (size, num_traj) of batch `index` of `epoch`, in random functional order"""
+        epoch = self.epoch if epoch is None else epoch
+        rng = np.random.default_rng([self.seed, epoch + 1, index])
+        counts = rng.multinomial(size or self.batch_size, self.p)
+        traj = torch.vstack([self.functionals[name](n, self.num_traj, rng).float()
+                             for name, n in zip(self.names, counts) if n > 0])
+        return traj[torch.from_numpy(rng.permutation(len(traj)))]
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        n_workers, worker_id = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        n_batches = -(-self.samples_per_epoch // self.batch_size)
+        for index in range(worker_id, n_batches, n_workers):
+            size = min(self.batch_size, self.samples_per_epoch - index * self.batch_size)
+            # One-element tuple as yielded by the TensorDataset loaders (VAE mode of SVItrainer)
+            traj = self.batch(index, size)
+            yield ((traj if self.transform is None else self.transform(traj)).unsqueeze(1),)
+
+
+def streaming_loader(dataset, num_workers=0, prefetch=2):
+    """DataLoader over a StreamingTrajectories; each worker keeps at most `prefetch` batches ready"""
+    kwargs = {"num_workers": num_workers}
+    if num_workers > 0:
+        kwargs.update(prefetch_factor=prefetch, persistent_workers=False)
+    return torch.utils.data.DataLoader(dataset, batch_size=None, **kwargs)
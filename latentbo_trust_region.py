@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Trust-region local search mode of the latent BO (TuRBO-style)
+
+The global candidate grid of latentBO_KL caps the resolution at its spacing, and refining it globally
+costs num_rows ** d posterior evaluations. With trust_region=True the candidates of every iteration
+are instead a Sobol sample of a box centred on the best evaluated point (in the normalized latent
+box), with side lengths weighted by the GP lengthscales. The box doubles after `success_tolerance`
+consecutive improving iterations and halves after `failure_tolerance` non-improving ones; once it
+has shrunk below `length_min` it is reset to its initial size (restart). The candidate count per
+iteration stays fixed while the effective resolution follows the box down to the incumbent.
+"""
+
+import math
+
+import torch
+
+
+class TrustRegion:
+    """State of the trust region: side length and success/failure counters (Eriksson et al., TuRBO)"""
+
+    def __init__(self, dim, q=1, length=0.8, length_min=0.5 ** 7, length_max=1.6, success_tolerance=3,
+                 failure_tolerance=None):
+        self.dim = dim
+        self.length_init, self.length_min, self.length_max = length, length_min, length_max
+        self.success_tolerance = success_tolerance
+        self.failure_tolerance = failure_tolerance or math.ceil(max(4.0 / q, float(dim) / q))
+        self.length = length
+        self.n_success = self.n_failure = self.n_restarts = 0
+
+    def update(self, best_before, best_after):
+        """Expand or shrink the box after an iteration that moved the best value from best_before to best_after"""
+        if best_after > best_before + 1e-3 * abs(best_before):
+            self.n_success, self.n_failure = self.n_success + 1, 0
+        else:
+            self.n_success, self.n_failure = 0, self.n_failure + 1
+        if self.n_success == self.success_tolerance:
+            self.length, self.n_success = min(2.0 * self.length, self.length_max), 0
+        elif self.n_failure == self.failure_tolerance:
+            self.length, self.n_failure = self.length / 2.0, 0
+        if self.length < self.length_min:
+            self.length, self.n_restarts = self.length_init, self.n_restarts + 1
+
+    def bounds(self, center, lengthscale=None):
+        """Box (low, high) around the normalized point center, clipped to [0, 1]^d"""
+        center = torch.as_tensor(center, dtype=torch.float64).reshape(-1)
+        weights = torch.ones_like(center)
+        if lengthscale is not None:
+            # Longer sides along the directions in which the GP varies slowly, same volume as the cube
+            weights = torch.as_tensor(lengthscale, dtype=torch.float64).detach().reshape(-1)
+            weights = weights / torch.exp(torch.mean(torch.log(weights)))
+        half = weights * self.length / 2.0
+        return torch.clamp(center - half, 0, 1), torch.clamp(center + half, 0, 1)
+
+    def candidates(self, center, n, lengthscale=None, feasible=None, lower=None, span=None, seed=0):
+        """Feasible normalized candidates (<= n, d): Sobol points of the box whose latent points z = lower + span * x
+        pass feasible(z) -> boolean mask (None: every point is feasible), e.g. feasible_mask with the decoder"""
+        low, high = self.bounds(center, lengthscale)
+        sobol = torch.quasirandom.SobolEngine(self.dim, scramble=True, seed=seed)
+        x = low + (high - low) * sobol.draw(n, dtype=torch.float64)
+        if feasible is not None:
+            x = x[feasible(lower + span * x)]
+        return x
+
+    def describe(self):
+        return {"tr_length": self.length, "tr_restarts": self.n_restarts}
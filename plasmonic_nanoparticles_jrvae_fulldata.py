@@ -108,6 +108,11 @@ from smt.sampling_methods import LHS
 from skimage.transform import rescale, resize, downscale_local_mean
 from skimage.transform import SimilarityTransform
 
+from latentbo_profiling import MemoryTracker, install_memory_tracker, memory_begin, memory_end
+
+#High-water mark of the memory per stage (data prep, balancing, training, plotting), written to memory.jsonl
+memory_tracker = install_memory_tracker(MemoryTracker("memory.jsonl", use_tracemalloc=True))
+
 #@title Helper functions
 
 def func_periodic(x, params):
@@ -415,6 +420,7 @@ cluster_info = np.load("plasmonic_labels.npy")
 #        data[i, j, k] = 0
 
 #Data Manipulation- We normalize the data
+memory_begin("data_normalization")
 data = np.zeros((imstack.shape))
 for i in range(0, len(imstack)):
   normdata = (imstack[i,:,:]-np.min(imstack[i,:,:]))/(np.max(imstack[i,:,:]) - np.min(imstack[i,:,:]))
@@ -424,6 +430,7 @@ data = np.reshape(data, (data.shape[0], 1, data.shape[1], data.shape[2]))
 data = torch.from_numpy(data)
 train_data = data.float()
 print(train_data.shape,cluster_info.shape)
+memory_end("data_normalization")
 
 labels=cluster_info
 for i in np.unique(labels):
@@ -446,6 +453,7 @@ print(noise.shape)
 """# Now consider full data - 7 labels"""
 
 #@title Augment dataset (balanced data for all labels)
+memory_begin("dataset_balancing")
 n_datapoints = 5000
 #Adding synthetic data (noise)
 #Class 1
@@ -535,12 +543,14 @@ idx= np.random.choice(len(train_syndata_full), len(train_syndata_full), replace=
 train_syndata_full = train_syndata_full[idx]
 labels_syndata_full = labels_syndata_full[idx]
 print(train_syndata_full.shape, labels_syndata_full.shape)
+memory_end("dataset_balancing")
 
 # Check if the data is balanced now
 for i in np.unique(labels_syndata_full):
     print("class {}, # of samples {}".format(i, len(labels_syndata_full[labels_syndata_full==i])))
 
 #Considering all labels
+memory_begin("plotting")
 fig, axes = plt.subplots(20, 20, figsize=(20, 20),
                          subplot_kw={'xticks':[], 'yticks':[]},
                          gridspec_kw=dict(hspace=0.1, wspace=0.1))
@@ -554,6 +564,7 @@ for ax, im, lbl in zip(axes.flat, train_syndata_full, labels_syndata_full):
 
 plt.savefig('TD_plasmonic.png')
 plt.show()
+memory_end("plotting")
 
 """# A sample KL traj obtained from BO optimization (earlier done)"""
 
@@ -578,6 +589,7 @@ W = 96
 discrete_dim = 7
 kl_d = 0.01
 
+memory_begin("jivae_training")
 train_loader_full = pv.utils.init_dataloader(train_syndata_full, batch_size=64)
 
 # Input data dimensions
@@ -610,8 +622,12 @@ for e in range(200):
             jvae_full.manifold_traversal(12, i, cmap='viridis')
             plt.savefig('Manifold' +str(i) +'iter' + str(e+1) +'.png')
             plt.show()
+memory_end("jivae_training")
 
+memory_begin("plotting")
 for i in range(discrete_dim):
     jvae_full.manifold2d(d=B, disc_idx=i, cmap='viridis')
     plt.savefig('Trained_Manifold' +str(i+1) +'.png')
-    plt.show()
\ No newline at end of file
+    plt.show()
+memory_end("plotting")
+memory_tracker.report()
\ No newline at end of file
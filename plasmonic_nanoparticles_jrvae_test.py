@@ -81,7 +81,6 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 from torch.optim import SGD
 from torch.optim import Adam
 from scipy.stats import norm
-from scipy.interpolate import interp1d
 
 import atomai as aoi
 
@@ -91,48 +90,10 @@ import ipywidgets as widgets
 import pandas as pd
 from skimage.transform import rescale, resize, downscale_local_mean
 from skimage.transform import SimilarityTransform
-#%matplotlib inline
-
-#@title Helper functions
-
-def func_periodic(x, params):
-    y = params["A"] * np.exp(params["alpha"] * x) * np.cos(params["omega"] * x) + params["B"] * x
-    return y
-
-def generate_1Dspectra_Segment(degree, nsamples) -> torch.Tensor:
-   
-    dataset = []
-    points = []
-    slopes = []
-
-    for i in range(nsamples):
-
-        x = np.linspace(-1, 1, 120)
-        segment_x = np.array([-1]+list(sorted(np.random.uniform(-1, 1, degree)))+[1])
-        segment_y = np.random.uniform(0, 1, degree+2)
-        points.append(torch.from_numpy(segment_x))
-
-        slope = np.zeros(degree+1)
-        for j in range(len(slope)):
-          slope[j] = (segment_y[j+1]-segment_y[j])/(segment_x[j+1]-segment_x[j])
-        slope = torch.from_numpy(slope)
 
-        f2 = interp1d(segment_x, segment_y, kind='linear')
-        f2 = f2(x)
-        f2 = torch.from_numpy(f2).type(torch.float)
-        #noise = torch.randint(0, 50, (1,)) / 1e3
-        noise = 0 # no noise
-
-        data_t = f2 + noise * torch.randn(size=(len(x),))
-        dataset.append(data_t)
-        slopes.append(slope)
-
-    dataset = torch.cat(dataset).reshape(nsamples,120)
-    points = torch.cat(points).reshape(nsamples, degree+2)
-    slopes = torch.cat(slopes).reshape(nsamples, degree+1)
-
-    # dataset = (dataset - dataset.min()) / (dataset.max() - dataset.min())
-    return dataset, points, slopes
+from latentbo_pretrain import pretrain_trajectory_vae
+from latentbo_trajectories import trajectory_library
+#%matplotlib inline
 
   # Utility functions for plasmonic image analysis
   #@title Customize Function
@@ -919,92 +880,19 @@ With these, we
 
 #Prepare training data to fit trajectory in a VAE model
 
+# Seed both generators so that the trajectories (and thus the pretrained vae_traj) are reproducible
 torch.manual_seed(100)
+np.random.seed(100)
 num_samples1 = 2500
 num_samples2 = 2500
 num_samples3 = 2500
 #num_samples4 = 2000
 num_traj = 120
 
-#########Sampled trajectories defined from functional 1
-traj_sampled1 = torch.empty((num_samples1, num_traj))
-#Control parameters for defining KL trajectories -defined from functional 1
-X_start = torch.linspace(50, 30, num_samples1)
-X_stop = torch.linspace(5, 1, num_samples1)
-X_coolrate = torch.linspace(80, 1, num_samples1)
-X_timeout = torch.linspace(20, 1, num_samples1)
-
-X= torch.vstack((X_start, X_stop, X_coolrate, X_timeout))
-X= torch.transpose(X, 0, 1)
-#print(X.shape)
-
-for j in range(num_samples1):
-    kl_scale_sampled = torch.cat(
-        [torch.ones(int(np.round(X_timeout[j])),) * X_start[j],  # put pressure on the continuous latent channel at the beginning
-        torch.linspace(X_start[j], X_stop[j], int(np.round(X_coolrate[j])))]  # gradually release the pressure
-    )
-
-    #Consider trajectory of 120 dimensions- defined by 4 variables (4D) in the real space
-    for i in range(num_traj):
-        traj_sampled1[j, i] = kl_scale_sampled[i] if i < len(kl_scale_sampled) else kl_scale_sampled[-1]
-
-
-print(traj_sampled1.shape)
-
-#########Sampled trajectories defined from functional 2
-traj_sampled2, points, slopes = generate_1Dspectra_Segment(2, num_samples2)
-
-#print(traj_sampled2.shape)
-#Rescaling to similar sample data defined from func 1
-traj_sampled2 = traj_sampled2.detach().numpy()
-
-traj_sampled22 = np.reshape(traj_sampled2, num_samples2*num_traj)
-#print(traj_sampled2.shape, traj_sampled22.shape)
-
-traj_sampled22_norm = (traj_sampled22- np.min(traj_sampled22)) / (np.max(traj_sampled22) - np.min(traj_sampled22))
-traj_sampled22_scaled = traj_sampled22_norm*(50-1) + 1
-#print(traj_sampled22_scaled.shape, np.min(traj_sampled22_scaled), np.max(traj_sampled22_scaled))
-
-traj_sampled22_scaled = np.reshape(traj_sampled22_scaled, (num_samples2, num_traj))
-traj_sampled22_scaled = torch.from_numpy(traj_sampled22_scaled)
-traj_sampled2 = torch.from_numpy(traj_sampled2)
-#print(traj_sampled22_scaled.shape, traj_sampled2.shape)
-
-####################Sampled trajs defined from functional 3
-params = lambda: {"A": np.random.lognormal(1, 1),
-                  "alpha": np.random.uniform(-2, 2),
-                  "omega": np.random.uniform(8, 14),
-                  "B": np.random.uniform(-1, 1)}
-
-traj_sampled3 = np.zeros((num_samples3, num_traj))
-n_traj3 = np.linspace(0, 2, num_traj)
-for i in range(num_samples3):
-    y = func_periodic(n_traj3, params())
-    y = 2 * ((y - y.min()) / y.ptp()) - 1
-    traj_sampled3[i,:] = y
-#traj_sampled3 = np.array(traj_sampled3, dtype=np.float32)
-print(traj_sampled3.shape)
-#Rescaling to similar sample data defined from func 1
-
-traj_sampled32 = np.reshape(traj_sampled3, num_samples3*num_traj)
-
-traj_sampled32_norm = (traj_sampled32- np.min(traj_sampled32)) / (np.max(traj_sampled32) - np.min(traj_sampled32))
-traj_sampled32_scaled = traj_sampled32_norm*(50-1) + 1
-#print(traj_sampled32_scaled.shape, np.min(traj_sampled32_scaled), np.max(traj_sampled32_scaled))
-
-traj_sampled32_scaled = np.reshape(traj_sampled32_scaled, (num_samples3, num_traj))
-traj_sampled32_scaled = torch.from_numpy(traj_sampled32_scaled)
-traj_sampled3 = torch.from_numpy(traj_sampled3)
-print(traj_sampled32_scaled.shape, traj_sampled3.shape)
-
-####################### Sampled traj from functional 4
-#traj_sampled4 = torch.normal(0, 1, size=(num_samples4, num_traj))
-#Rescaling to similar sample data defined from func 1
-#traj_sampled4_scaled = traj_sampled4*(50-1) + 1
-#print(traj_sampled4_scaled.shape, torch.min(traj_sampled4_scaled), torch.max(traj_sampled4_scaled))
-
-#Combine data sampled from multiple functionals
-traj_sampled = torch.vstack((traj_sampled1, traj_sampled22_scaled, traj_sampled32_scaled))
+# Functional 1: cool-down trajectories defined by 4 variables (start, stop, cool rate, time-out) in the real space
+# Functional 2: random piecewise-linear trajectories, functional 3: periodic ones, both rescaled to [1, 50]
+# Combine data sampled from multiple functionals
+traj_sampled = trajectory_library((num_samples1, num_samples2, num_samples3), num_traj)
 
 print(traj_sampled.shape)
 
@@ -1035,18 +923,11 @@ train_loader_traj = pv.utils.init_dataloader(traj_sampled.unsqueeze(1), batch_si
 # set the dimension of the spectra
 in_dim = (num_traj,)
 
-# Initialize invariant VAE
-vae_traj = pv.models.iVAE(in_dim, latent_dim=2, invariances=None,
-                      sampler_d="gaussian", decoder_sig=.3, sigmoid_d=False,
-                      seed=0)
-
-# Initialize SVI trainer
-trainer_traj = pv.trainers.SVItrainer(vae_traj, lr=1e-4)
-
-# Train for n epochs:
-for e in range(200):
-    trainer_traj.step(train_loader_traj)
-    trainer_traj.print_statistics()
+# Invariant VAE trained with SVI; reloaded from artifacts/ when a run with the same generator and
+# training configuration already trained it, resumed from its checkpoint if interrupted
+traj_config = {"num_traj": num_traj, "num_samples": [num_samples1, num_samples2, num_samples3], "seed": 100,
+               "latent_dim": 2, "decoder_sig": .3, "lr": 1e-4, "batch_size": 64, "epochs": 200}
+vae_traj, traj_meta = pretrain_trajectory_vae(traj_sampled, traj_config, print_every=50)
 
 """View the learned latent manifold:"""
 